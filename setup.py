@@ -36,6 +36,8 @@ setup(
         'inkpy==0.1.0-alpha',
         'django-search-forms[ajax]==0.5',
         'factory-boy==2.3.1',
+        # the version is pinned by ralph
+        'django-rq',
     ],
     entry_points={
         'django.pluggable_app': [
@@ -6,12 +6,14 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+from collections import defaultdict
 
 from django.conf import settings
 from django.contrib.auth.models import User
 from tastypie import fields
 from tastypie.authentication import ApiKeyAuthentication
 from tastypie.constants import ALL, ALL_WITH_RELATIONS
+from tastypie.paginator import Paginator
 from tastypie.resources import ModelResource
 from tastypie.throttle import CacheThrottle
 
@@ -27,15 +29,33 @@ from ralph_assets.models import (
     DeviceInfo,
     Licence,
     LicenceType,
+    OutboxEntry,
     Service,
     SoftwareCategory,
     Warehouse,
 )
+from ralph_assets.licences.models import prefetch_subtree_usages
 
 THROTTLE_AT = settings.API_THROTTLING['throttle_at']
 TIMEFRAME = settings.API_THROTTLING['timeframe']
 EXPIRATION = settings.API_THROTTLING['expiration']
 SAVE_PRIORITY = 10
+# relations dehydrated by licence resources and AssetsResource, loaded with
+# listed objects, so pages take the same number of queries for any limit
+LICENCE_RELATED = (
+    'licence_type', 'manufacturer', 'property_of', 'software_category',
+)
+ASSET_RELATED = (
+    'device_environment', 'device_info', 'model__category',
+    'model__manufacturer', 'owner', 'service', 'service_name', 'user',
+    'warehouse',
+)
+ASSET_PREFETCHED = ('licences',) + tuple(
+    'licences__' + name for name in LICENCE_RELATED
+)
+USER_PREFETCHED = ('licence_set',) + tuple(
+    'licence_set__' + name for name in LICENCE_RELATED
+)
 
 
 class ChoicesField(fields.ApiField):
@@ -74,6 +94,50 @@ class LinkedField(fields.ApiField):
             return None
 
 
+class LinkedDevicesPaginator(Paginator):
+    """Paginator resolving linked devices of the whole page of assets by one
+    query, for ``linked_device`` and ``venture`` fields."""
+
+    def get_slice(self, limit, offset):
+        assets = list(
+            super(LinkedDevicesPaginator, self).get_slice(limit, offset)
+        )
+        Asset.prefetch_linked_devices(assets)
+        return assets
+
+
+class SubtreeUsagePaginator(Paginator):
+    """Paginator computing subtree usages of the whole page of licences by
+    one query."""
+
+    def get_slice(self, limit, offset):
+        licences = list(
+            super(SubtreeUsagePaginator, self).get_slice(limit, offset)
+        )
+        prefetch_subtree_usages(licences)
+        return licences
+
+
+class OwnedAssetsPaginator(Paginator):
+    """Paginator loading assets owned by the whole page of users by one
+    query, for :class:`AssetsField`."""
+
+    def get_slice(self, limit, offset):
+        users = list(
+            super(OwnedAssetsPaginator, self).get_slice(limit, offset)
+        )
+        owned = defaultdict(list)
+        assets = list(Asset.objects.filter(
+            owner__in=[user.id for user in users],
+        ).select_related(*ASSET_RELATED).prefetch_related(*ASSET_PREFETCHED))
+        for asset in assets:
+            owned[asset.owner_id].append(asset)
+        Asset.prefetch_linked_devices(assets)
+        for user in users:
+            user._owned_assets = owned[user.id]
+        return users
+
+
 class AssetsField(fields.RelatedField):
     """A field representing an assigned assets to user.
     Filtered by Asset.owner field"""
@@ -88,7 +152,9 @@ class AssetsField(fields.RelatedField):
         super(AssetsField, self).__init__(*args, **kwargs)
 
     def dehydrate(self, bundle, **kwargs):
-        assets = Asset.objects.filter(owner=bundle.obj)
+        assets = getattr(bundle.obj, '_owned_assets', None)
+        if assets is None:
+            assets = Asset.objects.filter(owner=bundle.obj)
         return [
             self.dehydrate_related(bundle, self.get_related_resource(asset))
             for asset in assets
@@ -194,7 +260,9 @@ class WarehouseResource(ModelResource):
         }
 
 
-class LicenceResource(ModelResource):
+class NestedLicenceResource(ModelResource):
+    """Licences listed inside assets and user assignments, without subtree
+    usages, which would be computed per licence."""
     asset_type = ChoicesField(AssetType)
     licence_type = fields.ForeignKey(LicenceTypeResource, 'licence_type')
     manufacturer = fields.ForeignKey(
@@ -209,6 +277,7 @@ class LicenceResource(ModelResource):
 
     class Meta:
         queryset = Licence.objects.all()
+        resource_name = 'licence'
         authentication = ApiKeyAuthentication()
         filtering = {
             'number_bought': ALL,
@@ -234,6 +303,27 @@ class LicenceResource(ModelResource):
             expiration=EXPIRATION,
         )
 
+    def get_object_list(self, request):
+        # Workaround for RegionMiddleware
+        # Resource.queryset is evaluated at module load
+        return Licence.objects.select_related(*LICENCE_RELATED)
+
+    def resource_uri_kwargs(self, bundle_or_obj=None):
+        kwargs = super(NestedLicenceResource, self).resource_uri_kwargs(
+            bundle_or_obj,
+        )
+        # only the subclass is registered in the api
+        if LicenceResource._meta.api_name is not None:
+            kwargs['api_name'] = LicenceResource._meta.api_name
+        return kwargs
+
+
+class LicenceResource(NestedLicenceResource):
+    subtree_usage = fields.DictField(attribute='subtree_usage', readonly=True)
+
+    class Meta(NestedLicenceResource.Meta):
+        paginator_class = SubtreeUsagePaginator
+
 
 class DeviceInfoResource(ModelResource):
     class Meta:
@@ -247,7 +337,9 @@ class DeviceInfoResource(ModelResource):
 
 class AssetsResource(ModelResource):
     asset_type = ChoicesField(AssetType, 'type')
-    licences = fields.ToManyField(LicenceResource, 'licences', full=True)
+    licences = fields.ToManyField(
+        NestedLicenceResource, 'licences', full=True,
+    )
     manufacturer = fields.ForeignKey(
         AssetManufacturerResource, 'manufacturer', null=True,
     )
@@ -320,6 +412,7 @@ class AssetsResource(ModelResource):
             'user': ALL_WITH_RELATIONS,
             'warehouse': ALL_WITH_RELATIONS,
         }
+        paginator_class = LinkedDevicesPaginator
         list_allowed_methods = ['get']
         throttle = CacheThrottle(
             throttle_at=THROTTLE_AT,
@@ -330,13 +423,15 @@ class AssetsResource(ModelResource):
     def get_object_list(self, request):
         # Workaround for RegionMiddleware
         # Resource.queryset is evaluated at module load
-        return Asset.objects.all()
+        return Asset.objects.select_related(
+            *ASSET_RELATED
+        ).prefetch_related(*ASSET_PREFETCHED)
 
 
 class UserAssignmentsResource(ModelResource):
     is_m2m = True
     licences = fields.ToManyField(
-        LicenceResource,
+        NestedLicenceResource,
         'licence_set',
         full=True,
     )
@@ -346,7 +441,7 @@ class UserAssignmentsResource(ModelResource):
     user_username = fields.CharField(attribute="username")
 
     class Meta:
-        queryset = User.objects.all()
+        queryset = User.objects.prefetch_related(*USER_PREFETCHED)
         resource_name = 'user_assignments'
         authentication = ApiKeyAuthentication()
         excludes = [
@@ -355,9 +450,40 @@ class UserAssignmentsResource(ModelResource):
         filtering = {
             'user_username': ALL,
         }
+        paginator_class = OwnedAssetsPaginator
+        list_allowed_methods = ['get']
+        throttle = CacheThrottle(
+            throttle_at=THROTTLE_AT,
+            timeframe=TIMEFRAME,
+            expiration=EXPIRATION,
+        )
+
+
+class ChangesResource(ModelResource):
+    """Changes of assets, device info, licences and supports in the order
+    they were made. Consumers read them incrementally, filtering with
+    ``id__gt`` set to the last sequence number they've seen. Only changes
+    older than ``ASSETS_OUTBOX_LAG`` are listed."""
+
+    class Meta:
+        queryset = OutboxEntry.objects.select_related('content_type')
+        resource_name = 'changes'
+        authentication = ApiKeyAuthentication()
         list_allowed_methods = ['get']
+        detail_allowed_methods = []
+        filtering = {
+            'id': ALL,
+        }
+        ordering = ['id']
         throttle = CacheThrottle(
             throttle_at=THROTTLE_AT,
             timeframe=TIMEFRAME,
             expiration=EXPIRATION,
         )
+
+    def get_object_list(self, request):
+        return OutboxEntry.objects.visible().select_related('content_type')
+
+    def dehydrate(self, bundle):
+        bundle.data.update(bundle.obj.to_dict())
+        return bundle
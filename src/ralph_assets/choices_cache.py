@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""Precomputed lookup tables for fields with choices.
+
+Tables are built once per model field (and language) and live as long as the
+process, so changes of choices are picked up after restart.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from collections import namedtuple
+
+from django.utils.translation import get_language
+
+
+ChoicesLookup = namedtuple('ChoicesLookup', ['labels', 'ids'])
+
+_lookups = {}
+
+
+def get_choices_lookup(model, field_name):
+    """Return :class:`ChoicesLookup` for *field_name* of *model*, where:
+
+        * ``labels`` maps choice id to its label,
+        * ``ids`` maps lowercased and stripped label to choice id (the first
+          choice wins if labels repeat).
+    """
+    key = (model, field_name, get_language())
+    try:
+        return _lookups[key]
+    except KeyError:
+        pass
+    field = model._meta.get_field_by_name(field_name)[0]
+    labels = {}
+    ids = {}
+    for choice_id, label in field.choices or []:
+        labels.setdefault(choice_id, label)
+        ids.setdefault(unicode(label).lower().strip(), choice_id)
+    lookup = _lookups[key] = ChoicesLookup(labels, ids)
+    return lookup
+
+
+def clear_choices_cache():
+    _lookups.clear()
@@ -0,0 +1,598 @@
+# -*- coding: utf-8 -*-
+"""Helpers for bulk data import (XLS/CSV) working on the whole file at once."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import itertools
+import multiprocessing
+from collections import defaultdict, namedtuple
+from datetime import datetime
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connections, router, transaction
+from django.db.models.fields import (
+    BooleanField,
+    CharField,
+    DateField,
+    DecimalField,
+    FieldDoesNotExist,
+    TextField,
+)
+from django.db.models.fields.related import ManyToManyField, RelatedField
+from django.template.defaultfilters import slugify
+from django.utils.dateparse import parse_date, parse_datetime
+from lck.django.common.models import Named
+from ralph.discovery.models_device import DeviceEnvironment, ServiceCatalog
+
+from ralph_assets.choices_cache import get_choices_lookup
+from ralph_assets.models_assets import (
+    AssetCategory,
+    AssetManufacturer,
+    AssetModel,
+    CreatableFromString,
+    Sluggy,
+)
+
+
+IMPORT_CHUNK_SIZE = 1000
+# files with fewer rows are converted in the request process
+IMPORT_POOL_MIN_ROWS = getattr(settings, 'ASSETS_IMPORT_POOL_MIN_ROWS', 20000)
+# ``None`` means as many workers as CPUs
+IMPORT_POOL_PROCESSES = getattr(settings, 'ASSETS_IMPORT_POOL_PROCESSES', None)
+UNIQUE_IMPORT_FIELDS = ('sn', 'barcode', 'hostname', 'niw')
+# changes of these fields have to go through ``save`` - they are synced with
+# Ralph core, trigger hostname assignment or rebuild the MPTT tree
+BULK_UPDATE_EXCLUDED_FIELDS = {
+    'device_environment', 'hostname', 'owner', 'parent', 'service', 'status',
+}
+RESOLVABLE_MODELS = (
+    Named, Named.NonUnique, User, Sluggy, DeviceEnvironment, ServiceCatalog,
+)
+
+
+def chunked(iterable, size=IMPORT_CHUNK_SIZE):
+    """Split *iterable* into lists of at most *size* items."""
+    items = list(iterable)
+    for start in xrange(0, len(items), size):
+        yield items[start:start + size]
+
+
+def bulk_update(Model, objs, field_names, values=None,
+                chunk_size=IMPORT_CHUNK_SIZE):
+    """Write values of *field_names* from *objs* with one ``UPDATE`` per
+    chunk of objects.
+
+    Values differing between objects are set with ``CASE`` expressions keyed
+    by the primary key; *values* maps names of fields to values set on all
+    objects. ``save`` isn't called and no signals are sent, so ``modified``
+    and ``cache_version`` are bumped here when the model has them.
+    """
+    using = router.db_for_write(Model)
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    meta = Model._meta
+    pk_column = qn(meta.pk.column)
+    fields = [meta.get_field(name) for name in field_names]
+    local_fields = set(field.name for field in meta.fields)
+    cursor = connection.cursor()
+    for chunk in chunked(objs, chunk_size):
+        assignments = []
+        params = []
+        for field in fields:
+            column = qn(field.column)
+            cases = []
+            for obj in chunk:
+                cases.append('WHEN %s THEN %s')
+                params.extend([
+                    obj.pk,
+                    field.get_db_prep_save(
+                        getattr(obj, field.attname), connection=connection,
+                    ),
+                ])
+            assignments.append('{} = CASE {} {} ELSE {} END'.format(
+                column, pk_column, ' '.join(cases), column,
+            ))
+        for name, value in (values or {}).iteritems():
+            field = meta.get_field(name)
+            assignments.append('{} = %s'.format(qn(field.column)))
+            if field.rel:
+                value = getattr(value, 'pk', value)
+            params.append(
+                field.get_db_prep_save(value, connection=connection),
+            )
+        if 'modified' in local_fields and 'modified' not in field_names:
+            assignments.append('{} = %s'.format(qn('modified')))
+            params.append(datetime.now())
+        if 'cache_version' in local_fields:
+            assignments.append('{0} = {0} + 1'.format(qn('cache_version')))
+        params.extend(obj.pk for obj in chunk)
+        cursor.execute(
+            'UPDATE {} SET {} WHERE {} IN ({})'.format(
+                qn(meta.db_table),
+                ', '.join(assignments),
+                pk_column,
+                ', '.join(['%s'] * len(chunk)),
+            ),
+            params,
+        )
+    transaction.commit_unless_managed(using=using)
+
+
+FieldSpec = namedtuple('FieldSpec', ['kind', 'empty', 'choices'])
+
+
+def get_field_spec(field):
+    """Describe how text from a file is converted for *field*.
+
+    The description is a picklable :class:`FieldSpec`, so conversion can be
+    done in worker processes without access to models.
+    """
+    if isinstance(field, ManyToManyField):
+        empty = []
+    elif (
+        isinstance(field, (TextField, CharField)) and
+        field.name not in ('imei', 'sn', 'barcode')
+    ):
+        empty = ''
+    else:
+        empty = None
+    kind = None
+    if isinstance(field, BooleanField):
+        kind = 'boolean'
+    elif isinstance(field, DecimalField):
+        kind = 'decimal'
+    elif isinstance(field, DateField):
+        kind = 'date'
+    choices = {}
+    if field.choices:
+        choices = get_choices_lookup(field.model, field.name).ids
+    return FieldSpec(kind, empty, choices)
+
+
+def convert_value(spec, value):
+    """Transform a pure string into the value to be put into the field
+    described by *spec*. Values of related fields are left as they are."""
+    if not value:
+        return spec.empty
+    if spec.kind == 'boolean':
+        value = False if value.lower() in ["0", "false"] else True
+    elif spec.kind == 'decimal':
+        if value.count(',') == 1 and '.' not in value:
+            value = value.replace(',', '.')
+    elif spec.kind == 'date':
+        value = parse_datetime(value) or parse_date(value) or None
+    if spec.choices:
+        value = spec.choices.get(value.lower().strip(), value)
+    return value
+
+
+def _convert_rows(args):
+    specs, rows = args
+    result = []
+    for row in rows:
+        converted = {}
+        error = None
+        for key, value in row.iteritems():
+            spec = specs.get(key)
+            if spec is None:
+                converted[key] = value
+                continue
+            try:
+                converted[key] = convert_value(spec, value)
+            except Exception as exc:
+                error = (key, repr(exc))
+                break
+        result.append((converted, error))
+    return result
+
+
+def convert_rows(specs, rows):
+    """Convert cell values of all *rows* (dicts keyed by column).
+
+    *specs* maps a column to the :class:`FieldSpec` of its field, columns
+    without a spec are copied as they are. Return a list of
+    ``(converted row, error)`` in the order of *rows*; ``error`` is ``None``
+    unless conversion of the row failed, then it's ``(column, message)``.
+
+    Conversion doesn't touch the database, so big files are split into chunks
+    converted in a pool of worker processes started for this call only. The
+    workers never use database connections inherited from the caller and
+    exit without closing them.
+    """
+    if len(rows) < IMPORT_POOL_MIN_ROWS:
+        return _convert_rows((specs, rows))
+    pool = multiprocessing.Pool(IMPORT_POOL_PROCESSES)
+    try:
+        results = pool.map(
+            _convert_rows, [(specs, chunk) for chunk in chunked(rows)],
+        )
+        pool.close()
+    except Exception:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return list(itertools.chain.from_iterable(results))
+
+
+def get_lookup_field(Model):
+    """Return the name of the field used to find *Model* objects by the text
+    typed in an imported file."""
+    if issubclass(Model, User):
+        return 'username'
+    if issubclass(Model, Sluggy):
+        return 'slug'
+    return 'name'
+
+
+def _normalize(value):
+    if value is None:
+        return None
+    value = unicode(value).strip()
+    return value or None
+
+
+def _get_column(Model, field_name):
+    """Return the quoted column of *field_name* for ``extra`` queries."""
+    qn = connections[router.db_for_read(Model)].ops.quote_name
+    return '{}.{}'.format(
+        qn(Model._meta.db_table), qn(Model._meta.get_field(field_name).column),
+    )
+
+
+def resolve_names(Model, values):
+    """Return the lowercased subset of *values* which can be matched
+    case-insensitively with existing *Model* objects.
+
+    Values are compared with ``UPPER`` of the lookup column, one query per
+    chunk of values, so names missing from the database don't add queries.
+    """
+    lookup = get_lookup_field(Model)
+    manager = Model._base_manager
+    column = _get_column(Model, lookup)
+    found = set()
+    for chunk in chunked(set(value.upper() for value in values)):
+        found.update(
+            name.lower() for name in manager.extra(
+                where=['UPPER({}) IN ({})'.format(
+                    column, ', '.join(['%s'] * len(chunk)),
+                )],
+                params=chunk,
+            ).values_list(lookup, flat=True)
+        )
+    return found
+
+
+class ImportValidator(object):
+    """Validate an import file without writing anything to the database.
+
+    All rows are checked at once:
+
+        * values which can't be converted (in a pool of processes for big
+          files, see :func:`convert_rows`),
+        * duplicated unique values inside the file (hash sets),
+        * collisions of unique values with existing objects (chunked ``IN``
+          queries),
+        * references to objects which don't exist and can't be created from
+          text (bulk lookups),
+        * ids of updated objects which don't exist.
+    """
+
+    def __init__(self, Model, mappings, category_type=None):
+        self.Model = Model
+        self.mappings = mappings
+        self.category_type = category_type
+        self.errors = []
+
+    def add_error(self, row, column, message):
+        self.errors.append({
+            'row': row,
+            'column': column,
+            'message': message,
+        })
+
+    def get_field(self, field_name):
+        if '.' in field_name:
+            return None
+        try:
+            return self.Model._meta.get_field_by_name(field_name)[0]
+        except FieldDoesNotExist:
+            return None
+
+    def iter_rows(self, update_per_sheet, add_per_sheet):
+        """Yield ``(label, object id, {field name: raw value})`` for every
+        row of the file."""
+        for sheet_name, sheet_data in update_per_sheet.items():
+            for asset_id, asset_data in sheet_data.items():
+                yield 'id {}'.format(asset_id), asset_id, self._map(asset_data)
+        for sheet_name, sheet_data in add_per_sheet.items():
+            for index, asset_data in enumerate(sheet_data, start=2):
+                label = '{} #{}'.format(sheet_name, index)
+                yield label, None, self._map(asset_data)
+
+    def _map(self, asset_data):
+        result = {}
+        for key, value in asset_data.iteritems():
+            field_name = self.mappings.get(slugify(key))
+            if field_name:
+                result[field_name] = value
+        return result
+
+    @property
+    def unique_fields(self):
+        fields = []
+        for field_name in UNIQUE_IMPORT_FIELDS:
+            field = self.get_field(field_name)
+            if field is not None and field.unique:
+                fields.append(field_name)
+        return fields
+
+    def check_values(self, rows):
+        specs = {}
+        for field_name in set(itertools.chain.from_iterable(
+            data for _, _, data in rows
+        )):
+            field = self.get_field(field_name)
+            try:
+                specs[field_name] = get_field_spec(field)
+            except AttributeError:
+                # not a field of the model (e.g. of its amendment)
+                continue
+        results = convert_rows(specs, [data for _, _, data in rows])
+        for (label, _, _), (_, error) in zip(rows, results):
+            if error:
+                field_name, message = error
+                self.add_error(
+                    label, field_name, 'Invalid value: {}.'.format(message),
+                )
+
+    def check_duplicates(self, rows):
+        for field_name in self.unique_fields:
+            seen = {}
+            for label, _, data in rows:
+                value = _normalize(data.get(field_name))
+                if value is None:
+                    continue
+                key = value.upper()
+                if key in seen:
+                    self.add_error(
+                        label, field_name,
+                        'Duplicated value {!r} (also in {}).'.format(
+                            value, seen[key],
+                        ),
+                    )
+                else:
+                    seen[key] = label
+
+    def check_collisions(self, rows):
+        """Report values used by other objects. Both sides are stripped and
+        upper-cased, as case-insensitive collations would match them."""
+        manager = self.Model._base_manager
+        for field_name in self.unique_fields:
+            column = _get_column(self.Model, field_name)
+            rows_by_value = defaultdict(list)
+            for label, object_id, data in rows:
+                value = _normalize(data.get(field_name))
+                if value is not None:
+                    rows_by_value[value.upper()].append((label, object_id))
+            for chunk in chunked(rows_by_value):
+                existing = manager.extra(
+                    where=['UPPER(TRIM({})) IN ({})'.format(
+                        column, ', '.join(['%s'] * len(chunk)),
+                    )],
+                    params=chunk,
+                ).values_list('pk', field_name)
+                for pk, value in existing:
+                    key = (_normalize(value) or '').upper()
+                    for label, object_id in rows_by_value.get(key, []):
+                        if object_id == pk:
+                            continue
+                        self.add_error(
+                            label, field_name,
+                            'Value {!r} is already used by object '
+                            'id {}.'.format(value, pk),
+                        )
+
+    def check_foreign_keys(self, rows):
+        values_by_field = defaultdict(set)
+        for _, _, data in rows:
+            for field_name, value in data.iteritems():
+                value = _normalize(value)
+                if value is not None:
+                    values_by_field[field_name].add(value)
+        for field_name, values in values_by_field.iteritems():
+            if field_name == 'model.category':
+                self._check_categories(rows, values)
+                continue
+            field = self.get_field(field_name)
+            if not isinstance(field, RelatedField):
+                continue
+            RelModel = field.rel.to
+            if (
+                not issubclass(RelModel, RESOLVABLE_MODELS) or
+                issubclass(RelModel, CreatableFromString)
+            ):
+                continue
+            found = resolve_names(RelModel, values)
+            self._report_missing(rows, field_name, found)
+
+    def _check_categories(self, rows, values):
+        found = set()
+        queryset = AssetCategory.objects.all()
+        if self.category_type is not None:
+            queryset = queryset.filter(type=self.category_type)
+        for chunk in chunked(values):
+            found.update(
+                name.lower() for name in queryset.filter(
+                    name__in=chunk,
+                ).values_list('name', flat=True)
+            )
+        self._report_missing(rows, 'model.category', found)
+
+    def _report_missing(self, rows, field_name, found):
+        for label, _, data in rows:
+            value = _normalize(data.get(field_name))
+            if value is not None and value.lower() not in found:
+                self.add_error(
+                    label, field_name,
+                    'Couldn\'t find value {!r}.'.format(value),
+                )
+
+    def check_updated_ids(self, rows):
+        ids = set(object_id for _, object_id, _ in rows if object_id)
+        existing = set()
+        for chunk in chunked(ids):
+            existing.update(
+                self.Model._base_manager.filter(
+                    pk__in=chunk,
+                ).values_list('pk', flat=True)
+            )
+        for label, object_id, _ in rows:
+            if object_id and object_id not in existing:
+                self.add_error(label, 'id', 'Object doesn\'t exist.')
+
+    def validate(self, update_per_sheet, add_per_sheet):
+        """Run all checks and return the list of found errors."""
+        self.errors = []
+        rows = list(self.iter_rows(update_per_sheet, add_per_sheet))
+        self.check_values(rows)
+        self.check_updated_ids(rows)
+        self.check_duplicates(rows)
+        self.check_collisions(rows)
+        self.check_foreign_keys(rows)
+        return self.errors
+
+
+class AssetModelResolver(object):
+    """Import-scoped cache of ``AssetModel`` objects.
+
+    Models are keyed by ``(name, category name, manufacturer name)``. All
+    combinations used in the file should be passed to :meth:`preload`, which
+    fetches categories, manufacturers and models in bulk and creates the
+    missing manufacturers and models with ``bulk_create``. After that
+    :meth:`get` is served from memory.
+    """
+
+    def __init__(self, asset_type, category_type):
+        self.asset_type = asset_type
+        self.category_type = category_type
+        self.categories = {}
+        self.manufacturers = {}
+        self.models = {}
+
+    def _model_key(self, name, category, manufacturer):
+        return (
+            name,
+            category.pk if category else None,
+            manufacturer.pk if manufacturer else None,
+        )
+
+    def _load_categories(self, names):
+        for chunk in chunked(names):
+            for category in AssetCategory.objects.filter(
+                name__in=chunk, type=self.category_type,
+            ):
+                self.categories.setdefault(category.name, category)
+
+    def _load_manufacturers(self, names):
+        def fetch(names):
+            for chunk in chunked(names):
+                for manufacturer in AssetManufacturer.objects.filter(
+                    name__in=chunk,
+                ):
+                    self.manufacturers[manufacturer.name] = manufacturer
+        fetch(names)
+        missing = set(names) - set(self.manufacturers)
+        if missing:
+            AssetManufacturer.objects.bulk_create([
+                AssetManufacturer(name=name) for name in missing
+            ])
+            fetch(missing)
+
+    def _load_models(self, combinations):
+        def fetch(names):
+            for chunk in chunked(names):
+                for model in AssetModel.objects.filter(
+                    name__in=chunk, type=self.asset_type,
+                ):
+                    key = (
+                        model.name, model.category_id, model.manufacturer_id,
+                    )
+                    self.models.setdefault(key, model)
+        names = set(name for name, _, _ in combinations)
+        fetch(names)
+        missing = {}
+        for name, category_name, manufacturer_name in combinations:
+            category = self.categories.get(category_name)
+            manufacturer = self.manufacturers.get(manufacturer_name)
+            key = self._model_key(name, category, manufacturer)
+            if key not in self.models:
+                missing[key] = AssetModel(
+                    name=name,
+                    type=self.asset_type,
+                    category=category,
+                    manufacturer=manufacturer,
+                )
+        if missing:
+            AssetModel.objects.bulk_create(missing.values())
+            fetch(set(name for name, _, _ in missing))
+
+    def preload(self, combinations):
+        """Fetch or create everything needed for *combinations* of
+        ``(model name, category name, manufacturer name)``.
+
+        Combinations referring to a category which doesn't exist are skipped,
+        :meth:`get` will raise ``AssetCategory.DoesNotExist`` for them.
+        """
+        combinations = set(
+            combination for combination in combinations if combination[0]
+        )
+        self._load_categories(set(
+            category for _, category, _ in combinations if category
+        ))
+        self._load_manufacturers(set(
+            manufacturer for _, _, manufacturer in combinations if manufacturer
+        ))
+        self._load_models([
+            combination for combination in combinations
+            if not combination[1] or combination[1] in self.categories
+        ])
+
+    def get(self, name, category_name=None, manufacturer_name=None):
+        """Return the ``AssetModel`` for the given names, creating it (and its
+        manufacturer) when it wasn't preloaded.
+
+        Raise ``AssetCategory.DoesNotExist`` if category name is provided but
+        doesn't exist.
+        """
+        category = None
+        if category_name:
+            category = self.categories.get(category_name)
+            if category is None:
+                category = AssetCategory.objects.get(
+                    name=category_name, type=self.category_type,
+                )
+                self.categories[category_name] = category
+        manufacturer = None
+        if manufacturer_name:
+            manufacturer = self.manufacturers.get(manufacturer_name)
+            if manufacturer is None:
+                manufacturer = AssetManufacturer.objects.get_or_create(
+                    name=manufacturer_name,
+                )[0]
+                self.manufacturers[manufacturer_name] = manufacturer
+        key = self._model_key(name, category, manufacturer)
+        model = self.models.get(key)
+        if model is None:
+            model = AssetModel.objects.get_or_create(
+                name=name,
+                type=self.asset_type,
+                category=category,
+                manufacturer=manufacturer,
+            )[0]
+            self.models[key] = model
+        return model
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""Digest of supports and licences expiring soon, grouped by owners of the
+assets they cover."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import csv
+import datetime
+import json
+import os
+import re
+from collections import defaultdict
+
+from django.conf import settings
+from django.utils.encoding import smart_str
+
+from ralph_assets.history.utils import history_scope
+from ralph_assets.licences.models import Licence, LicenceAsset, LicenceUser
+from ralph_assets.models_support import Support
+
+
+# contracts expiring within this many days from today are included
+EXPIRY_DIGEST_DAYS = getattr(settings, 'ASSETS_EXPIRY_DIGEST_DAYS', 30)
+# directory digests are written to
+EXPIRY_DIGEST_PATH = getattr(settings, 'ASSETS_EXPIRY_DIGEST_PATH', '/tmp/')
+# rq queue running scheduled digests
+EXPIRY_DIGEST_QUEUE = getattr(
+    settings, 'ASSETS_EXPIRY_DIGEST_QUEUE', 'default',
+)
+DIGEST_FORMATS = ('csv', 'json')
+DIGEST_FIELDS = (
+    'owner', 'type', 'id', 'name', 'expires', 'asset_id', 'asset_sn',
+    'asset_barcode',
+)
+# owner of contracts without assigned assets and of assets without owner
+NO_OWNER = ''
+UNSAFE_CHARS = re.compile(r'[^\w.@-]+')
+
+
+def _asset_row(contract, asset_id, sn, barcode, owner):
+    row = dict(contract)
+    row.update({
+        'owner': owner or NO_OWNER,
+        'asset_id': asset_id,
+        'asset_sn': sn or '',
+        'asset_barcode': barcode or '',
+    })
+    return row
+
+
+def get_expiring(days=EXPIRY_DIGEST_DAYS, today=None):
+    """Return rows of supports and licences expiring within *days* from
+    *today*, one per covered asset (or user a licence is assigned to),
+    grouped by owner usernames. Contracts are read by date-range queries and
+    their assets by one query per assignment table, so the number of queries
+    doesn't depend on the number of expiring contracts. Soft-deleted
+    supports and assets are skipped; contracts of all regions are
+    included."""
+    today = today or datetime.date.today()
+    end = today + datetime.timedelta(days=days)
+    digest = defaultdict(list)
+    contracts = {}
+    for support_id, name, contract_id, date_to in Support.admin_objects.filter(
+        date_to__gte=today, date_to__lte=end, deleted=False,
+    ).values_list('id', 'name', 'contract_id', 'date_to'):
+        contracts['support', support_id] = {
+            'type': 'support',
+            'id': support_id,
+            'name': '{} ({})'.format(name, contract_id),
+            'expires': date_to,
+        }
+    for licence_id, niw, category, valid_thru in Licence.admin_objects.filter(
+        valid_thru__gte=today, valid_thru__lte=end,
+    ).values_list('id', 'niw', 'software_category__name', 'valid_thru'):
+        contracts['licence', licence_id] = {
+            'type': 'licence',
+            'id': licence_id,
+            'name': '{} ({})'.format(category, niw),
+            'expires': valid_thru,
+        }
+    covered = set()
+    assignments = (
+        ('support', Support.assets.through.objects.filter(
+            support__date_to__gte=today, support__date_to__lte=end,
+            support__deleted=False, asset__deleted=False,
+        ).values_list(
+            'support', 'asset', 'asset__sn', 'asset__barcode',
+            'asset__owner__username',
+        )),
+        ('licence', LicenceAsset.objects.filter(
+            licence__valid_thru__gte=today, licence__valid_thru__lte=end,
+            asset__deleted=False,
+        ).values_list(
+            'licence', 'asset', 'asset__sn', 'asset__barcode',
+            'asset__owner__username',
+        )),
+        ('licence', LicenceUser.objects.filter(
+            licence__valid_thru__gte=today, licence__valid_thru__lte=end,
+        ).values_list('licence', 'user__username')),
+    )
+    for kind, rows in assignments:
+        for row in rows:
+            contract = contracts.get((kind, row[0]))
+            if contract is None:
+                # the contract was changed between queries
+                continue
+            covered.add((kind, row[0]))
+            if len(row) == 2:
+                # licence assigned to a user
+                row = (row[0], None, None, None, row[1])
+            digest[row[4] or NO_OWNER].append(_asset_row(contract, *row[1:]))
+    for key, contract in contracts.iteritems():
+        if key not in covered:
+            digest[NO_OWNER].append(_asset_row(contract, None, '', '', None))
+    for rows in digest.itervalues():
+        rows.sort(key=lambda row: (row['expires'], row['type'], row['id']))
+    return dict(digest)
+
+
+def write_digest(digest, path=EXPIRY_DIGEST_PATH, format='csv', today=None):
+    """Write *digest* to one file per owner in a dated directory inside
+    *path*. Return the directory."""
+    today = today or datetime.date.today()
+    directory = os.path.join(path, 'expiry_digest_{}'.format(today))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    for owner, rows in digest.iteritems():
+        file_name = '{}.{}'.format(
+            UNSAFE_CHARS.sub('_', owner) or 'no_owner', format,
+        )
+        with open(os.path.join(directory, file_name), 'wb') as f:
+            if format == 'json':
+                json.dump(rows, f, default=unicode, indent=2)
+            else:
+                writer = csv.writer(f)
+                writer.writerow([smart_str(field) for field in DIGEST_FIELDS])
+                for row in rows:
+                    writer.writerow([
+                        smart_str(row[field] or '') for field in DIGEST_FIELDS
+                    ])
+    return directory
+
+
+@history_scope()
+def expiry_digest(days=EXPIRY_DIGEST_DAYS, path=EXPIRY_DIGEST_PATH,
+                  format='csv'):
+    """Compute and write the digest; meant to be enqueued as an rq job."""
+    return write_digest(get_expiring(days), path, format)
+
+
+def enqueue_expiry_digest(days=EXPIRY_DIGEST_DAYS, path=EXPIRY_DIGEST_PATH,
+                          format='csv'):
+    """Enqueue :func:`expiry_digest` in ``ASSETS_EXPIRY_DIGEST_QUEUE``."""
+    import django_rq
+    return django_rq.get_queue(EXPIRY_DIGEST_QUEUE).enqueue(
+        expiry_digest, days, path, format,
+    )
@@ -211,7 +211,26 @@ class XlsColumnChoiceForm(forms.Form):
 
 
 class XlsConfirmForm(forms.Form):
-    """The confirmation of XLS submission. A form with a button only."""
+    """The confirmation of XLS submission. A file with problems found by the
+    validation is imported only when they are explicitly ignored."""
+    ignore_problems = forms.BooleanField(
+        label=_('Import despite the problems found'), required=False,
+    )
+
+    def __init__(self, validation_errors=(), *args, **kwargs):
+        super(XlsConfirmForm, self).__init__(*args, **kwargs)
+        self.validation_errors = validation_errors
+        if not validation_errors:
+            del self.fields['ignore_problems']
+
+    def clean(self):
+        result = super(XlsConfirmForm, self).clean()
+        if self.validation_errors and not result.get('ignore_problems'):
+            raise forms.ValidationError(_(
+                'Problems were found in the file. Fix them or import the '
+                'file despite them.'
+            ))
+        return result
 
 
 XLS_UPLOAD_FORMS = [
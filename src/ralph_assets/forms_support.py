@@ -25,7 +25,11 @@ from ralph.ui.widgets import DateWidget
 
 from ralph_assets import models_support
 from ralph_assets.forms import LOOKUPS, ReadOnlyFieldsMixin
-from ralph_assets.forms_utils import RegionRelatedSearchField, RegionSearchForm
+from ralph_assets.forms_utils import (
+    ExpiringSearchField,
+    RegionRelatedSearchField,
+    RegionSearchForm,
+)
 from ralph_assets.models import AssetType
 from ralph_assets.models_support import SupportType
 
@@ -159,6 +163,9 @@ class SupportSearchForm(RegionSearchForm):
     description = TextSearchField()
     date_from = DateRangeSearchField()
     date_to = DateRangeSearchField()
+    expiring = ExpiringSearchField(
+        filter_field='date_to', label=_('expiring within (days)'),
+    )
     additional_notes = TextSearchField()
     assets = TextSearchField(
         filter_field='assets__sn', label=_('by sn (of assigned asset)'),
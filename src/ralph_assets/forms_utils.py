@@ -6,6 +6,8 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import datetime
+
 from django import forms
 from django.db.models import Q
 from django_search_forms.form import SearchForm
@@ -26,6 +28,25 @@ class RegionRelatedSearchField(SearchField, forms.ChoiceField):
         return Q(**{self.name + '__id': int(value)})
 
 
+class ExpiringSearchField(SearchField, forms.IntegerField):
+    """A field that allows to search objects expiring within given number of
+    days from today."""
+
+    def __init__(self, filter_field, *args, **kwargs):
+        self.filter_field = filter_field
+        kwargs['min_value'] = 1
+        super(ExpiringSearchField, self).__init__(*args, **kwargs)
+
+    def get_query(self, value):
+        today = datetime.date.today()
+        return Q(**{
+            self.filter_field + '__gte': today,
+            self.filter_field + '__lte': today + datetime.timedelta(
+                days=value,
+            ),
+        })
+
+
 class RegionSearchForm(SearchForm):
 
     def __init__(self, *args, **kwargs):
@@ -5,13 +5,30 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import threading
+
+from django.core.signals import request_finished
 from django.db.models import signals
 
-from ralph_assets.history.receivers import m2m_changed, post_save, pre_save
+from ralph_assets.history.receivers import (
+    m2m_changed,
+    post_save,
+    pre_save,
+    reset_context,
+)
 
 
 registry = {}
 registry_m2m = {}
+registry_lock = threading.RLock()
+m2m_registry_loaded = False
+
+request_finished.connect(
+    reset_context, dispatch_uid='ralph_assets.history.reset',
+)
+signals.m2m_changed.connect(
+    m2m_changed, dispatch_uid='ralph_assets.history.m2m_changed',
+)
 
 
 def register(model, exclude=None, m2m=False):
@@ -30,4 +47,43 @@ def register(model, exclude=None, m2m=False):
         signals.post_save.connect(post_save, sender=model)
     else:
         registry_m2m[model] = True
-        signals.m2m_changed.connect(m2m_changed, sender=model)
+
+
+def register_history_model(sender, **kwargs):
+    """Register models with ``HistoryMixin`` as soon as they are created,
+    so instances don't pay for it."""
+    from ralph_assets.history.models import (
+        DEFAULT_HISTORY_FIELD_EXCLUDE,
+        HistoryMixin,
+    )
+    if not issubclass(sender, HistoryMixin) or sender in registry:
+        return
+    with registry_lock:
+        register(sender, exclude=getattr(
+            sender,
+            'exclude_fields_from_history',
+            DEFAULT_HISTORY_FIELD_EXCLUDE,
+        ))
+
+
+def load_m2m_registry():
+    """Register through models of m2m relations to models with history.
+
+    Relations are known when all models are loaded, so it's done on the
+    first m2m change.
+    """
+    global m2m_registry_loaded
+    with registry_lock:
+        if m2m_registry_loaded:
+            return
+        for model in registry.keys():
+            for field in model._meta.get_all_related_many_to_many_objects():
+                through = field.field.rel.through
+                if through not in registry_m2m:
+                    register(through, m2m=True)
+        m2m_registry_loaded = True
+
+
+signals.class_prepared.connect(
+    register_history_model, dispatch_uid='ralph_assets.history.register',
+)
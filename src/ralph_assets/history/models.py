@@ -5,14 +5,17 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import base64
+import itertools
 import json
-from collections import namedtuple
+import zlib
+from collections import defaultdict, namedtuple
 
 from datetime import datetime
 
-from django.db import models
-from django.core import serializers
+from django.db import connection, models
 from django.core.urlresolvers import reverse
+from django.utils.dateparse import parse_datetime
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.generic import GenericForeignKey
 from django.utils.translation import ugettext_lazy as _
@@ -22,16 +25,21 @@ DEFAULT_HISTORY_FIELD_EXCLUDE = ('created', 'modified', 'invoice_date',
                                  'cache_version', 'rght', 'level', 'lft',
                                  'tree_id', 'loan_end_date')
 
-serializer = serializers.get_serializer("python")()
-
 Snapshot = namedtuple(
     'Snapshot',
     ['current', 'previous', 'added', 'deleted', 'changed', 'obj', 'field_name'],  # noqa
 )
 
 
+# fields of history entries kept in the archive
+ARCHIVED_FIELDS = ('date', 'user', 'field_name', 'old_value', 'new_value')
+# number of objects whose history is prefetched in one query
+PREFETCH_CHUNK_SIZE = 500
+
+
 class HistoryManager(models.Manager):
-    def get_history_for_this_object(self, obj, field_name=None):
+    def get_history_for_this_object(self, obj, field_name=None,
+                                    archived=False):
         if not obj:
             return
         content_type = ContentType.objects.get_for_model(obj.__class__)
@@ -43,20 +51,92 @@ class HistoryManager(models.Manager):
             kwargs.update({
                 'field_name': field_name
             })
-        return self.get_history_for_this_content_type(**kwargs)
+        return self.get_history_for_this_content_type(
+            archived=archived, **kwargs
+        )
 
     def get_history_for_this_content_type(
-        self, content_type, object_id, **kwargs
+        self, content_type, object_id, archived=False, **kwargs
     ):
-        return self.model.objects.filter(
+        """Return history of the object, including its archived history
+        (see :class:`HistoryWithArchive`) when *archived* is set."""
+        history = self.model.objects.filter(
             content_type=content_type,
             object_id=object_id,
             **kwargs
         )
+        if archived:
+            history = HistoryWithArchive(
+                history.select_related('user'),
+                content_type,
+                object_id,
+                kwargs.get('field_name'),
+            )
+        return history
 
-    def log_changes(self, obj, user, diff_data):
-        if not obj:
+    def prefetch_latest(self, objs, limit=5, field_name=None,
+                        archived=False):
+        """Load up to *limit* latest history entries (with their users) of
+        each of *objs* (of one model), for
+        :meth:`HistoryMixin.get_latest_history`.
+
+        Entries of all objects are selected in one query (per chunk of
+        objects), which skips those having *limit* newer entries of the same
+        object. With *archived* the archive is read for objects with fewer
+        entries.
+        """
+        objs = [obj for obj in objs if obj.pk is not None]
+        if not objs:
             return
+        content_type = ContentType.objects.get_for_model(objs[0].__class__)
+        qn = connection.ops.quote_name
+        table = qn(self.model._meta.db_table)
+        newer = (
+            '(SELECT COUNT(*) FROM {table} newer '
+            'WHERE newer.{content_type} = {table}.{content_type} '
+            'AND newer.{object_id} = {table}.{object_id} '
+            '{same_field}AND newer.{date} > {table}.{date}) < %s'
+        ).format(
+            table=table,
+            content_type=qn('content_type_id'),
+            object_id=qn('object_id'),
+            date=qn('date'),
+            same_field=(
+                'AND newer.{0} = {1}.{0} '.format(qn('field_name'), table)
+                if field_name else ''
+            ),
+        )
+        latest = defaultdict(list)
+        pks = [obj.pk for obj in objs]
+        for start in xrange(0, len(pks), PREFETCH_CHUNK_SIZE):
+            entries = self.model.objects.filter(
+                content_type=content_type,
+                object_id__in=pks[start:start + PREFETCH_CHUNK_SIZE],
+            )
+            if field_name:
+                entries = entries.filter(field_name=field_name)
+            entries = entries.extra(
+                where=[newer], params=[limit],
+            ).select_related('user').order_by('object_id', '-date', '-id')
+            for entry in entries:
+                latest[entry.object_id].append(entry)
+        incomplete = [pk for pk in pks if len(latest[pk]) < limit]
+        if archived and incomplete:
+            for pk, entries in HistoryArchive.objects.get_entries(
+                content_type, incomplete, field_name, users=True,
+            ).iteritems():
+                latest[pk].extend(entries)
+        for obj in objs:
+            if not hasattr(obj, '_latest_history'):
+                obj._latest_history = {}
+            obj._latest_history[field_name, archived] = (
+                limit, latest[obj.pk][:limit],
+            )
+
+    def build_changes(self, obj, user, diff_data):
+        """Return unsaved history entries for *diff_data* of *obj*."""
+        if not obj:
+            return []
         content_type = ContentType.objects.get_for_model(obj.__class__)
         changed_items = []
 
@@ -71,11 +151,19 @@ class HistoryManager(models.Manager):
                     new_value=data['new'] if data['new'] else '-',
                 )
             )
-        self.model.objects.bulk_create(changed_items)
+        return changed_items
+
+    def log_changes(self, obj, user, diff_data):
+        if not obj:
+            return
+        from ralph_assets.history.utils import context
+        context.write(self.build_changes(obj, user, diff_data))
 
 
 class History(models.Model):
-    date = models.DateTimeField(verbose_name=_('date'), default=datetime.now)
+    date = models.DateTimeField(
+        verbose_name=_('date'), default=datetime.now, db_index=True,
+    )
     user = models.ForeignKey(
         'auth.User', verbose_name=_('user'), null=True,
         blank=True, default=None, on_delete=models.SET_NULL
@@ -93,6 +181,8 @@ class History(models.Model):
         verbose_name = _('history change')
         verbose_name_plural = _('history changes')
         ordering = ('-date',)
+        # composite indexes on (content_type, object_id[, field_name], date)
+        # are created by migration 0026
 
     def __unicode__(self):
         return 'in {} (id: {}) change {}: {} -> {}'.format(
@@ -112,41 +202,256 @@ class History(models.Model):
         })
 
 
-class HistoryMixin(object):
-    """Django's raw m2m_change signal sucks when working with forms."""
-
-    def __init__(self, *args, **kwargs):
-        super(HistoryMixin, self).__init__(*args, **kwargs)
-        from ralph_assets.history import registry, register
-        if not registry.get(self.__class__, None):
-            exclude = getattr(
-                self,
-                'exclude_fields_from_history',
-                DEFAULT_HISTORY_FIELD_EXCLUDE
+class HistoryArchiveManager(models.Manager):
+    def archive(self, entries):
+        """Store *entries* (``values()`` of history entries, with ``pk``,
+        ``content_type``, ``object_id`` and ``ARCHIVED_FIELDS``) in the
+        archive, one archive row per object. Entries aren't deleted."""
+        by_object = defaultdict(list)
+        for entry in entries:
+            by_object[entry['content_type'], entry['object_id']].append(entry)
+        self.bulk_create([
+            self.model(
+                content_type_id=content_type_id,
+                object_id=object_id,
+                date_from=min(entry['date'] for entry in object_entries),
+                date_to=max(entry['date'] for entry in object_entries),
+                entries=self.model.compress(object_entries),
             )
-            register(self.__class__, exclude=exclude)
-            for field in self._meta.get_all_related_many_to_many_objects():
-                register(field.field.rel.through, m2m=True)
+            for (content_type_id, object_id), object_entries
+            in by_object.iteritems()
+        ])
+
+    def get_entries(self, content_type, object_ids, field_name=None,
+                    since=None, users=False):
+        """Return archived history entries of objects with *object_ids*
+        (newest first, only made after *since* if given), keyed by object
+        id. Users of entries are loaded in one query if *users* is set."""
+        entries = defaultdict(list)
+        archives = self.filter(
+            content_type=content_type, object_id__in=object_ids,
+        )
+        if since is not None:
+            archives = archives.filter(date_to__gt=since)
+        for archive in archives:
+            entries[archive.object_id].extend(
+                entry for entry in archive.get_entries()
+                if (not field_name or entry.field_name == field_name) and
+                (since is None or entry.date > since)
+            )
+        for object_entries in entries.itervalues():
+            object_entries.sort(key=lambda entry: entry.date, reverse=True)
+        if users:
+            self.load_users(itertools.chain.from_iterable(entries.values()))
+        return entries
+
+    def load_users(self, entries):
+        entries = [entry for entry in entries if entry.user_id is not None]
+        user_field = History._meta.get_field('user')
+        by_pk = user_field.rel.to._default_manager.in_bulk(
+            set(entry.user_id for entry in entries)
+        )
+        for entry in entries:
+            setattr(entry, user_field.get_cache_name(), by_pk.get(
+                entry.user_id,
+            ))
+
+
+class HistoryArchive(models.Model):
+    """History entries of one object moved out of :class:`History` by the
+    ``archive_history`` command, stored as compressed JSON."""
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.PositiveIntegerField()
+    date_from = models.DateTimeField()
+    date_to = models.DateTimeField()
+    entries = models.TextField()
+    objects = HistoryArchiveManager()
+
+    class Meta:
+        app_label = 'ralph_assets'
+        verbose_name = _('archived history')
+        verbose_name_plural = _('archived history')
+
+    def __unicode__(self):
+        return 'in {} (id: {}) history from {} to {}'.format(
+            self.content_type,
+            self.object_id,
+            self.date_from,
+            self.date_to,
+        )
+
+    @staticmethod
+    def compress(entries):
+        data = json.dumps([
+            [
+                entry['date'].isoformat(),
+                entry['user'],
+                entry['field_name'],
+                entry['old_value'],
+                entry['new_value'],
+            ]
+            for entry in entries
+        ])
+        return base64.b64encode(zlib.compress(data.encode('utf-8'), 9))
 
-    def get_history(self, field_name=None):
+    def get_entries(self):
+        """Return archived entries as unsaved :class:`History` objects."""
+        data = zlib.decompress(base64.b64decode(self.entries))
+        return [
+            History(
+                content_type_id=self.content_type_id,
+                object_id=self.object_id,
+                date=parse_datetime(date),
+                user_id=user_id,
+                field_name=field_name,
+                old_value=old_value,
+                new_value=new_value,
+            )
+            for date, user_id, field_name, old_value, new_value
+            in json.loads(data.decode('utf-8'))
+        ]
+
+
+class HistorySnapshot(models.Model):
+    """Full state of an object at a date (see
+    :mod:`ralph_assets.history.state`), so reconstructing older states
+    doesn't walk the whole history."""
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.PositiveIntegerField()
+    date = models.DateTimeField(default=datetime.now)
+    state = models.TextField()
+
+    class Meta:
+        app_label = 'ralph_assets'
+        verbose_name = _('history snapshot')
+        verbose_name_plural = _('history snapshots')
+        # index on (content_type, object_id, date) is created by migration
+        # 0027
+
+    def __unicode__(self):
+        return 'in {} (id: {}) snapshot at {}'.format(
+            self.content_type,
+            self.object_id,
+            self.date,
+        )
+
+    def get_state(self):
+        return json.loads(self.state)
+
+
+class HistoryWithArchive(object):
+    """History of one object: entries from :class:`History` followed by
+    the archived ones.
+
+    Supports what paginators and templates need - ``count()``, ``len()``,
+    iteration, indexing and slicing. The archive is read only when entries
+    past the live history are needed.
+    """
+
+    def __init__(self, queryset, content_type, object_id, field_name=None):
+        self.queryset = queryset
+        self.content_type = content_type
+        self.object_id = object_id
+        self.field_name = field_name
+        self._live_count = None
+        self._archived = None
+
+    @property
+    def live_count(self):
+        if self._live_count is None:
+            self._live_count = self.queryset.count()
+        return self._live_count
+
+    @property
+    def archived(self):
+        if self._archived is None:
+            self._archived = HistoryArchive.objects.get_entries(
+                self.content_type, [self.object_id], self.field_name,
+                users=True,
+            ).get(self.object_id, [])
+        return self._archived
+
+    def count(self):
+        return self.live_count + len(self.archived)
+
+    def __len__(self):
+        return self.count()
+
+    def __nonzero__(self):
+        return self.queryset.exists() or bool(self.archived)
+
+    def __iter__(self):
+        return itertools.chain(self.queryset, self.archived)
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            try:
+                return self[key:key + 1][0]
+            except IndexError:
+                raise IndexError('History index out of range.')
+        start, stop = key.start or 0, key.stop
+        if start < 0 or (stop is not None and stop < 0) or key.step:
+            raise ValueError('Only positive slices are supported.')
+        entries = list(self.queryset[start:stop])
+        if stop is None or len(entries) < stop - start:
+            entries.extend(self.archived[
+                max(start - self.live_count, 0):
+                None if stop is None else stop - self.live_count
+            ])
+        return entries
+
+
+class HistoryMixin(object):
+    """Django's raw m2m_change signal sucks when working with forms.
+
+    Models with this mixin are registered to history when their classes are
+    created (see ``ralph_assets.history.register_history_model``).
+    """
+
+    def get_history(self, field_name=None, archived=False):
         return History.objects.get_history_for_this_object(
             obj=self,
             field_name=field_name,
+            archived=archived,
         )
 
-    def get_snapshot(self, obj, manager, field_name):
-        """Method returns snapshot from current state of object."""
-        snapshot = serializer.serialize(manager.all(), fields=())
-        try:
-            history = obj.get_history(field_name=field_name)[0]
-        except (IndexError, AttributeError):
-            history = None
-        previous = getattr(history, 'new_value', None)
-        previous = previous and json.loads(previous) or []
-        current = [s['pk'] for s in snapshot]
+    def get_latest_history(self, limit=5, field_name=None, archived=False):
+        """Return up to *limit* latest history entries (archived ones too
+        with *archived*), using those loaded by
+        :meth:`HistoryManager.prefetch_latest` if there are enough of them.
+        Otherwise they are selected by one plain query."""
+        latest = getattr(self, '_latest_history', {}).get(
+            (field_name, archived),
+        )
+        if latest is not None and latest[0] >= limit:
+            return latest[1][:limit]
+        history = list(
+            self.get_history(field_name=field_name).select_related(
+                'user',
+            ).order_by('-date', '-id')[:limit]
+        )
+        if archived and len(history) < limit:
+            history.extend(HistoryArchive.objects.get_entries(
+                ContentType.objects.get_for_model(self.__class__),
+                [self.pk], field_name, users=True,
+            ).get(self.pk, []))
+        return history[:limit]
+
+    def get_snapshot(self, obj, manager, field_name, current=None):
+        """Method returns snapshot from current state of object.
+
+        The previous state is the last known set of pks of the field, cached
+        by the history context, so only the first change of the field in
+        a request reads it from the history.
+        """
+        from ralph_assets.history.utils import context
+        if current is None:
+            current = list(manager.values_list('pk', flat=True))
+        previous = context.get_m2m_state(obj, field_name)
+        context.set_m2m_state(obj, field_name, current)
         deleted = set(previous) - set(current)
         added = set(current) - set(previous)
-        changed = not set(current) == set(previous)
+        changed = bool(deleted or added)
         return Snapshot(
             current, previous, added, deleted, changed, obj, field_name
         )
@@ -164,9 +469,23 @@ class HistoryMixin(object):
             )
 
     def _save_related_objects_history(self, manager, related_pks, field_name):
-        for obj in manager.filter(pk__in=related_pks):
-            manager = getattr(obj, field_name)
-            snapshot = self.get_snapshot(obj, manager, field_name)
+        from ralph_assets.history.utils import context
+        related = list(manager.filter(pk__in=related_pks))
+        if not related:
+            return
+        field = related[0]._meta.get_field(field_name)
+        source = field.m2m_field_name()
+        target = field.m2m_reverse_field_name()
+        current = defaultdict(list)
+        for source_id, target_id in field.rel.through._default_manager.filter(
+            **{source + '__in': [obj.pk for obj in related]}
+        ).values_list(source, target):
+            current[source_id].append(target_id)
+        context.load_m2m_states(related, field_name)
+        for obj in related:
+            snapshot = self.get_snapshot(
+                obj, None, field_name, current=current[obj.pk],
+            )
             self.save_history_from_snapshot(snapshot)
 
     def save_reverse_relation_history(self):
@@ -13,10 +13,20 @@ def pre_save(sender, instance, **kwargs):
 
 
 def post_save(sender, instance, **kwargs):
-    context.end()
+    context.end(instance)
+
+
+def reset_context(sender, **kwargs):
+    """Forget saves which never finished (e.g. failed ones) in this thread."""
+    context.reset()
 
 
 def m2m_changed(sender, instance, action, reverse, **kwargs):
+    from ralph_assets import history
+    if not history.m2m_registry_loaded:
+        history.load_m2m_registry()
+    if sender not in history.registry_m2m:
+        return
     if action in ('pre_clear',) and reverse:
         instance.save_reverse_relation_history()
     if action in ('post_add',) and not reverse:
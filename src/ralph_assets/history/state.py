@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""Reconstruction of states of objects from their history.
+
+State of an object is a dict of its history fields (with many-to-many ones)
+holding values in the format of the history: labels of related objects and
+choices, ``'-'`` for empty values. State as of a date is computed from the
+nearest later :class:`HistorySnapshot` (or the current state), by applying
+old values of history entries made after that date, newest first. Fields
+which aren't stored on the object (e.g. ``assigned_licence_quantity``) are in
+the state only when they changed after that date.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import json
+from collections import defaultdict
+
+from django.contrib.contenttypes.models import ContentType
+from django.db.models.fields.related import RelatedField
+
+from ralph_assets.history.models import (
+    History,
+    HistoryArchive,
+    HistorySnapshot,
+)
+from ralph_assets.history.utils import context, get_choices
+
+
+# number of objects handled by one query
+CHUNK_SIZE = 500
+
+
+def _chunks(items):
+    for start in xrange(0, len(items), CHUNK_SIZE):
+        yield items[start:start + CHUNK_SIZE]
+
+
+def to_history_value(value):
+    return unicode(value) if value else '-'
+
+
+def get_current_states(objs):
+    """Return current states of *objs* (of one model), keyed by pk."""
+    objs = list(objs)
+    if not objs:
+        return {}
+    model = objs[0].__class__
+    fields = context.get_history_fields(model).values()
+    for field in fields:
+        if isinstance(field, RelatedField):
+            context.load_related_labels(
+                field, [getattr(obj, field.attname) for obj in objs],
+            )
+    states = {}
+    for obj in objs:
+        state = states[obj.pk] = {}
+        for field in fields:
+            value = getattr(obj, field.attname)
+            if isinstance(field, RelatedField):
+                value = context.get_related_label(obj, field, value)
+            elif field.choices:
+                value = get_choices(obj, field.name, value)
+            state[field.name] = to_history_value(value)
+    for field, _ in model._meta.get_m2m_with_model():
+        source = field.m2m_field_name()
+        target = field.m2m_reverse_field_name()
+        related = defaultdict(list)
+        for chunk in _chunks(states.keys()):
+            for source_id, target_id in (
+                field.rel.through._default_manager.filter(
+                    **{source + '__in': chunk}
+                ).values_list(source, target)
+            ):
+                related[source_id].append(target_id)
+        for pk, state in states.iteritems():
+            state[field.name] = json.dumps(related[pk])
+    return states
+
+
+def get_snapshots(content_type, pks, date):
+    """Return the earliest snapshots taken at *date* or later, keyed by
+    object id."""
+    ids = {}
+    for chunk in _chunks(pks):
+        for object_id, snapshot_id in HistorySnapshot.objects.filter(
+            content_type=content_type, object_id__in=chunk, date__gte=date,
+        ).order_by('object_id', 'date').values_list('object_id', 'id'):
+            ids.setdefault(object_id, snapshot_id)
+    snapshots = {}
+    id_list = ids.values()
+    for chunk in _chunks(id_list):
+        for snapshot in HistorySnapshot.objects.filter(pk__in=chunk):
+            snapshots[snapshot.object_id] = snapshot
+    return snapshots
+
+
+def get_changes(content_type, pks, since, until=None):
+    """Return ``(date, field name, old value)`` of history entries of objects
+    made after *since* (and not after *until*), newest first, keyed by object
+    id. Archived entries are included."""
+    changes = defaultdict(list)
+    for chunk in _chunks(pks):
+        entries = History.objects.filter(
+            content_type=content_type, object_id__in=chunk, date__gt=since,
+        )
+        if until is not None:
+            entries = entries.filter(date__lte=until)
+        for object_id, date, field_name, old_value in entries.values_list(
+            'object_id', 'date', 'field_name', 'old_value',
+        ):
+            changes[object_id].append((date, field_name, old_value))
+        archived = HistoryArchive.objects.get_entries(
+            content_type, chunk, since=since,
+        )
+        for object_id, object_entries in archived.iteritems():
+            changes[object_id].extend(
+                (entry.date, entry.field_name, entry.old_value)
+                for entry in object_entries
+                if until is None or entry.date <= until
+            )
+    for object_changes in changes.itervalues():
+        object_changes.sort(key=lambda change: change[0], reverse=True)
+    return changes
+
+
+def get_states_at(objs, date):
+    """Return states of *objs* (of one model) as of *date*, keyed by pk."""
+    objs = list(objs)
+    if not objs:
+        return {}
+    content_type = ContentType.objects.get_for_model(objs[0].__class__)
+    snapshots = get_snapshots(content_type, [obj.pk for obj in objs], date)
+    states = get_current_states(
+        [obj for obj in objs if obj.pk not in snapshots]
+    )
+    # snapshots are taken for many objects at once, so objects are grouped
+    # by the date their state comes from
+    by_until = defaultdict(list)
+    for obj in objs:
+        snapshot = snapshots.get(obj.pk)
+        if snapshot:
+            states[obj.pk] = snapshot.get_state()
+            by_until[snapshot.date].append(obj.pk)
+        else:
+            by_until[None].append(obj.pk)
+    for until, pks in by_until.iteritems():
+        changes = get_changes(content_type, pks, date, until)
+        for pk in pks:
+            state = states[pk]
+            for _, field_name, old_value in changes.get(pk, []):
+                state[field_name] = old_value
+    return states
+
+
+def get_state_at(obj, date):
+    """Return state of *obj* as of *date*."""
+    return get_states_at([obj], date)[obj.pk]
+
+
+def take_snapshots(objs, date=None):
+    """Store current states of *objs* (of one model) as snapshots."""
+    objs = list(objs)
+    if not objs:
+        return
+    content_type = ContentType.objects.get_for_model(objs[0].__class__)
+    extra = {'date': date} if date else {}
+    HistorySnapshot.objects.bulk_create([
+        HistorySnapshot(
+            content_type=content_type,
+            object_id=pk,
+            state=json.dumps(state),
+            **extra
+        )
+        for pk, state in get_current_states(objs).iteritems()
+    ])
@@ -7,7 +7,10 @@ from __future__ import unicode_literals
 
 from django.conf.urls import patterns, url
 
-from ralph_assets.history.views import HistoryListForModel
+from ralph_assets.history.views import (
+    HistoryListForModel,
+    HistoryStateForModel,
+)
 
 
 urlpatterns = patterns(
@@ -17,4 +20,9 @@ urlpatterns = patterns(
         HistoryListForModel.as_view(),
         name='history_for_model',
     ),
+    url(
+        (r'^(?P<content_type>[-\d]+)/(?P<object_id>[-\d]+)/state/$'),
+        HistoryStateForModel.as_view(),
+        name='history_state_for_model',
+    ),
 )
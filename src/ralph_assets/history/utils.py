@@ -5,11 +5,29 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import json
+import sys
+import threading
+from functools import wraps
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
 from django.core import serializers
+from django.db import transaction
 from django.db.models.fields import FieldDoesNotExist
 from django.db.models.fields.related import RelatedField
 
-from ralph_assets.history.models import History
+from ralph_assets.choices_cache import get_choices_lookup
+from ralph_assets.history.models import History, HistoryArchive
+
+
+# labels of related objects and last known m2m sets kept per thread by the
+# history context
+LABELS_CACHE_SIZE = 10000
+M2M_STATES_CACHE_SIZE = 10000
+HISTORY_CHUNK_SIZE = 1000
+# name of the rq queue writing deferred history (None - write it in place)
+HISTORY_QUEUE = getattr(settings, 'ASSETS_HISTORY_QUEUE', None)
 
 
 def field_changes(instance, ignore=('id', 'ralph_device_id')):
@@ -61,10 +79,7 @@ def get_choices(instance, field, id):
         id = int(id)
     except (TypeError, ValueError):
         return id
-    choices = instance._meta.get_field_by_name(field)[0].get_choices()
-    for choice_id, value in choices:
-        if choice_id == id:
-            return value
+    return get_choices_lookup(instance.__class__, field).labels.get(id)
 
 
 class DictDiffer(object):
@@ -82,11 +97,129 @@ class DictDiffer(object):
         )
 
 
-class HistoryContext(object):
+def get_diff_data(pre_obj, obj, past_snapshot, current_snapshot):
+    """Return the list of changes between two field snapshots of an object,
+    ready to be passed to ``History.objects.log_changes``.
+
+    *pre_obj* (the object before changes) is optional, it's only used to
+    take labels of related objects it has already loaded.
+    """
+    fields_diff = DictDiffer(current_snapshot, past_snapshot).changed()
+    diff_data = []
+    for field in fields_diff:
+        old_value = past_snapshot[field]
+        new_value = current_snapshot[field]
+        new_field = obj._meta.get_field_by_name(field)[0]
+        if isinstance(new_field, RelatedField):
+            old_value = context.get_related_label(
+                pre_obj, new_field, old_value,
+            )
+            new_value = context.get_related_label(obj, new_field, new_value)
+        elif new_field.choices:
+            if int(old_value) == int(new_value):
+                continue
+            old_value = get_choices(obj, field, old_value)
+            new_value = get_choices(obj, field, new_value)
+        elif (
+            pre_obj is not None and
+            hasattr(obj, 'get_{}_display'.format(field))
+        ):
+            old_value = getattr(pre_obj, 'get_{}_display'.format(field))()
+            new_value = getattr(obj, 'get_{}_display'.format(field))()
+
+        if old_value != new_value:
+            diff_data.append(
+                {
+                    'field': field,
+                    'old': old_value,
+                    'new': new_value,
+                }
+            )
+    return diff_data
+
+
+class HistoryFrame(object):
+    """State of a single save observed by the history: the object and its
+    snapshot taken before saving.
+
+    Objects loaded from the database which track their initial values
+    (``dirty_fields`` of ``TimeTrackable``) are diffed against the state they
+    were loaded with, so no query is needed before saving. Other objects are
+    re-selected from the database.
+    """
+
+    def __init__(self, context, sender, obj):
+        self.context = context
+        self.sender = sender
+        self.obj = obj
+        self.model = obj.__class__
+        self.pre_obj = None
+        self.past_snapshot = None
+        self.use_dirty_fields = False
+
+    def pre_save(self):
+        if not self.obj._state.adding and hasattr(self.obj, 'dirty_fields'):
+            self.use_dirty_fields = True
+            return
+        if self.obj.pk is None:
+            return
+        try:
+            self.pre_obj = self.model._default_manager.get(pk=self.obj.pk)
+        except self.model.DoesNotExist:
+            return
+        self.past_snapshot = self.context.get_fields_snapshot(
+            [self.pre_obj]
+        )[0]['fields']
+
+    def get_dirty_snapshots(self):
+        """Return snapshots of changed history fields: values the object was
+        loaded with and the current ones."""
+        fields = self.context.get_history_fields(self.model)
+        past_snapshot, current_snapshot = {}, {}
+        for attname, old_value in self.obj.dirty_fields.iteritems():
+            field = fields.get(attname)
+            if field is None:
+                continue
+            past_snapshot[field.name] = old_value
+            current_snapshot[field.name] = getattr(self.obj, attname)
+        return past_snapshot, current_snapshot
+
+    def post_save(self):
+        if self.use_dirty_fields:
+            past_snapshot, current_snapshot = self.get_dirty_snapshots()
+        elif self.pre_obj:
+            past_snapshot = self.past_snapshot
+            current_snapshot = self.context.get_fields_snapshot(
+                [self.obj]
+            )[0]['fields']
+        else:
+            return
+        diff_data = get_diff_data(
+            self.pre_obj, self.obj, past_snapshot, current_snapshot,
+        )
+        if diff_data:
+            History.objects.log_changes(
+                self.obj, self.obj.saving_user, diff_data,
+            )
+
+
+class HistoryContext(threading.local):
+    """Per-thread stack of saves in progress.
+
+    Every ``pre_save`` pushes a frame and the matching ``post_save`` pops it,
+    so a save nested in another one (e.g. ``DeviceInfo`` saved inside
+    ``Asset.save``) and saves running in other threads diff against their own
+    snapshots.
+    """
 
     def __init__(self):
         self.serializer = serializers.get_serializer("python")()
-        self.obj = None
+        self.frames = []
+        self.fields = {}
+        self.labels = {}
+        self.m2m_states = {}
+        self.pending = None
+        self.scopes = 0
 
     def get_fields_snapshot(self, objs):
         if not objs:
@@ -102,67 +235,253 @@ class HistoryContext(object):
         from ralph_assets.history import registry
         return registry
 
-    def pre_save(self):
-        self.pre_obj = None
+    def get_history_fields(self, model):
+        """Return history fields of *model* keyed by their attribute names."""
         try:
-            self.pre_obj = self.model._default_manager.get(pk=self.obj.pk)
-        except self.model.DoesNotExist:
+            return self.fields[model]
+        except KeyError:
+            pass
+        names = self.registry.get(model, ())
+        fields = self.fields[model] = dict(
+            (field.attname, field) for field in model._meta.fields
+            if field.name in names
+        )
+        return fields
+
+    def load_related_labels(self, field, values):
+        """Cache labels of objects related by *field* with *values*, which
+        aren't cached yet, in one query."""
+        model = field.rel.to
+        to_field = field.rel.field_name
+        missing = set(
+            value for value in values
+            if value is not None and (model, value) not in self.labels
+        )
+        if not missing:
             return
-        self.past_snapshot = self.get_fields_snapshot(
-            [self.pre_obj]
-        )[0]['fields']
+        if len(self.labels) + len(missing) > LABELS_CACHE_SIZE:
+            self.labels = {}
+        for related in model._base_manager.filter(
+            **{to_field + '__in': missing}
+        ):
+            self.labels[model, getattr(related, to_field)] = unicode(related)
 
-    def post_save(self):
-        if not self.pre_obj:
+    def get_related_label(self, instance, field, value):
+        """Return label of the object related by *field* with *value*.
+
+        The object already loaded on *instance* is used if it matches,
+        otherwise the label is fetched once and cached until the end of
+        the request.
+        """
+        if value is None:
+            return 'None'
+        model = field.rel.to
+        to_field = field.rel.field_name
+        key = (model, value)
+        related = None
+        if instance is not None:
+            related = getattr(instance, field.get_cache_name(), None)
+        if related is not None and getattr(related, to_field) == value:
+            self.labels[key] = unicode(related)
+        elif key not in self.labels:
+            if len(self.labels) >= LABELS_CACHE_SIZE:
+                self.labels = {}
+            try:
+                related = model._base_manager.get(**{to_field: value})
+            except model.DoesNotExist:
+                self.labels[key] = 'None'
+            else:
+                self.labels[key] = unicode(related)
+        return self.labels[key]
+
+    def load_m2m_states(self, objs, field_name):
+        """Cache the last known sets of pks of m2m *field_name* of *objs*
+        (taken from their latest, possibly archived, history), for objects
+        not cached yet."""
+        missing = dict(
+            (obj.pk, obj) for obj in objs
+            if (obj.__class__, obj.pk, field_name) not in self.m2m_states
+        )
+        if not missing:
             return
-        current_snapshot = self.get_fields_snapshot([self.obj])[0]['fields']
-
-        fields_diff = DictDiffer(
-            current_snapshot, self.past_snapshot
-        ).changed()
-
-        diff_data = []
-        for field in fields_diff:
-            old_value = self.past_snapshot[field]
-            new_value = current_snapshot[field]
-            old_field = self.pre_obj._meta.get_field_by_name(field)[0]
-            new_field = self.obj._meta.get_field_by_name(field)[0]
-            if isinstance(new_field, RelatedField):
-                old_value = str(getattr(self.pre_obj, field))
-                new_value = str(getattr(self.obj, field))
-            elif hasattr(old_field, 'choices') and old_field.choices:
-                if int(old_value) == int(new_value):
-                    continue
-                old_value = get_choices(self.pre_obj, field, old_value)
-                new_value = get_choices(self.obj, field, new_value)
-            elif hasattr(self.obj, 'get_{}_display'.format(field)):
-                old_value = getattr(
-                    self.pre_obj, 'get_{}_display'.format(field)
-                )()
-                new_value = getattr(
-                    self.obj, 'get_{}_display'.format(field)
-                )()
-
-            if old_value != new_value:
-                diff_data.append(
-                    {
-                        'field': field,
-                        'old': old_value,
-                        'new': new_value,
-                    }
-                )
-        History.objects.log_changes(self.obj, self.obj.saving_user, diff_data)
-
-    def start(self, sender, obj, m2m=False, pk_set=set(), reverse=False):
-        self.obj = obj
-        self.model = self.obj.__class__
-        self.sender = sender
-        self.pre_save()
+        if len(self.m2m_states) + len(missing) > M2M_STATES_CACHE_SIZE:
+            self.m2m_states = {}
+        model = objs[0].__class__
+        content_type = ContentType.objects.get_for_model(model)
+        states = dict((pk, []) for pk in missing)
+        found = set()
+        entries = History.objects.filter(
+            content_type=content_type,
+            object_id__in=missing.keys(),
+            field_name=field_name,
+        ).order_by('object_id', '-date').values_list('object_id', 'new_value')
+        for object_id, new_value in entries:
+            if object_id in found:
+                continue
+            found.add(object_id)
+            states[object_id] = new_value and json.loads(new_value) or []
+        not_found = set(missing) - found
+        if not_found:
+            archived = HistoryArchive.objects.get_entries(
+                content_type, not_found, field_name,
+            )
+            for object_id, object_entries in archived.iteritems():
+                new_value = object_entries[0].new_value
+                states[object_id] = new_value and json.loads(new_value) or []
+        for pk, state in states.iteritems():
+            self.m2m_states[(model, pk, field_name)] = state
+
+    def get_m2m_state(self, obj, field_name):
+        """Return the last known set of pks of m2m *field_name* of *obj*."""
+        self.load_m2m_states([obj], field_name)
+        return self.m2m_states[(obj.__class__, obj.pk, field_name)]
+
+    def set_m2m_state(self, obj, field_name, pks):
+        self.m2m_states[(obj.__class__, obj.pk, field_name)] = pks
+
+    def write(self, entries):
+        """Write history *entries*, or buffer them inside
+        :func:`deferred_history`."""
+        if self.pending is not None:
+            self.pending.extend(entries)
+        elif entries:
+            write_history(entries)
+
+    def start(self, sender, obj):
+        frame = HistoryFrame(self, sender, obj)
+        self.frames.append(frame)
+        frame.pre_save()
+
+    def end(self, obj):
+        # frames above the matching one belong to saves which failed before
+        # sending post_save - drop them too
+        for index in xrange(len(self.frames) - 1, -1, -1):
+            if self.frames[index].obj is obj:
+                frame = self.frames[index]
+                del self.frames[index:]
+                frame.post_save()
+                return
+
+    def reset(self):
+        self.frames = []
+        self.labels = {}
+        self.m2m_states = {}
+        self.pending = None
 
-    def end(self):
-        self.post_save()
-        self.obj = None
-        self.sender = None
-        self.reverse = False
 
 context = HistoryContext()
+
+
+def write_history(entries):
+    """Insert history *entries* in chunks."""
+    for start in xrange(0, len(entries), HISTORY_CHUNK_SIZE):
+        History.objects.bulk_create(entries[start:start + HISTORY_CHUNK_SIZE])
+
+
+def enqueue_history(entries):
+    """Hand history *entries* of committed changes to the rq queue."""
+    if entries:
+        import django_rq
+        django_rq.get_queue(HISTORY_QUEUE).enqueue(write_history_job, entries)
+
+
+class DeferredHistory(object):
+    """See :func:`deferred_history`."""
+
+    def __enter__(self):
+        self.outermost = context.pending is None
+        self.transaction = None
+        if self.outermost:
+            if not transaction.is_managed():
+                self.transaction = transaction.commit_on_success()
+                self.transaction.__enter__()
+            context.pending = []
+        self.start = len(context.pending)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            if self.outermost:
+                context.pending = None
+            else:
+                del context.pending[self.start:]
+            # m2m sets recorded in the block were never written
+            context.m2m_states = {}
+            if self.transaction:
+                self.transaction.__exit__(exc_type, exc_value, traceback)
+            return False
+        if not self.outermost:
+            return False
+        entries, context.pending = context.pending, None
+        queued = bool(HISTORY_QUEUE) and self.transaction is not None
+        if not queued:
+            try:
+                write_history(entries)
+            except Exception:
+                if self.transaction:
+                    self.transaction.__exit__(*sys.exc_info())
+                raise
+        if self.transaction:
+            self.transaction.__exit__(None, None, None)
+        if queued:
+            # the changes are committed now
+            enqueue_history(entries)
+        return False
+
+    def __call__(self, func):
+        @wraps(func)
+        def inner(*args, **kwargs):
+            with DeferredHistory():
+                return func(*args, **kwargs)
+        return inner
+
+
+def deferred_history():
+    """Run the block (or the decorated function) in a transaction, buffer
+    history written in it and write it in chunked bulk inserts when the
+    outermost block ends.
+
+    Like ``nested_commit_on_success``, the outermost block commits its own
+    transaction on success and rolls it back on errors, unless it joins a
+    transaction managed by the caller. History is inserted in the same
+    transaction as the changes, so it commits or rolls back with them, and
+    entries of a block which raised are dropped. When ``ASSETS_HISTORY_QUEUE``
+    is set, history of a block owning its transaction is handed to that rq
+    queue once the transaction commits.
+    """
+    return DeferredHistory()
+
+
+def write_history_job(entries):
+    """rq job writing deferred history *entries*."""
+    with history_scope():
+        write_history(entries)
+
+
+class HistoryScope(object):
+    """See :func:`history_scope`."""
+
+    def __enter__(self):
+        if not context.scopes:
+            context.reset()
+        context.scopes += 1
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        context.scopes -= 1
+        if not context.scopes:
+            context.reset()
+        return False
+
+    def __call__(self, func):
+        @wraps(func)
+        def inner(*args, **kwargs):
+            with HistoryScope():
+                return func(*args, **kwargs)
+        return inner
+
+
+def history_scope():
+    """Start the block (or the decorated function) and end it with an empty
+    history context, so labels and m2m sets cached by a management command or
+    an rq job don't outlive it in a long-running worker. Requests are reset
+    by ``request_finished`` instead."""
+    return HistoryScope()
@@ -5,10 +5,19 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import datetime
+
 from django.db.models.fields import FieldDoesNotExist
+from django.utils.dateparse import parse_date, parse_datetime
 
 from ralph_assets.history.models import History
-from ralph_assets.views.base import AssetsBase, ContentTypeMixin, PaginateMixin
+from ralph_assets.history.state import get_state_at
+from ralph_assets.views.base import (
+    AssetsBase,
+    ContentTypeMixin,
+    JsonResponseMixin,
+    PaginateMixin,
+)
 from ralph_assets.models_assets import ASSET_TYPE2MODE
 
 
@@ -25,7 +34,7 @@ class HistoryBase(AssetsBase):
 
     def get_context_data(self, **kwargs):
         context = super(HistoryBase, self).get_context_data(**kwargs)
-        obj = self.content_type.get_object_for_this_type(id=self.object_id)
+        obj = self.get_content_object()
         mode = getattr(obj, 'type', None)
         if mode:
             sidebars = context['active_menu'].get_sidebar_items()
@@ -48,18 +57,20 @@ class HistoryListForModel(PaginateMixin, ContentTypeMixin, HistoryBase):
         )
 
     def get_paginate_queryset(self):
-        history = History.objects.get_history_for_this_content_type(
-            content_type=self.content_type,
-            object_id=self.object_id,
-        )
         self.show_status_button = True
         try:
             self.model._meta.get_field_by_name('status')
         except FieldDoesNotExist:
             self.show_status_button = False
+        kwargs = {}
         if self.status and self.show_status_button:
-            history = history.filter(field_name__exact='status')
-        return history
+            kwargs['field_name'] = 'status'
+        return History.objects.get_history_for_this_content_type(
+            content_type=self.content_type,
+            object_id=self.object_id,
+            archived=True,
+            **kwargs
+        )
 
     def get_context_data(self, **kwargs):
         context = super(HistoryListForModel, self).get_context_data(**kwargs)
@@ -68,3 +79,57 @@ class HistoryListForModel(PaginateMixin, ContentTypeMixin, HistoryBase):
             'show_status_button': self.show_status_button,
         })
         return context
+
+
+class HistoryStateForModel(JsonResponseMixin, ContentTypeMixin, HistoryBase):
+    """View for state of object as of the date given in ``date`` parameter,
+    reconstructed from its history. Returns JSON for ``format=json``."""
+    template_name = 'assets/history/state_for_model.html'
+
+    def dispatch(self, request, *args, **kwargs):
+        self.date_error = False
+        self.date = self.parse_date(request.GET.get('date', ''))
+        if self.date is None:
+            self.date_error = bool(request.GET.get('date'))
+            self.date = datetime.datetime.now()
+        return super(HistoryStateForModel, self).dispatch(
+            request, *args, **kwargs
+        )
+
+    @staticmethod
+    def parse_date(value):
+        """Parse date or date with time; date means the end of that day."""
+        value = value.strip()
+        try:
+            date = parse_datetime(value)
+            if date is None:
+                date = parse_date(value)
+                if date is not None:
+                    date = datetime.datetime.combine(date, datetime.time.max)
+        except ValueError:
+            date = None
+        return date
+
+    def get_state(self):
+        return get_state_at(self.get_content_object(), self.date)
+
+    def get(self, request, *args, **kwargs):
+        if request.GET.get('format') == 'json':
+            if self.date_error:
+                return self.render_json_response(
+                    {'error': 'Invalid date.'}, status=400,
+                )
+            return self.render_json_response({
+                'date': self.date.isoformat(),
+                'state': self.get_state(),
+            })
+        return super(HistoryStateForModel, self).get(request, *args, **kwargs)
+
+    def get_context_data(self, **kwargs):
+        context = super(HistoryStateForModel, self).get_context_data(**kwargs)
+        context.update({
+            'date': self.date,
+            'date_error': self.date_error,
+            'state': sorted(self.get_state().iteritems()),
+        })
+        return context
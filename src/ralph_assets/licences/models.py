@@ -6,12 +6,20 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import hashlib
+import time
+from collections import defaultdict
+
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
-from django.db import models
-from django.db.models import Sum
+from django.db import connection, models, router
+from django.db.models import F
 from django.db.models.loading import get_model
-from django.utils.functional import cached_property
+from django.db.models.sql import DeleteQuery
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from django.utils.translation import ugettext_lazy as _
 from lck.django.common.models import (
     Named,
@@ -34,18 +42,60 @@ from ralph_assets.models_assets import (
     CreatableFromString,
     Service,
 )
+from ralph_assets.models_outbox import ChangeOperation, OutboxEntry
 from ralph_assets.models_util import (
     Regionalized,
     RegionalizedDBManager,
 )
 from ralph_assets.models_util import WithForm
-from ralph_assets.history.models import History, HistoryMixin
+from ralph_assets.history.models import (
+    DEFAULT_HISTORY_FIELD_EXCLUDE,
+    History,
+    HistoryMixin,
+)
+
+
+# number of assignments written or read by one query
+ASSIGN_CHUNK_SIZE = 500
+SUMMARY_CACHE_TIMEOUT = getattr(
+    settings, 'ASSETS_LICENCE_SUMMARY_CACHE_TIMEOUT', 300,
+)
+SUMMARY_VERSION_KEY = 'ralph_assets.licences.summary_version'
+SUMMARY_SQL = """
+    SELECT
+        SUM(licence.number_bought),
+        SUM(COALESCE((
+            SELECT SUM(quantity) FROM ralph_assets_licenceasset
+            WHERE licence_id = licence.id
+        ), 0)),
+        SUM(COALESCE((
+            SELECT SUM(quantity) FROM ralph_assets_licenceuser
+            WHERE licence_id = licence.id
+        ), 0))
+    FROM ralph_assets_licence licence
+    WHERE licence.id IN ({})
+"""
+# descendants of a licence have lft between lft and rght of the licence
+SUBTREE_USAGE_SQL = """
+    SELECT
+        licence.id, SUM(node.number_bought), SUM(node.used_quantity)
+    FROM ralph_assets_licence licence
+    JOIN ralph_assets_licence node ON
+        node.tree_id = licence.tree_id AND
+        node.lft BETWEEN licence.lft AND licence.rght
+    WHERE licence.id IN ({})
+    GROUP BY licence.id
+"""
 
 
 class WrongModelError(Exception):
     pass
 
 
+class NotEnoughLicencesError(Exception):
+    pass
+
+
 class LicenceType(Named, CreatableFromString):
     """The type of a licence"""
     class Meta:
@@ -64,6 +114,8 @@ class SoftwareCategory(Named, CreatableFromString):
 
     class Meta:
         app_label = 'ralph_assets'
+        # index on UPPER(name) for prefix lookups on PostgreSQL is created by
+        # migration 0032
 
     @classmethod
     def create_from_string(cls, asset_type, string_name):
@@ -141,6 +193,7 @@ class Licence(
     valid_thru = models.DateField(
         null=True,
         blank=True,
+        db_index=True,
         help_text="Leave blank if this licence is perpetual",
     )
     order_no = models.CharField(max_length=50, null=True, blank=True)
@@ -196,11 +249,18 @@ class Licence(
         null=True,
         on_delete=models.PROTECT,
     )
+    # sum of quantities assigned to assets and users, maintained by
+    # LicenceAsset and LicenceUser
+    used_quantity = models.PositiveIntegerField(default=0, editable=False)
 
-    _used = None
+    exclude_fields_from_history = DEFAULT_HISTORY_FIELD_EXCLUDE + (
+        'used_quantity',
+    )
 
     class Meta:
         app_label = 'ralph_assets'
+        # index on UPPER(niw) for prefix lookups on PostgreSQL is created by
+        # migration 0032
 
     def __unicode__(self):
         return "{} x {} - {}".format(
@@ -215,18 +275,44 @@ class Licence(
             'licence_id': self.id,
         })
 
-    @cached_property
+    @property
     def used(self):
-        assets_qs = self.assets.through.objects.filter(licence=self)
-        users_qs = self.users.through.objects.filter(licence=self)
-
-        def get_sum(qs):
-            return qs.aggregate(sum=Sum('quantity'))['sum'] or 0
-        return sum(map(get_sum, [assets_qs, users_qs]))
+        return self.used_quantity
 
-    @cached_property
+    @property
     def free(self):
-        return self.number_bought - self.used
+        return self.number_bought - self.used_quantity
+
+    @property
+    def subtree_usage(self):
+        """Bought, used and free quantities of the licence with all its
+        descendants (see :func:`get_subtree_usages`)."""
+        usage = getattr(self, '_subtree_usage', None)
+        if usage is not None:
+            return usage
+        if self.is_leaf_node():
+            return {
+                'bought': self.number_bought,
+                'used': self.used_quantity,
+                'free': self.free,
+            }
+        return get_cached(
+            'subtree.{}'.format(self.pk),
+            lambda: get_subtree_usages([self])[self.pk],
+        )
+
+    def save(self, *args, **kwargs):
+        if self.pk is not None and not kwargs.get('force_insert'):
+            # the counter is changed only by updates of assigned quantities,
+            # so the stored value is written back; the row stays locked until
+            # the end of the transaction, so it isn't changed in between
+            stored = Licence.admin_objects.select_for_update().filter(
+                pk=self.pk,
+            ).values_list('used_quantity', flat=True)
+            if stored:
+                self.used_quantity = stored[0]
+        super(Licence, self).save(*args, **kwargs)
+        invalidate_summaries()
 
     def get_model_from_obj(self, obj):
         name = obj._meta.object_name
@@ -247,12 +333,16 @@ class Licence(
             name.lower(): obj,
             'licence': self,
         }
-        assigned_licence, created = Model.objects.get_or_create(**kwargs)
+        assigned_licence, created = Model.objects.get_or_create(
+            defaults={'quantity': quantity}, **kwargs
+        )
         old_quantity = assigned_licence.quantity
-        assigned_licence.quantity = quantity
-        assigned_licence.save(update_fields=['quantity'])
-        if not created and old_quantity == quantity:
-            return
+        if not created:
+            if old_quantity == quantity:
+                return
+            assigned_licence.licence = self
+            assigned_licence.quantity = quantity
+            assigned_licence.save(update_fields=['quantity'])
         History.objects.log_changes(
             obj,
             getattr(obj, 'saving_user', None),
@@ -275,6 +365,7 @@ class Licence(
         try:
             assigned_licence = Model.objects.get(**kwargs)
             old_value = assigned_licence.quantity
+            assigned_licence.licence = self
             assigned_licence.delete()
         except Model.DoesNotExist:
             return
@@ -290,12 +381,217 @@ class Licence(
             ]
         )
 
+    def get_assignment_model(self, objs):
+        """Return the model assigning this licence to *objs* (all of one
+        model) and the name of its field pointing to them."""
+        if len(set(obj.__class__ for obj in objs)) > 1:
+            raise WrongModelError('Objects of many models are not allowed.')
+        Model, name = self.get_model_from_obj(objs[0])
+        return Model, name.lower()
+
+    def get_assignments(self, Model, field_name, ids):
+        """Return ``(assignment id, quantity)`` of this licence assigned to
+        objects with *ids*, keyed by object id. The rows are locked until the
+        end of the transaction, so quantities don't change before the used
+        quantity is updated by their difference."""
+        attname = '{}_id'.format(field_name)
+        assignments = {}
+        for start in xrange(0, len(ids), ASSIGN_CHUNK_SIZE):
+            rows = Model.objects.select_for_update().filter(
+                licence=self,
+                **{attname + '__in': ids[start:start + ASSIGN_CHUNK_SIZE]}
+            ).values_list('pk', attname, 'quantity')
+            for pk, obj_id, quantity in rows:
+                assignments[obj_id] = (pk, quantity)
+        return assignments
+
+    def assign_many(self, quantities, user=None, check_capacity=True):
+        """Assign quantities of this licence to many assets or users (of one
+        model) at once.
+
+        *quantities* maps objects to quantities. Existing assignments of the
+        objects are read at once and only differences are written in bulk:
+        new assignments are inserted and changed quantities updated. History
+        is logged in one batch. With *check_capacity*
+        :class:`NotEnoughLicencesError` is raised before any write, if more
+        licences would be used than were bought; the licence row is locked
+        until the end of the transaction, so concurrent assignments don't
+        exceed it together.
+        """
+        quantities = dict(quantities)
+        if not quantities:
+            return
+        if min(quantities.itervalues()) <= 0:
+            raise ValueError('Variable quantity must be greater than zero.')
+        Model, field_name = self.get_assignment_model(quantities.keys())
+        stored = None
+        if check_capacity:
+            # locked before the assignments, as updates of used quantities do
+            stored = Licence.admin_objects.select_for_update().get(pk=self.pk)
+            used = stored.used_quantity
+        assignments = self.get_assignments(
+            Model, field_name, [obj.pk for obj in quantities],
+        )
+        delta = sum(
+            quantity - assignments.get(obj.pk, (None, 0))[1]
+            for obj, quantity in quantities.iteritems()
+        )
+        if check_capacity and delta > 0:
+            if used + delta > self.number_bought:
+                raise NotEnoughLicencesError(
+                    '{} licences needed, {} free.'.format(
+                        delta, self.number_bought - used,
+                    )
+                )
+        new = []
+        changed = defaultdict(list)
+        diffs = []
+        for obj, quantity in quantities.iteritems():
+            old_quantity = assignments.get(obj.pk, (None, None))[1]
+            if old_quantity == quantity:
+                continue
+            if old_quantity is None:
+                new.append(Model(licence=self, quantity=quantity, **{
+                    field_name: obj,
+                }))
+            else:
+                changed[quantity].append(obj.pk)
+            diffs.append((obj, old_quantity or '-', quantity))
+        for start in xrange(0, len(new), ASSIGN_CHUNK_SIZE):
+            Model.objects.bulk_create(new[start:start + ASSIGN_CHUNK_SIZE])
+        for quantity, ids in changed.iteritems():
+            for start in xrange(0, len(ids), ASSIGN_CHUNK_SIZE):
+                Model.objects.filter(licence=self, **{
+                    '{}_id__in'.format(field_name):
+                        ids[start:start + ASSIGN_CHUNK_SIZE],
+                }).update(quantity=quantity)
+        if delta:
+            update_used_quantity(self.pk, delta, stored)
+            self.used_quantity += delta
+        self._log_assignments(diffs, user)
+
+    def detach_many(self, objs, user=None):
+        """Detach this licence from many assets or users (of one model) at
+        once, logging history in one batch."""
+        objs = list(objs)
+        if not objs:
+            return
+        Model, field_name = self.get_assignment_model(objs)
+        assignments = self.get_assignments(
+            Model, field_name, [obj.pk for obj in objs],
+        )
+        if not assignments:
+            return
+        # deleted without post_delete signals, so the used quantity is
+        # updated once
+        DeleteQuery(Model).delete_batch(
+            [pk for pk, _ in assignments.itervalues()],
+            router.db_for_write(Model),
+        )
+        delta = -sum(quantity for _, quantity in assignments.itervalues())
+        update_used_quantity(self.pk, delta)
+        self.used_quantity += delta
+        self._log_assignments(
+            [
+                (obj, assignments[obj.pk][1], '-')
+                for obj in objs if obj.pk in assignments
+            ],
+            user,
+        )
+
+    def _log_assignments(self, diffs, user):
+        from ralph_assets.history.utils import context
+        entries = []
+        for obj, old, new in diffs:
+            entries.extend(History.objects.build_changes(
+                obj,
+                user or getattr(obj, 'saving_user', None),
+                [{
+                    'field': 'assigned_licence_quantity',
+                    'old': old,
+                    'new': new,
+                }],
+            ))
+        context.write(entries)
+
 
-class LicenceAsset(models.Model):
+class AssignedLicence(models.Model):
+    """Quantity of a licence assigned to an object, kept in sync with
+    :attr:`Licence.used_quantity`."""
     licence = models.ForeignKey(Licence)
-    asset = models.ForeignKey(Asset)
     quantity = models.PositiveIntegerField(default=1)
 
+    class Meta:
+        abstract = True
+
+    def __init__(self, *args, **kwargs):
+        super(AssignedLicence, self).__init__(*args, **kwargs)
+        self._saved_quantity = self.quantity if self.pk else 0
+        self._saved_licence_id = self.licence_id if self.pk else None
+        self._stored_licence = None
+
+    def load_stored(self):
+        """Read the stored quantity and licence of this assignment, locking
+        both rows until the end of the transaction (nothing is stored for
+        unsaved assignments)."""
+        self._saved_quantity = 0
+        self._saved_licence_id = self._stored_licence = None
+        if self.pk is None:
+            return
+        stored = list(
+            self.__class__.objects.select_for_update().select_related(
+                'licence',
+            ).filter(pk=self.pk)
+        )
+        if stored:
+            self._saved_quantity = stored[0].quantity
+            self._saved_licence_id = stored[0].licence_id
+            self._stored_licence = stored[0].licence
+
+    def save(self, *args, **kwargs):
+        changed = (
+            self._state.adding or
+            self.quantity != self._saved_quantity or
+            self.licence_id != self._saved_licence_id
+        )
+        if changed:
+            # the loaded quantity may be outdated by other processes
+            self.load_stored()
+        super(AssignedLicence, self).save(*args, **kwargs)
+        if changed:
+            if self.licence_id == self._saved_licence_id:
+                self.update_used_quantity(
+                    self.quantity - self._saved_quantity, self._stored_licence,
+                )
+            else:
+                if self._saved_licence_id is not None:
+                    update_used_quantity(
+                        self._saved_licence_id, -self._saved_quantity,
+                        self._stored_licence,
+                    )
+                self.update_used_quantity(self.quantity)
+        self._saved_quantity = self.quantity
+        self._saved_licence_id = self.licence_id
+        self._stored_licence = None
+
+    def delete(self, *args, **kwargs):
+        # deleted querysets are loaded right before deletion, single objects
+        # may be outdated
+        self.load_stored()
+        super(AssignedLicence, self).delete(*args, **kwargs)
+
+    def update_used_quantity(self, delta, stored_licence=None):
+        if not delta:
+            return
+        update_used_quantity(self.licence_id, delta, stored_licence)
+        licence = getattr(self, '_licence_cache', None)
+        if licence is not None and licence is not stored_licence:
+            licence.used_quantity += delta
+
+
+class LicenceAsset(AssignedLicence):
+    asset = models.ForeignKey(Asset)
+
     class Meta:
         app_label = 'ralph_assets'
         unique_together = ('licence', 'asset')
@@ -306,10 +602,8 @@ class LicenceAsset(models.Model):
         )
 
 
-class LicenceUser(models.Model):
-    licence = models.ForeignKey(Licence)
+class LicenceUser(AssignedLicence):
     user = models.ForeignKey(User, related_name='licences')
-    quantity = models.PositiveIntegerField(default=1)
 
     class Meta:
         app_label = 'ralph_assets'
@@ -321,6 +615,125 @@ class LicenceUser(models.Model):
         )
 
 
+@receiver(
+    post_delete,
+    sender=LicenceAsset,
+    dispatch_uid='ralph_assets.licenceasset.post_delete',
+)
+@receiver(
+    post_delete,
+    sender=LicenceUser,
+    dispatch_uid='ralph_assets.licenceuser.post_delete',
+)
+def assigned_licence_post_delete(sender, instance, **kwargs):
+    # sent also for deletions of querysets and cascades
+    instance.update_used_quantity(
+        -instance._saved_quantity, instance._stored_licence,
+    )
+
+
+@receiver(post_delete, sender=Licence, dispatch_uid='ralph_assets.licence')
+def licence_post_delete(sender, instance, **kwargs):
+    invalidate_summaries()
+
+
+def update_used_quantity(licence_id, delta, stored_licence=None):
+    """Add *delta* to the used quantity of the licence in the database.
+
+    *stored_licence* is the licence loaded with its row locked in the same
+    transaction; it's updated in place and logged to the outbox, otherwise
+    the licence is read again to be logged.
+    """
+    licences = Licence.admin_objects.filter(pk=licence_id)
+    licences.update(used_quantity=F('used_quantity') + delta)
+    if stored_licence is not None:
+        stored_licence.used_quantity += delta
+        licences = [stored_licence]
+    # updates don't send signals
+    OutboxEntry.objects.log(licences, ChangeOperation.updated)
+    invalidate_summaries()
+
+
+def invalidate_summaries():
+    """Make cached summaries of licences outdated."""
+    try:
+        cache.incr(SUMMARY_VERSION_KEY)
+    except ValueError:
+        cache.set(SUMMARY_VERSION_KEY, int(time.time() * 1000), 2592000)
+
+
+def get_cached(name, compute):
+    """Return the result of *compute* cached under *name*, until any licence
+    or assignment changes."""
+    version = cache.get(SUMMARY_VERSION_KEY)
+    if version is None:
+        invalidate_summaries()
+        version = cache.get(SUMMARY_VERSION_KEY)
+    key = 'ralph_assets.licences.{}.{}'.format(version, name)
+    value = cache.get(key)
+    if value is None:
+        value = compute()
+        cache.set(key, value, SUMMARY_CACHE_TIMEOUT)
+    return value
+
+
+def get_summary(licences):
+    """Return the number of bought *licences* (a queryset) and quantities
+    used by assets and users, computed by one query. Summaries are cached
+    for the SQL of the query."""
+    sql, params = licences.order_by().values('pk').query.sql_with_params()
+    sql = SUMMARY_SQL.format(sql)
+
+    def compute():
+        cursor = connection.cursor()
+        cursor.execute(sql, params)
+        total, used_by_assets, used_by_users = cursor.fetchone()
+        return {
+            'total': int(total or 0),
+            'used_by_assets': int(used_by_assets or 0),
+            'used_by_users': int(used_by_users or 0),
+        }
+    return get_cached(
+        'summary.{}'.format(
+            hashlib.md5(repr((sql, params)).encode('utf-8')).hexdigest(),
+        ),
+        compute,
+    )
+
+
+def get_subtree_usages(licences):
+    """Return bought, used and free quantities of subtrees of *licences*
+    (each licence with all its descendants), keyed by licence id. They are
+    summed by one query joining the licences with the nodes of their
+    subtrees."""
+    ids = [licence.pk for licence in licences]
+    if not ids:
+        return {}
+    cursor = connection.cursor()
+    cursor.execute(
+        SUBTREE_USAGE_SQL.format(', '.join(['%s'] * len(ids))), ids,
+    )
+    usages = {}
+    for licence_id, bought, used in cursor.fetchall():
+        bought, used = int(bought or 0), int(used or 0)
+        usages[licence_id] = {
+            'bought': bought,
+            'used': used,
+            'free': bought - used,
+        }
+    return usages
+
+
+def prefetch_subtree_usages(licences):
+    """Load :attr:`Licence.subtree_usage` of *licences* by one query."""
+    licences = [
+        licence for licence in licences if not licence.is_leaf_node()
+    ]
+    usages = get_subtree_usages(licences)
+    for licence in licences:
+        licence._subtree_usage = usages.get(licence.pk)
+
+
 class BudgetInfoLookup(RestrictedLookupChannel):
     model = BudgetInfo
 
@@ -12,7 +12,7 @@ from bob.data_table import DataTableColumn
 
 from django.contrib import messages
 from django.core.urlresolvers import reverse
-from django.db.models import Sum
+from django.db import transaction
 from django.http import HttpResponseRedirect
 from django.shortcuts import get_object_or_404
 from django.utils.translation import ugettext_lazy as _
@@ -30,7 +30,9 @@ from ralph_assets.licences.models import (
     Licence,
     LicenceAsset,
     LicenceUser,
+    NotEnoughLicencesError,
     SoftwareCategory,
+    get_summary,
 )
 from ralph_assets.models_assets import MODE2ASSET_TYPE
 from ralph_assets.utils import assigned_formset_factory
@@ -112,18 +114,31 @@ class AssginLicenceMixin(object):
 
     def post(self, request, *args, **kwargs):
         if self.formset.is_valid():
-            assigned_objs = set(self.queryset.values_list('id', flat=True))
-            formset_objs = []
+            field = self.get_base_field()
+            quantities = {}
             for item in self.formset.cleaned_data:
-                if not item or not item.get('id', None):
+                if not item or not item.get(field, None):
                     continue
-                formset_objs.append(item['id'].id)
-            diff = assigned_objs.difference(formset_objs)
-            self.formset.save()
-            if diff:
-                self.get_base_model().objects.filter(id__in=diff).delete()
-            self.update_formset()
-            messages.success(request, _('Saved.'))
+                quantities[item[field]] = item['quantity']
+            detached = [
+                getattr(assigned, field)
+                for assigned in self.queryset.select_related(field)
+                if getattr(assigned, field) not in quantities
+            ]
+            try:
+                # detaching is rolled back when there are not enough
+                # licences for the assignments
+                with transaction.commit_on_success():
+                    self.obj.detach_many(detached, user=request.user)
+                    self.obj.assign_many(quantities, user=request.user)
+            except NotEnoughLicencesError as error:
+                self.formset._non_form_errors = self.formset.error_class([
+                    _('Not enough licences: {}').format(error),
+                ])
+                messages.error(request, _('Please correct the errors.'))
+            else:
+                self.update_formset()
+                messages.success(request, _('Saved.'))
         return self.get(request, *args, **kwargs)
 
 
@@ -382,13 +397,9 @@ class CountLicence(AjaxMixin, JsonResponseMixin, GenericSearch):
 
     def get(self, request, *args, **kwargs):
         self.form = self.Form(request.GET)
-        qs = self.handle_search_data(request)
-        summary = qs.aggregate(total=Sum('number_bought'))
-        summary.update(qs.aggregate(
-                       used_by_assets=Sum('licenceasset__quantity')))
-        summary.update(qs.aggregate(
-                       used_by_users=Sum('licenceuser__quantity')))
-        return self.render_json_response(summary)
+        # the search isn't counted, the summary needs only its query
+        licences = self.Model.objects.filter(self.form.get_query())
+        return self.render_json_response(get_summary(licences))
 
 
 class AssginAssetToLicence(AssginToLicenceBase):
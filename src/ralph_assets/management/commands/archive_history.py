@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import calendar
+import datetime
+import textwrap
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from optparse import make_option
+
+from ralph_assets.history.models import (
+    ARCHIVED_FIELDS,
+    History,
+    HistoryArchive,
+)
+from ralph_assets.history.utils import history_scope
+
+
+def months_ago(date, months):
+    month = date.month - 1 - months
+    year = date.year + month // 12
+    month = month % 12 + 1
+    day = min(date.day, calendar.monthrange(year, month)[1])
+    return date.replace(year=year, month=month, day=day)
+
+
+class Command(BaseCommand):
+    """Move history entries older than given number of months to the
+    compressed archive. Archived history is still shown on history pages."""
+    help = textwrap.dedent(__doc__).strip()
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--months',
+            type='int',
+            dest='months',
+            default=12,
+            help="Archive history older than this many months",
+        ),
+        make_option(
+            '--batch-size',
+            type='int',
+            dest='batch_size',
+            default=10000,
+            help="Number of history entries moved in one transaction",
+        ),
+    )
+
+    @history_scope()
+    def handle(self, *args, **options):
+        before = months_ago(datetime.datetime.now(), options['months'])
+        archived = 0
+        while True:
+            moved = self.archive_batch(before, options['batch_size'])
+            if not moved:
+                break
+            archived += moved
+        self.stdout.write(
+            'Archived {} history entries older than {}.\n'.format(
+                archived, before,
+            )
+        )
+
+    @transaction.commit_on_success
+    def archive_batch(self, before, batch_size):
+        entries = list(
+            History.objects.filter(
+                date__lt=before,
+            ).order_by('pk').values(
+                'pk', 'content_type', 'object_id', *ARCHIVED_FIELDS
+            )[:batch_size]
+        )
+        if not entries:
+            return 0
+        HistoryArchive.objects.archive(entries)
+        # entries are the first ones by pk, so they are exactly those up to
+        # the last one
+        History.objects.filter(
+            date__lt=before, pk__lte=entries[-1]['pk'],
+        ).delete()
+        return len(entries)
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import textwrap
+
+from django.core.management.base import BaseCommand
+from optparse import make_option
+
+from ralph_assets.expiry_digest import (
+    DIGEST_FORMATS,
+    EXPIRY_DIGEST_DAYS,
+    EXPIRY_DIGEST_PATH,
+    enqueue_expiry_digest,
+    expiry_digest,
+)
+from ralph_assets.history.utils import history_scope
+
+
+class Command(BaseCommand):
+    """Write digests of supports and licences expiring soon with assets they
+    cover, one file per owner of the assets."""
+    help = textwrap.dedent(__doc__).strip()
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--days',
+            type='int',
+            dest='days',
+            default=EXPIRY_DIGEST_DAYS,
+            help="Include contracts expiring within this many days",
+        ),
+        make_option(
+            '--path',
+            dest='path',
+            default=EXPIRY_DIGEST_PATH,
+            help="Directory digests are written to",
+        ),
+        make_option(
+            '--format',
+            type='choice',
+            dest='format',
+            choices=DIGEST_FORMATS,
+            default='csv',
+            help="Format of digest files: csv or json",
+        ),
+        make_option(
+            '--enqueue',
+            action='store_true',
+            dest='enqueue',
+            default=False,
+            help="Write digests by an rq job instead of this process",
+        ),
+    )
+
+    @history_scope()
+    def handle(self, *args, **options):
+        if options['enqueue']:
+            job = enqueue_expiry_digest(
+                options['days'], options['path'], options['format'],
+            )
+            self.stdout.write('Enqueued job {}.\n'.format(job.id))
+            return
+        directory = expiry_digest(
+            options['days'], options['path'], options['format'],
+        )
+        self.stdout.write('Digests written to {}.\n'.format(directory))
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import textwrap
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Sum
+from optparse import make_option
+
+from ralph_assets.history.utils import history_scope
+from ralph_assets.licences.models import Licence, LicenceAsset, LicenceUser
+from ralph_assets.models_outbox import ChangeOperation, OutboxEntry
+
+
+def get_used_quantities():
+    """Return sums of quantities assigned to assets and users, keyed by
+    licence id."""
+    used = defaultdict(int)
+    for Model in (LicenceAsset, LicenceUser):
+        for licence_id, quantity in Model.objects.values(
+            'licence',
+        ).annotate(sum=Sum('quantity')).values_list('licence', 'sum'):
+            used[licence_id] += quantity or 0
+    return used
+
+
+class Command(BaseCommand):
+    """Check used quantities stored on licences against quantities assigned
+    to assets and users, and fix the wrong ones."""
+    help = textwrap.dedent(__doc__).strip()
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--dry-run',
+            action='store_true',
+            dest='dry_run',
+            default=False,
+            help="Only report wrong used quantities",
+        ),
+    )
+
+    @history_scope()
+    @transaction.commit_on_success
+    def handle(self, *args, **options):
+        used = get_used_quantities()
+        wrong = 0
+        for licence_id, used_quantity in Licence.admin_objects.values_list(
+            'id', 'used_quantity',
+        ):
+            correct = used.get(licence_id, 0)
+            if used_quantity == correct:
+                continue
+            wrong += 1
+            self.stdout.write(
+                'Licence {}: used quantity {} instead of {}.\n'.format(
+                    licence_id, used_quantity, correct,
+                )
+            )
+            if not options['dry_run']:
+                licences = Licence.admin_objects.filter(pk=licence_id)
+                licences.update(used_quantity=correct)
+                OutboxEntry.objects.log(licences, ChangeOperation.updated)
+        self.stdout.write('{} licences with wrong used quantity {}.\n'.format(
+            wrong, 'found' if options['dry_run'] else 'fixed',
+        ))
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import datetime
+import textwrap
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import get_models
+
+from ralph_assets.history.models import HistoryMixin
+from ralph_assets.history.state import CHUNK_SIZE, take_snapshots
+from ralph_assets.history.utils import history_scope
+
+
+class Command(BaseCommand):
+    """Store current states of all objects with history as snapshots, which
+    shorten reconstruction of their past states. Run it periodically, e.g.
+    monthly."""
+    help = textwrap.dedent(__doc__).strip()
+
+    @history_scope()
+    def handle(self, *args, **options):
+        date = datetime.datetime.now()
+        for model in get_models():
+            if not issubclass(model, HistoryMixin):
+                continue
+            count = self.snapshot_model(model, date)
+            self.stdout.write(
+                'Stored {} snapshots of {}.\n'.format(
+                    count, model._meta.verbose_name_plural,
+                )
+            )
+
+    @transaction.commit_on_success
+    def snapshot_model(self, model, date):
+        pks = list(
+            model._base_manager.order_by('pk').values_list('pk', flat=True)
+        )
+        for start in xrange(0, len(pks), CHUNK_SIZE):
+            take_snapshots(
+                model._base_manager.filter(
+                    pk__in=pks[start:start + CHUNK_SIZE],
+                ),
+                date,
+            )
+        return len(pks)
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import json
+import textwrap
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from optparse import make_option
+
+from ralph_assets.history.utils import history_scope
+from ralph_assets.models_outbox import OutboxEntry
+
+
+class Command(BaseCommand):
+    """Print changes of assets, device info, licences and supports made
+    after given sequence number, one JSON object per line. With --follow
+    keep waiting for new changes."""
+    help = textwrap.dedent(__doc__).strip()
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--since',
+            type='int',
+            dest='since',
+            default=0,
+            help="Print changes after this sequence number",
+        ),
+        make_option(
+            '--limit',
+            type='int',
+            dest='limit',
+            default=1000,
+            help="Number of changes read by one query",
+        ),
+        make_option(
+            '--follow',
+            action='store_true',
+            dest='follow',
+            default=False,
+            help="Keep waiting for new changes",
+        ),
+        make_option(
+            '--interval',
+            type='float',
+            dest='interval',
+            default=5,
+            help="Seconds between checks for new changes with --follow",
+        ),
+    )
+
+    @history_scope()
+    def handle(self, *args, **options):
+        sequence = options['since']
+        while True:
+            entries = list(
+                OutboxEntry.objects.since(sequence, options['limit'])
+            )
+            for entry in entries:
+                self.stdout.write(json.dumps(entry.to_dict()) + '\n')
+                sequence = entry.sequence
+            if len(entries) == options['limit']:
+                continue
+            if not options['follow']:
+                break
+            self.stdout.flush()
+            # end the transaction, so the next query sees new changes
+            transaction.commit_unless_managed()
+            time.sleep(options['interval'])
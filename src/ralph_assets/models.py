@@ -12,7 +12,7 @@ from django.contrib.auth.models import User
 from django.core.urlresolvers import reverse
 from django.utils.html import escape
 from django.utils.translation import ugettext_lazy as _
-from django.db.models import Q
+from django.db.models import F, Q
 
 from ralph_assets.models_assets import (
     Asset,
@@ -39,6 +39,7 @@ from ralph_assets.licences.models import (
     LicenceType,
     SoftwareCategory,
 )
+from ralph_assets.models_outbox import ChangeOperation, OutboxEntry
 from ralph_assets.models_support import Support
 from ralph_assets.models_transition import (
     Action,
@@ -114,47 +115,33 @@ class FreeLicenceLookup(RestrictedLookupChannel):
     """Lookup the licences that have any specimen left."""
 
     model = Licence
+    limit = 10
 
     def get_query(self, query, request):
-        expression = '%{}%'.format(query)
-        return self.model.objects.raw(
-            """SELECT
-                ralph_assets_licence.*,
-                ralph_assets_softwarecategory.name,
-                (
-                    COUNT(ralph_assets_licenceasset.asset_id)  +
-                    COUNT(ralph_assets_licenceuser.user_id)
-                ) AS used
-            FROM
-                ralph_assets_licence
-            INNER JOIN ralph_assets_softwarecategory ON (
-                ralph_assets_licence.software_category_id =
-                ralph_assets_softwarecategory.id
-            )
-            LEFT JOIN ralph_assets_licenceasset ON (
-                ralph_assets_licence.id =
-                ralph_assets_licenceasset.licence_id
-            )
-            LEFT JOIN ralph_assets_licenceuser ON (
-                ralph_assets_licence.id =
-                ralph_assets_licenceuser.licence_id
-            )
-            WHERE
-                ralph_assets_softwarecategory.name LIKE %s
-            OR
-                ralph_assets_licence.niw LIKE %s
-            GROUP BY ralph_assets_licence.id
-            HAVING used < ralph_assets_licence.number_bought
-            LIMIT 10;
-            """,
-            (expression, expression)
+        licences = self.get_base_objects().filter(
+            used_quantity__lt=F('number_bought'),
+        ).select_related('software_category')
+        # prefixes of niw and of software category name are matched by
+        # separate queries, so each of them uses its index
+        found = list(
+            licences.filter(niw__istartswith=query).order_by('niw')[
+                :self.limit
+            ]
         )
+        found_ids = set(licence.id for licence in found)
+        for licence in licences.filter(
+            software_category__name__istartswith=query,
+        ).order_by('software_category__name', 'niw')[:self.limit]:
+            if len(found) == self.limit:
+                break
+            if licence.id not in found_ids:
+                found.append(licence)
+        return found
 
     def get_result(self, obj):
         return obj.id
 
     def format_item_display(self, obj):
-        free = str(obj.number_bought - obj.assets.count() - obj.users.count())
         return """
         <span>{name}</span>
         <span class="licence-niw">{niw}</span>
@@ -162,7 +149,7 @@ class FreeLicenceLookup(RestrictedLookupChannel):
         """.format(
             name=escape(str(obj)),
             niw=obj.niw,
-            free=free,
+            free=obj.free,
         )
 
 
@@ -467,6 +454,7 @@ __all__ = [
     'AssetType',
     'BOAssetModelLookup',
     'BODeviceLookup',
+    'ChangeOperation',
     'CoaOemOs',
     'DCAssetModelLookup',
     'DCDeviceLookup',
@@ -476,6 +464,7 @@ __all__ = [
     'LicenceType',
     'OfficeInfo',
     'Orientation',
+    'OutboxEntry',
     'PartInfo',
     'ReportOdtSource',
     'ReportOdtSourceLanguage',
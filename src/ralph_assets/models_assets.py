@@ -11,6 +11,7 @@ from __future__ import unicode_literals
 import datetime
 import logging
 import os
+from collections import defaultdict
 
 from dateutil.relativedelta import relativedelta
 
@@ -612,24 +613,58 @@ class Asset(
         on_delete=models.PROTECT,
     )
 
+    # empty strings saved as NULL
+    empty_as_none_fields = ('source', 'hostname')
+
     def __unicode__(self):
         return "{} - {} - {}".format(self.model, self.sn, self.barcode)
 
     @property
     def linked_device(self):
+        """Device linked in Ralph, queried once per instance until
+        ``ralph_device_id`` changes."""
         try:
-            device = self.device_info.get_ralph_device()
+            ralph_device_id = self.device_info.ralph_device_id
         except AttributeError:
-            device = None
+            return None
+        if not ralph_device_id:
+            return None
+        linked_id, device = getattr(self, '_linked_device', (None, None))
+        if linked_id != ralph_device_id:
+            device = self.get_ralph_device()
+            self._linked_device = (ralph_device_id, device)
         return device
 
     @property
     def venture(self):
         try:
-            return self.get_ralph_device().venture
+            return self.linked_device.venture
         except AttributeError:
             return None
 
+    @classmethod
+    def prefetch_linked_devices(cls, assets):
+        """Resolve linked devices of *assets* (with their ventures) by one
+        query and memoize them on the assets."""
+        linked = defaultdict(list)
+        for asset in assets:
+            try:
+                ralph_device_id = asset.device_info.ralph_device_id
+            except AttributeError:
+                continue
+            if ralph_device_id:
+                linked[ralph_device_id].append(asset)
+        if not linked:
+            return
+        devices = Device.objects.select_related('venture').in_bulk(
+            linked.keys(),
+        )
+        for ralph_device_id, linked_assets in linked.iteritems():
+            for asset in linked_assets:
+                asset._linked_device = (
+                    ralph_device_id, devices.get(ralph_device_id),
+                )
+
     @property
     def cores_count(self):
         """Returns cores count assigned to device in Ralph"""
@@ -745,7 +780,7 @@ class Asset(
                         self.create_stock_device()
 
     def save(self, commit=True, force_unlink=False, *args, **kwargs):
-        _replace_empty_with_none(self, ['source', 'hostname'])
+        _replace_empty_with_none(self, self.empty_as_none_fields)
         self.handle_device_linkage(force_unlink)
         return super(Asset, self).save(commit=commit, *args, **kwargs)
 
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""Outbox of changes of assets, device info, licences and supports.
+
+Every change appends an entry, whose id is the sequence number consumers
+use as a cursor: they ask for changes since the last sequence they've seen
+instead of re-reading whole tables. Entries are written by signal receivers
+in ``models_signals``, so inside a transaction they are committed (or rolled
+back) together with the change. Updates bypassing ``save`` (e.g. bulk
+updates of import, used quantities of licences) log their changes with
+:meth:`OutboxManager.log`.
+
+Ids are taken when entries are inserted, not when their transactions commit,
+so an entry may become visible after entries with higher ids. Entries are
+served only when they are older than ``ASSETS_OUTBOX_LAG`` seconds, so such
+entries aren't skipped by cursors as long as transactions are shorter than
+that. Delivery is at-least-once: entries carry full states of objects, so
+consumers apply them idempotently and may re-read from an older sequence.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import json
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import models
+from django.utils.translation import ugettext_lazy as _
+from lck.django.choices import Choices
+
+
+# seconds entries wait before they are served (see the module docstring)
+OUTBOX_LAG = getattr(settings, 'ASSETS_OUTBOX_LAG', 60)
+
+
+class ChangeOperation(Choices):
+    _ = Choices.Choice
+
+    created = _('created')
+    updated = _('updated')
+    deleted = _('deleted')
+
+
+def get_snapshot(obj):
+    """Return database values of concrete fields of *obj*, foreign keys as
+    ids. Values assigned but not saved yet (e.g. dates as strings, choices)
+    are converted the way they are written."""
+    return dict(
+        (field.name, field.get_prep_value(field.value_from_object(obj)))
+        for field in obj._meta.fields
+    )
+
+
+class OutboxManager(models.Manager):
+    def log(self, objs, operation):
+        """Append changes of *objs* (of one model) to the outbox."""
+        objs = list(objs)
+        if not objs:
+            return
+        content_type = ContentType.objects.get_for_model(objs[0].__class__)
+        if operation == ChangeOperation.deleted:
+            data = [{} for obj in objs]
+        else:
+            data = [get_snapshot(obj) for obj in objs]
+        self.bulk_create([
+            self.model(
+                content_type=content_type,
+                object_id=obj.pk,
+                operation=operation,
+                data=json.dumps(fields, cls=DjangoJSONEncoder),
+            )
+            for obj, fields in zip(objs, data)
+        ])
+
+    def visible(self, lag=None):
+        """Return changes older than *lag* seconds (``ASSETS_OUTBOX_LAG`` by
+        default)."""
+        if lag is None:
+            lag = OUTBOX_LAG
+        return self.filter(date__lte=datetime.now() - timedelta(seconds=lag))
+
+    def since(self, sequence, limit=1000, lag=None):
+        """Return up to *limit* visible changes after the *sequence*
+        number."""
+        return self.visible(lag).filter(
+            id__gt=sequence,
+        ).select_related('content_type').order_by('id')[:limit]
+
+
+class OutboxEntry(models.Model):
+    date = models.DateTimeField(default=datetime.now)
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.PositiveIntegerField()
+    operation = models.PositiveSmallIntegerField(choices=ChangeOperation())
+    data = models.TextField(default='{}')
+    objects = OutboxManager()
+
+    class Meta:
+        app_label = 'ralph_assets'
+        verbose_name = _('outbox entry')
+        verbose_name_plural = _('outbox entries')
+        ordering = ('id',)
+
+    def __unicode__(self):
+        return '#{} {} {} (id: {})'.format(
+            self.id,
+            ChangeOperation.from_id(self.operation).name,
+            self.content_type,
+            self.object_id,
+        )
+
+    @property
+    def sequence(self):
+        return self.id
+
+    def to_dict(self):
+        return {
+            'sequence': self.id,
+            'date': self.date.isoformat(),
+            'model': '{}.{}'.format(
+                self.content_type.app_label, self.content_type.model,
+            ),
+            'object_id': self.object_id,
+            'operation': ChangeOperation.from_id(self.operation).name,
+            'data': json.loads(self.data),
+        }
@@ -6,13 +6,16 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 
-from ralph_assets.models import Asset, DeviceInfo
+from ralph_assets.models import Asset, DeviceInfo, Licence, Support
+from ralph_assets.models_outbox import ChangeOperation, OutboxEntry
 
 
 SAVE_PRIORITY = 215
+# models whose changes are written to the outbox
+OUTBOX_MODELS = (Asset, DeviceInfo, Licence, Support)
 
 
 def _can_not_edit_localization(asset_dev_info):
@@ -118,3 +121,29 @@ def update_core_localization(asset_dev_info):
 )
 def asset_device_info_post_save(sender, instance, **kwargs):
     update_core_localization(asset_dev_info=instance)
+
+
+def outbox_post_save(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    OutboxEntry.objects.log(
+        [instance],
+        ChangeOperation.created if created else ChangeOperation.updated,
+    )
+
+
+def outbox_post_delete(sender, instance, **kwargs):
+    OutboxEntry.objects.log([instance], ChangeOperation.deleted)
+
+
+for model in OUTBOX_MODELS:
+    post_save.connect(
+        outbox_post_save,
+        sender=model,
+        dispatch_uid='assets.outbox.post_save.{}'.format(model.__name__),
+    )
+    post_delete.connect(
+        outbox_post_delete,
+        sender=model,
+        dispatch_uid='assets.outbox.post_delete.{}'.format(model.__name__),
+    )
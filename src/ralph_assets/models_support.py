@@ -35,6 +35,13 @@ from ralph_assets.models_util import (
 )
 
 
+# counted by a subquery, so joins of search filters don't change counts
+ASSETS_COUNT_SQL = (
+    'SELECT COUNT(*) FROM ralph_assets_support_assets '
+    'WHERE ralph_assets_support_assets.support_id = ralph_assets_support.id'
+)
+
+
 class SupportType(Named):
     """The type of a support"""
 
@@ -71,7 +78,7 @@ class Support(
         max_digits=10, decimal_places=2, default=0, null=True, blank=True,
     )
     date_from = models.DateField(null=True, blank=True)
-    date_to = models.DateField(null=False, blank=False)
+    date_to = models.DateField(null=False, blank=False, db_index=True)
     escalation_path = models.CharField(max_length=200, blank=True)
     contract_terms = models.CharField(max_length=200, blank=True)
     additional_notes = models.CharField(max_length=200, blank=True)
@@ -40,6 +40,30 @@ REPORT_LANGUAGES = {
     'default': 'en',
 }
 
+# imports with at least this many rows convert cell values in a pool of
+# ASSETS_IMPORT_POOL_PROCESSES worker processes (None - one per CPU)
+ASSETS_IMPORT_POOL_MIN_ROWS = 20000
+ASSETS_IMPORT_POOL_PROCESSES = None
+
+# rq queue writing history deferred by bulk edits, transitions and imports
+# (None - write it in the request process)
+ASSETS_HISTORY_QUEUE = None
+
+# seconds summaries of the licence list are cached for (they are also
+# outdated by changes of licences and their assignments)
+ASSETS_LICENCE_SUMMARY_CACHE_TIMEOUT = 300
+
+# seconds changes wait in the outbox before they are served, so changes
+# committed after ones with higher sequence numbers aren't skipped
+ASSETS_OUTBOX_LAG = 60
+
+# digests of supports and licences expiring within ASSETS_EXPIRY_DIGEST_DAYS
+# are written to ASSETS_EXPIRY_DIGEST_PATH, by jobs of the
+# ASSETS_EXPIRY_DIGEST_QUEUE rq queue when enqueued
+ASSETS_EXPIRY_DIGEST_DAYS = 30
+ASSETS_EXPIRY_DIGEST_PATH = '/tmp/'
+ASSETS_EXPIRY_DIGEST_QUEUE = 'default'
+
 # automatically assign domain hostname to asset in edit and bulk forms
 ASSETS_AUTO_ASSIGN_HOSTNAME = False
 if locals().get('ASSETS_AUTO_ASSIGN_HOSTNAME'):
@@ -31,12 +31,12 @@ def short_history(obj, limit=5, full_history_button=True):
     """Render a short history table."""
     if not obj:
         return {}
-    history = obj.get_history()
+    history = obj.get_latest_history(limit)
     if not history:
         return {}
     return get_context(
         obj,
-        history.order_by('-date'),
+        history,
         limit,
         full_history_button,
         _('Short history'),
@@ -48,12 +48,12 @@ def status_history(obj, limit=5, full_history_button=True):
     """Render a short history table only for status changes."""
     if not obj:
         return {}
-    history = obj.get_history(field_name='status')
+    history = obj.get_latest_history(limit, field_name='status')
     if not history:
         return {}
     return get_context(
         obj,
-        history.order_by('-date'),
+        history,
         limit,
         full_history_button,
         _('Status history'),
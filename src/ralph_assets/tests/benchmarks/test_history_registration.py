@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""Benchmark of iterating over assets with the history registration checked
+by every instance (as it used to be) and done once at class creation.
+
+Timing is printed only, run it with ``ASSETS_BENCHMARKS=1``.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import time
+from unittest import skipUnless
+
+from django.test import TestCase
+from mock import patch
+
+from ralph_assets.history import registry
+from ralph_assets.history.models import HistoryMixin
+from ralph_assets.models_assets import Asset
+from ralph_assets.tests.utils.assets import AssetFactory
+
+
+def legacy_init(self, *args, **kwargs):
+    """``HistoryMixin.__init__`` checking the registration per instance."""
+    super(HistoryMixin, self).__init__(*args, **kwargs)
+    from ralph_assets.history import registry
+    if not registry.get(self.__class__, None):
+        raise AssertionError('Registered at class creation.')
+
+
+class TestHistoryRegistration(TestCase):
+
+    def test_registered_without_instances(self):
+        self.assertIn(Asset, registry)
+        self.assertNotIn('__init__', vars(HistoryMixin))
+
+    @skipUnless(os.environ.get('ASSETS_BENCHMARKS'), 'benchmark')
+    def test_queryset_iteration(self):
+        for _ in xrange(200):
+            AssetFactory()
+        rows = list(Asset.objects.values_list())
+
+        def iterate():
+            start = time.time()
+            for _ in xrange(20):
+                # instances are built from already fetched rows, so only the
+                # construction is measured
+                for row in rows:
+                    Asset(*row)
+            return time.time() - start
+
+        with patch.object(HistoryMixin, '__init__', legacy_init, create=True):
+            legacy = iterate()
+        current = iterate()
+        print(
+            '\n{} instances: per-instance check {:.3f}s, '
+            'registered at class creation {:.3f}s'.format(
+                len(rows) * 20, legacy, current,
+            )
+        )
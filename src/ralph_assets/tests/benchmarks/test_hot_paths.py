@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+"""Query-count budgets of the hot paths writing assets: saving an asset, bulk
+edit, transition and import.
+
+Every path fires history, hostname assigning, device linkage, field syncing
+with core and localization updates, so queries are counted for the whole
+path. Paths handling many objects are measured for two sizes. Queries added
+by every further object may only be those of its saves (measured by saving
+a single asset) and a small overhead; the rest of the smaller run must fit the
+fixed budget. Budgets are asserted always, wall times are printed with
+``ASSETS_BENCHMARKS=1``.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import urllib
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.urlresolvers import reverse
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from ralph_assets.models_assets import Asset, AssetStatus, AssetType
+from ralph_assets.models_transition import Action
+from ralph_assets.tests.util import get_bulk_edit_post_data_part
+from ralph_assets.tests.utils import ClientMixin, QueryCounter, UserFactory
+from ralph_assets.tests.utils.assets import (
+    AssetModelFactory,
+    BOAssetFactory,
+    DCAssetFactory,
+    WarehouseFactory,
+)
+from ralph_assets.tests.utils.licences import LicenceFactory
+from ralph_assets.tests.utils.supports import (
+    BOSupportFactory,
+    DCSupportFactory,
+)
+from ralph_assets.tests.utils.transitions import TransitionFactory
+
+
+BENCHMARKS = bool(os.environ.get('ASSETS_BENCHMARKS'))
+# numbers of objects of the smaller and the larger run
+SIZES = (2, 6)
+# maximum number of queries of a single save: the measured number (in the
+# comment) and a small margin
+SAVE_BUDGETS = {
+    'asset': 25,  # 22
+    'device_info': 42,  # 38
+}
+# maximum number of queries of the smaller run besides per-object ones, and
+# of every further object besides its saves: the measured numbers (in the
+# comment) and a small margin
+PATH_BUDGETS = {
+    'bulk_edit': (18, 34),  # 15.5, 31.25 (50.25 per object, 19 saving it)
+    'transition': (35, 1),  # 31.5, -2.75 (19.25 per object, 22 saving it)
+    'import': (23, 1),  # 20, 0 (rows are updated in bulk)
+}
+ASSETS_TRANSITIONS = {
+    'ENABLE': True,
+    'SLUGS': {
+        'LOAN-ASSET': 'loan-asset',
+    },
+}
+
+
+def seed_assets(factory, support_factory, count):
+    """Create *count* assets with licences and supports assigned."""
+    assets = []
+    for _ in xrange(count):
+        asset = factory()
+        LicenceFactory().assign(asset)
+        asset.supports.add(support_factory())
+        assets.append(asset)
+    return assets
+
+
+def count_save_queries(factory, support_factory, **changes):
+    """Return the number of queries of saving one asset with *changes*."""
+    asset = seed_assets(factory, support_factory, 1)[0]
+    asset = Asset.objects.get(pk=asset.pk)
+    for name, value in changes.iteritems():
+        setattr(asset, name, value)
+    with QueryCounter() as counter:
+        asset.save()
+    return counter.count
+
+
+class HotPathTestCase(ClientMixin, TestCase):
+
+    def assertWithinBudget(self, name, counters, save_queries=0):
+        """Check counters of the runs of *name* (one per size), whose every
+        object costs *save_queries* of its saves."""
+        fixed_budget, overhead_budget = PATH_BUDGETS[name]
+        small, large = counters
+        per_object = (large.count - small.count) / (SIZES[1] - SIZES[0])
+        if BENCHMARKS:
+            print(
+                '\n{}: {} objects {} queries {:.3f}s, '
+                '{} objects {} queries {:.3f}s'.format(
+                    name, SIZES[0], small.count, small.time,
+                    SIZES[1], large.count, large.time,
+                )
+            )
+        self.assertLessEqual(per_object, save_queries + overhead_budget)
+        self.assertLessEqual(
+            small.count - SIZES[0] * per_object, fixed_budget,
+        )
+
+
+class TestSaveBudget(HotPathTestCase):
+
+    def setUp(self):
+        self.asset = seed_assets(DCAssetFactory, DCSupportFactory, 1)[0]
+        # load as views do, so dirty fields are tracked
+        self.asset = Asset.objects.get(pk=self.asset.pk)
+
+    def test_asset_save(self):
+        self.asset.remarks = 'changed'
+        self.asset.status = AssetStatus.in_progress
+        with QueryCounter() as counter:
+            self.asset.save()
+        if BENCHMARKS:
+            print('\nasset save: {} queries {:.3f}s'.format(
+                counter.count, counter.time,
+            ))
+        self.assertLessEqual(counter.count, SAVE_BUDGETS['asset'])
+
+    def test_device_info_save(self):
+        device_info = self.asset.device_info
+        device_info.position = 10
+        with QueryCounter() as counter:
+            device_info.save()
+        if BENCHMARKS:
+            print('\ndevice info save: {} queries {:.3f}s'.format(
+                counter.count, counter.time,
+            ))
+        self.assertLessEqual(counter.count, SAVE_BUDGETS['device_info'])
+
+
+class TestBulkEditBudget(HotPathTestCase):
+
+    def setUp(self):
+        self.login_as_superuser()
+        self.model = AssetModelFactory()
+
+    def bulk_edit(self, count):
+        assets = seed_assets(DCAssetFactory, DCSupportFactory, count)
+        post_data = {
+            'form-TOTAL_FORMS': count,
+            'form-INITIAL_FORMS': count,
+            'form-MAX_NUM_FORMS': '',
+        }
+        for i, asset in enumerate(assets):
+            post_data.update(get_bulk_edit_post_data_part(
+                id=i + 1, model=self.model.id,
+            ))
+            post_data['form-{}-id'.format(i)] = asset.id
+        url = '{}?{}'.format(
+            reverse('bulkedit', kwargs={'mode': 'dc'}),
+            urllib.urlencode(
+                [('select', asset.id) for asset in assets],
+            ),
+        )
+        with QueryCounter() as counter:
+            response = self.client.post(url, post_data)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(
+            Asset.objects.filter(
+                pk__in=[asset.id for asset in assets], model=self.model,
+            ).count(),
+            count,
+        )
+        return counter
+
+    def test_bulk_edit(self):
+        save_queries = count_save_queries(
+            DCAssetFactory, DCSupportFactory, model=self.model,
+        )
+        self.assertWithinBudget(
+            'bulk_edit', [self.bulk_edit(size) for size in SIZES],
+            save_queries,
+        )
+
+
+@override_settings(ASSETS_TRANSITIONS=ASSETS_TRANSITIONS)
+class TestTransitionBudget(HotPathTestCase):
+
+    def setUp(self):
+        self.login_as_superuser()
+        transition = TransitionFactory(name='loan-asset', slug='loan-asset')
+        transition.actions.add(*Action.objects.filter(
+            name__in=['assign_user', 'assign_warehouse'],
+        ))
+        self.user = UserFactory()
+        self.warehouse = WarehouseFactory()
+
+    def transition(self, count):
+        assets = seed_assets(BOAssetFactory, BOSupportFactory, count)
+        url = '{}?{}'.format(
+            reverse('transition', args=('back_office',)),
+            urllib.urlencode(
+                [('select', asset.id) for asset in assets] +
+                [('transition_type', 'loan-asset')],
+            ),
+        )
+        with QueryCounter() as counter:
+            response = self.client.post(url, {
+                'user': self.user.id,
+                'warehouse': self.warehouse.id,
+            })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            Asset.objects.filter(
+                pk__in=[asset.id for asset in assets], user=self.user,
+            ).count(),
+            count,
+        )
+        return counter
+
+    def test_transition(self):
+        # one save by each of the actions
+        save_queries = count_save_queries(
+            BOAssetFactory, BOSupportFactory, user=self.user,
+        ) + count_save_queries(
+            BOAssetFactory, BOSupportFactory, warehouse=self.warehouse,
+        )
+        self.assertWithinBudget(
+            'transition', [self.transition(size) for size in SIZES],
+            save_queries,
+        )
+
+
+class TestImportBudget(HotPathTestCase):
+
+    def setUp(self):
+        self.login_as_superuser()
+        self.url = reverse('xls_upload')
+
+    def import_update(self, count):
+        assets = seed_assets(BOAssetFactory, BOSupportFactory, count)
+        csv_data = '"id","remarks"\n' + '\n'.join(
+            '"{}","imported"'.format(asset.id) for asset in assets
+        )
+        self.client.get(self.url)
+        self.client.post(self.url, {
+            'upload-asset_type': AssetType.back_office.id,
+            'upload-model': 'ralph_assets.asset',
+            'upload-file': SimpleUploadedFile('test.csv', csv_data),
+            'xls_upload_view-current_step': 'upload',
+        })
+        self.client.post(self.url, {
+            'column_choice-remarks': 'remarks',
+            'xls_upload_view-current_step': 'column_choice',
+        })
+        with QueryCounter() as counter:
+            response = self.client.post(self.url, {
+                'xls_upload_view-current_step': 'confirm',
+            })
+        self.assertContains(response, 'Import done')
+        self.assertEqual(
+            Asset.objects.filter(
+                pk__in=[asset.id for asset in assets], remarks='imported',
+            ).count(),
+            count,
+        )
+        return counter
+
+    def test_import(self):
+        self.assertWithinBudget(
+            'import', [self.import_update(size) for size in SIZES],
+        )
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import json
+
+from django.test import TestCase
+from ralph.business.models import Venture
+from ralph.discovery.tests.util import DeviceFactory
+from tastypie.models import ApiKey
+
+from ralph_assets.tests.utils import QueryCounter, UserFactory
+from ralph_assets.tests.utils.assets import BOAssetFactory, DCAssetFactory
+from ralph_assets.tests.utils.licences import LicenceFactory
+
+
+class ApiTestCase(TestCase):
+
+    def setUp(self):
+        self.user = UserFactory()
+        self.api_key = ApiKey.objects.get_or_create(user=self.user)[0]
+
+    def request_list(self, resource_name, limit):
+        return self.client.get(
+            '/assets/api/v0.9/{}/'.format(resource_name), {
+                'format': 'json',
+                'limit': limit,
+                'username': self.user.username,
+                'api_key': self.api_key.key,
+            },
+        )
+
+    def get_list(self, resource_name, limit):
+        # the first requests fill caches of choices and create activity log
+        # rows of the client, which isn't counted
+        self.request_list(resource_name, limit)
+        with QueryCounter() as counter:
+            response = self.request_list(resource_name, limit)
+        self.assertEqual(response.status_code, 200)
+        objects = json.loads(response.content)['objects']
+        self.assertEqual(len(objects), limit)
+        return objects, counter.count
+
+
+class TestAssetsResource(ApiTestCase):
+
+    def setUp(self):
+        super(TestAssetsResource, self).setUp()
+        for _ in xrange(6):
+            asset = BOAssetFactory()
+            for _ in xrange(2):
+                LicenceFactory().assign(asset)
+
+    def test_queries_dont_depend_on_page_size(self):
+        objects, small = self.get_list('assets', 2)
+        self.assertEqual(len(objects[0]['licences']), 2)
+        self.assertTrue(objects[0]['licences'][0]['software_category'])
+        self.assertNotIn('subtree_usage', objects[0]['licences'][0])
+        self.assertIn(
+            '/v0.9/licence/', objects[0]['licences'][0]['resource_uri'],
+        )
+        self.assertTrue(objects[0]['model']['category'])
+        objects, large = self.get_list('assets', 6)
+        self.assertEqual(small, large)
+
+
+class TestAssetsResourceLinkedDevices(ApiTestCase):
+
+    def setUp(self):
+        super(TestAssetsResourceLinkedDevices, self).setUp()
+        venture = Venture.objects.create(name='venture', symbol='venture')
+        for _ in xrange(6):
+            asset = DCAssetFactory()
+            device = DeviceFactory(venture=venture)
+            asset.device_info.ralph_device_id = device.id
+            asset.device_info.save()
+
+    def test_linked_devices_are_resolved_per_page(self):
+        objects, small = self.get_list('assets', 2)
+        self.assertTrue(objects[0]['linked_device'])
+        self.assertTrue(objects[0]['venture'])
+        objects, large = self.get_list('assets', 6)
+        self.assertEqual(small, large)
+
+
+class TestUserAssignmentsResource(ApiTestCase):
+
+    def setUp(self):
+        super(TestUserAssignmentsResource, self).setUp()
+        # owners are created before users made by asset factories, so they
+        # are on the first page
+        for owner in [UserFactory() for _ in xrange(5)]:
+            for _ in xrange(2):
+                LicenceFactory().assign(BOAssetFactory(owner=owner))
+            LicenceFactory().assign(owner)
+
+    def test_queries_dont_depend_on_page_size(self):
+        objects, small = self.get_list('user_assignments', 2)
+        objects, large = self.get_list('user_assignments', 6)
+        assigned = [obj for obj in objects if obj['assets']]
+        self.assertEqual(len(assigned), 5)
+        self.assertEqual(len(assigned[0]['assets']), 2)
+        self.assertEqual(len(assigned[0]['assets'][0]['licences']), 1)
+        self.assertEqual(len(assigned[0]['licences']), 1)
+        self.assertEqual(small, large)
+
+
+class TestLicenceResource(ApiTestCase):
+
+    def setUp(self):
+        super(TestLicenceResource, self).setUp()
+        for _ in xrange(6):
+            LicenceFactory(parent=LicenceFactory(number_bought=1))
+
+    def test_queries_dont_depend_on_page_size(self):
+        objects, small = self.get_list('licence', 2)
+        self.assertTrue(objects[0]['software_category']['name'])
+        self.assertTrue(objects[0]['subtree_usage'])
+        objects, large = self.get_list('licence', 6)
+        self.assertEqual(small, large)
@@ -77,6 +77,99 @@ class TestImport(ClientMixin, TestCase):
                 getattr(updated_asset, field), new_value
             )
 
+    def test_bulk_update_writes_values_and_history(self):
+        assets = [BOAssetFactory(price=10) for _ in range(3)]
+        rows = '\n'.join(
+            '"{}","{}","{}"'.format(asset.id, 100 + idx, 'remark')
+            for idx, asset in enumerate(assets)
+        )
+        csv_data = '"id","price","remarks"\n' + rows
+        response = self._get_confirm_step_response(
+            csv_data, ['price', 'remarks'],
+        )
+        self.assertContains(response, 'step 3/3')
+        response = self.client.post(self.url, {
+            'xls_upload_view-current_step': 'confirm',
+        })
+        self.assertContains(response, 'Import done')
+        self.assertFalse(response.context['errors'])
+        for idx, asset in enumerate(assets):
+            updated_asset = Asset.objects.get(pk=asset.id)
+            self.assertEqual(updated_asset.price, 100 + idx)
+            self.assertEqual(updated_asset.remarks, 'remark')
+            self.assertEqual(
+                updated_asset.modified_by, self.user.get_profile(),
+            )
+            self.assertGreater(updated_asset.modified, asset.modified)
+            self.assertEqual(
+                updated_asset.get_history(field_name='modified_by').count(), 0,
+            )
+            history = updated_asset.get_history(field_name='price')
+            self.assertEqual(history.count(), 1)
+            self.assertEqual(history[0].new_value, '{}'.format(100 + idx))
+
+    def _get_confirm_step_response(self, csv_data, fields):
+        self.client.get(self.url)
+        step1_post = {
+            'upload-asset_type': AssetType.back_office.id,
+            'upload-model': 'ralph_assets.asset',
+            'upload-file': SimpleUploadedFile('test.csv', csv_data),
+            'xls_upload_view-current_step': 'upload',
+        }
+        self.client.post(self.url, step1_post)
+        step2_post = {
+            'xls_upload_view-current_step': 'column_choice',
+        }
+        step2_post.update({
+            'column_choice-{}'.format(field): field for field in fields
+        })
+        return self.client.post(self.url, step2_post)
+
+    def test_validation_report_shows_duplicates_and_collisions(self):
+        asset = BOAssetFactory()
+        csv_data = '"id","sn"\n"{}","{}"\n"{}","{}"'.format(
+            asset.id, 'sn-duplicated', asset.id + 1000, 'sn-duplicated',
+        )
+        response = self._get_confirm_step_response(csv_data, ['sn'])
+        self.assertContains(response, 'step 3/3')
+        errors = response.context['validation_errors']
+        messages = [error['message'] for error in errors]
+        self.assertTrue(
+            any(msg.startswith('Duplicated value') for msg in messages)
+        )
+        self.assertIn('Object doesn\'t exist.', messages)
+
+        other_asset = BOAssetFactory()
+        csv_data = '"id","sn"\n"{}","{}"'.format(asset.id, other_asset.sn)
+        response = self._get_confirm_step_response(csv_data, ['sn'])
+        errors = response.context['validation_errors']
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(errors[0]['column'], 'sn')
+        self.assertEqual(Asset.objects.get(pk=asset.id).sn, asset.sn)
+
+    def test_import_with_problems_is_blocked_unless_ignored(self):
+        asset = BOAssetFactory()
+        other_asset = BOAssetFactory()
+        csv_data = '"id","sn"\n"{}","{}"'.format(asset.id, other_asset.sn)
+        self._get_confirm_step_response(csv_data, ['sn'])
+        response = self.client.post(self.url, {
+            'xls_upload_view-current_step': 'confirm',
+        })
+        self.assertContains(response, 'step 3/3')
+        self.assertTrue(response.context['wizard']['form'].non_field_errors())
+        self.assertEqual(Asset.objects.get(pk=asset.id).sn, asset.sn)
+
+        csv_data = '"id","remarks"\n"{}","{}"\n"{}","{}"'.format(
+            asset.id, 'remark', asset.id + 1000, 'remark',
+        )
+        self._get_confirm_step_response(csv_data, ['remarks'])
+        response = self.client.post(self.url, {
+            'xls_upload_view-current_step': 'confirm',
+            'confirm-ignore_problems': 'on',
+        })
+        self.assertContains(response, 'Import done')
+        self.assertEqual(Asset.objects.get(pk=asset.id).remarks, 'remark')
+
 
 class TestDataImporter(object):
     SEP = ','
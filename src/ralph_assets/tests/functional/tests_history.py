@@ -153,6 +153,35 @@ class HistoryAssetsView(TestCase):
                 licence_history.new_value, '[{}]'.format(self.asset.id)
             )
 
+    def test_removed_licences_are_logged(self):
+        url = '/assets/back_office/edit/device/{}/'.format(self.asset.id)
+        attrs = dict(
+            self.bo_asset_params.items() + self.asset_change_params.items()
+        )
+        attrs.update({
+            'purpose': 2,
+            'licences': '|'.join(str(lic.pk) for lic in self.licences[1:]),
+        })
+        self.client.post(url, attrs, follow=True)
+        asset_history = self.asset.get_history(field_name='licences')[0]
+        self.assertEqual(
+            asset_history.new_value,
+            self.convert_to_list_str(attrs['licences']),
+        )
+        removed = self.licences[0]
+        self.assertEqual(
+            removed.get_history(field_name='assets')[0].new_value, '[]',
+        )
+        quantity_history = self.asset.get_history(
+            field_name='assigned_licence_quantity',
+        )[0]
+        self.assertEqual(
+            [quantity_history.old_value, quantity_history.new_value],
+            ['1', '-'],
+        )
+        self.assertEqual(quantity_history.user.username, 'ralph')
+        self.assertEqual(removed.assets.count(), 0)
+
     def test_change_required_support(self):
         asset = BOAssetFactory()
         url = reverse('device_edit', kwargs={
@@ -77,6 +77,24 @@ class TestFreeLicenceLookup(BaseLookupsTest):
             expected_count=1,
         )
 
+    def test_licence_found_by_niw_prefix(self):
+        LicenceFactory(niw='NIW-1')
+        LicenceFactory(niw='NIW-2')
+        LicenceFactory(niw='OTHER-NIW-3')
+        self._check_lookup_count(
+            self.base_url, searched_term='niw-', expected_count=2,
+        )
+
+    def test_used_licences_are_skipped(self):
+        used = LicenceFactory(niw='NIW-1', number_bought=5)
+        used.assign(BOAssetFactory(), quantity=5)
+        free = LicenceFactory(niw='NIW-2', number_bought=5)
+        free.assign(BOAssetFactory(), quantity=3)
+        full_url = "{}?{}".format(self.base_url, urlencode({'term': 'NIW-'}))
+        response = json.loads(self.client.get(full_url).content)
+        self.assertEqual([int(item['pk']) for item in response], [free.id])
+        self.assertIn('(2 free)', response[0]['repr'])
+
 
 class TestAssetLookup(BaseLookupsTest):
     lookup = ('ralph_assets.models', 'AssetLookup')
@@ -1257,6 +1257,27 @@ class TestSupportsView(TestRegions, BaseViewsTest):
         self._check_supports_assets(support, assets)
         check_fields(self, self.new_support_data.items(), support)
 
+    def test_list_counts_assets(self):
+        """Assets count is annotated by the list query and not changed by
+        searching by assigned assets."""
+        support = DCSupportFactory()
+        assets = [DCAssetFactory(), DCAssetFactory()]
+        support.assets.add(*assets)
+        response = self.client.get(self.listing_url(), {
+            'assets': '"{}"'.format(assets[0].sn),
+        })
+        rows = response.context['bob_page'].object_list
+        self.assertEqual([row.assets_count for row in rows], [2])
+
+    def test_list_expiring(self):
+        today = datetime.date.today()
+        expiring = DCSupportFactory(date_to=today + datetime.timedelta(5))
+        DCSupportFactory(date_to=today + datetime.timedelta(40))
+        DCSupportFactory(date_to=today - datetime.timedelta(1))
+        response = self.client.get(self.listing_url(), {'expiring': 30})
+        rows = response.context['bob_page'].object_list
+        self.assertEqual([row.id for row in rows], [expiring.id])
+
     def test_license_add_form_show_fields(self):
         required_fields = self.visible_add_form_fields[:]
         form_url = reverse('add_support')
@@ -1781,7 +1802,7 @@ class TestColumnsInSearch(BaseViewsTest):
         DCSupportFactory()
         correct_col_names = set([
             'Dropdown', 'Type', 'Contract id', 'Name', 'Date from', 'Date to',
-            'Price', 'Created',
+            'Price', 'Assets', 'Created',
         ])
         search_url = reverse('support_list')
         self.check_cols_presence(search_url, correct_col_names, mode=None)
@@ -2215,7 +2236,7 @@ class TestLicenceConnection(BaseViewsTest):
         """
         assigne asset with licence with custom quantity
         """
-        licence = LicenceFactory()
+        licence = LicenceFactory(number_bought=200)
         asset = AssetFactory()
         self.assertEqual(LicenceAsset.objects.count(), 0)
 
@@ -2238,7 +2259,7 @@ class TestLicenceConnection(BaseViewsTest):
         """
         update licences quantity
         """
-        licence_asset = LicenceAssetFactory()
+        licence_asset = LicenceAssetFactory(licence__number_bought=200)
         self.assertEqual(LicenceAsset.objects.count(), 1)
 
         rows = [
@@ -2276,11 +2297,32 @@ class TestLicenceConnection(BaseViewsTest):
         self.assertEqual(len(response.context_data['formset'].errors), 0)
         self.assertEqual(LicenceAsset.objects.count(), 0)
 
+    def test_assigned_to_assets_over_capacity(self):
+        """
+        assigning more licences than were bought is reported
+        """
+        licence = LicenceFactory(number_bought=10)
+        rows = [
+            {
+                'licence': licence.id,
+                'id': '',
+                'asset': AssetFactory().id,
+                'quantity': 11,
+            },
+        ]
+        url = reverse('licence_connections_assets', args=(licence.id,))
+        response = self.client.post(url, self.formset_dict(rows))
+        self.assertEqual(LicenceAsset.objects.count(), 0)
+        self.assertEqual(
+            len(response.context_data['formset'].non_form_errors()), 1,
+        )
+        self.assertEqual(Licence.objects.get(pk=licence.pk).used_quantity, 0)
+
     def test_assigned_to_users_simple_add(self):
         """
         assigne user with licence with custom quantity
         """
-        licence = LicenceFactory()
+        licence = LicenceFactory(number_bought=200)
         user = UserFactory()
         self.assertEqual(LicenceUser.objects.count(), 0)
 
@@ -2303,7 +2345,7 @@ class TestLicenceConnection(BaseViewsTest):
         """
         update licences quantity
         """
-        licence_user = LicenceUserFactory()
+        licence_user = LicenceUserFactory(licence__number_bought=200)
         self.assertEqual(LicenceUser.objects.count(), 1)
 
         rows = [
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from django.test import TestCase
+
+from ralph_assets.choices_cache import clear_choices_cache, get_choices_lookup
+from ralph_assets.history.utils import get_choices
+from ralph_assets.models_assets import Asset, AssetStatus
+
+
+class TestChoicesLookup(TestCase):
+
+    def setUp(self):
+        clear_choices_cache()
+
+    def test_lookup_tables(self):
+        lookup = get_choices_lookup(Asset, 'status')
+        self.assertEqual(
+            lookup.labels[AssetStatus.used.id], AssetStatus.used.desc,
+        )
+        self.assertEqual(lookup.ids['in use'], AssetStatus.used.id)
+        self.assertIs(get_choices_lookup(Asset, 'status'), lookup)
+
+    def test_history_get_choices(self):
+        asset = Asset()
+        self.assertEqual(
+            get_choices(asset, 'status', str(AssetStatus.damaged.id)),
+            AssetStatus.damaged.desc,
+        )
+        self.assertIsNone(get_choices(asset, 'status', 9999))
+        self.assertEqual(get_choices(asset, 'status', 'abc'), 'abc')
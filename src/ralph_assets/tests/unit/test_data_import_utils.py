@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import multiprocessing
+
+from django.test import TestCase
+from mock import patch
+
+from ralph_assets.data_import_utils import (
+    AssetModelResolver,
+    ImportValidator,
+    convert_rows,
+    get_field_spec,
+    resolve_names,
+)
+from ralph_assets.models_assets import (
+    Asset,
+    AssetCategory,
+    AssetCategoryType,
+    AssetManufacturer,
+    AssetModel,
+    AssetStatus,
+    AssetType,
+)
+from ralph_assets.tests.utils.assets import (
+    AssetCategoryFactory,
+    AssetManufacturerFactory,
+    AssetModelFactory,
+    BOAssetFactory,
+)
+
+
+class TestAssetModelResolver(TestCase):
+
+    def setUp(self):
+        self.category = AssetCategoryFactory()
+        self.existing_model = AssetModelFactory(
+            type=AssetType.back_office, category=self.category,
+        )
+        self.resolver = AssetModelResolver(
+            AssetType.back_office, AssetCategoryType.back_office,
+        )
+
+    def test_preload_uses_existing_and_creates_missing(self):
+        existing_key = (
+            self.existing_model.name,
+            self.category.name,
+            self.existing_model.manufacturer.name,
+        )
+        new_key = ('New model', self.category.name, 'New manufacturer')
+        self.resolver.preload([existing_key, new_key, new_key])
+
+        with self.assertNumQueries(0):
+            model = self.resolver.get(*existing_key)
+            new_model = self.resolver.get(*new_key)
+        self.assertEqual(model, self.existing_model)
+        self.assertEqual(new_model.manufacturer.name, 'New manufacturer')
+        self.assertEqual(new_model.category, self.category)
+        self.assertEqual(
+            AssetModel.objects.filter(name='New model').count(), 1,
+        )
+        self.assertEqual(
+            AssetManufacturer.objects.filter(name='New manufacturer').count(),
+            1,
+        )
+
+    def test_get_raises_on_missing_category(self):
+        self.resolver.preload([('Model', 'Missing category', None)])
+        with self.assertRaises(AssetCategory.DoesNotExist):
+            self.resolver.get('Model', 'Missing category')
+        self.assertFalse(AssetModel.objects.filter(name='Model').exists())
+
+
+class TestResolveNames(TestCase):
+
+    def test_resolves_case_insensitively_in_one_query(self):
+        manufacturer = AssetManufacturerFactory(name='Manufacturer')
+        values = ['MANUFACTURER', 'Missing'] + [
+            'Misspelled #{}'.format(i) for i in xrange(10)
+        ]
+        with self.assertNumQueries(1):
+            found = resolve_names(AssetManufacturer, values)
+        self.assertEqual(found, set([manufacturer.name.lower()]))
+
+
+class TestImportValidator(TestCase):
+
+    def test_unique_values_are_compared_normalized(self):
+        asset = BOAssetFactory(sn='Sn-Abc ')
+        validator = ImportValidator(Asset, {'sn': 'sn'})
+        errors = validator.validate({}, {'sheet': [
+            {'sn': ' sn-ABC'}, {'sn': 'SN-ABC'}, {'sn': 'other'},
+        ]})
+        # both rows collide with the asset, the second one duplicates the
+        # first one
+        self.assertEqual(
+            sorted(
+                (error['row'], error['message'].split()[0])
+                for error in errors
+            ),
+            [
+                ('sheet #2', 'Value'),
+                ('sheet #3', 'Duplicated'),
+                ('sheet #3', 'Value'),
+            ],
+        )
+        self.assertIn('id {}'.format(asset.id), errors[-1]['message'])
+
+
+class TestConvertRows(TestCase):
+
+    def setUp(self):
+        self.specs = {
+            'price': get_field_spec(Asset._meta.get_field('price')),
+            'status': get_field_spec(Asset._meta.get_field('status')),
+            'invoice-date': get_field_spec(
+                Asset._meta.get_field('invoice_date'),
+            ),
+        }
+        self.rows = [
+            {'price': '10,5', 'status': 'In Use', 'invoice-date': ''},
+            {'price': '', 'status': 'damaged', 'other': 'x'},
+        ]
+        self.expected = [
+            (
+                {
+                    'price': '10.5',
+                    'status': AssetStatus.used.id,
+                    'invoice-date': None,
+                },
+                None,
+            ),
+            (
+                {
+                    'price': None,
+                    'status': AssetStatus.damaged.id,
+                    'other': 'x',
+                },
+                None,
+            ),
+        ]
+
+    def test_convert_in_process(self):
+        self.assertEqual(convert_rows(self.specs, self.rows), self.expected)
+
+    @patch('ralph_assets.data_import_utils.IMPORT_POOL_MIN_ROWS', 1)
+    def test_convert_in_pool(self):
+        self.assertEqual(convert_rows(self.specs, self.rows), self.expected)
+        # workers are started for one conversion
+        self.assertEqual(multiprocessing.active_children(), [])
+
+    @patch('ralph_assets.data_import_utils.IMPORT_POOL_MIN_ROWS', 1)
+    def test_validator_reports_invalid_values(self):
+        validator = ImportValidator(Asset, {
+            'invoice-date': 'invoice_date',
+            'price': 'price',
+        })
+        errors = validator.validate({}, {'sheet': [
+            {'invoice-date': '2014-02-30', 'price': '1'},
+            {'invoice-date': '2014-02-28', 'price': '1'},
+        ]})
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(errors[0]['row'], 'sheet #2')
+        self.assertEqual(errors[0]['column'], 'invoice_date')
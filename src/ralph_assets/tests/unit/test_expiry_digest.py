@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import csv
+import datetime
+import json
+import os
+import shutil
+import tempfile
+
+from django.test import TestCase
+
+from ralph_assets.expiry_digest import NO_OWNER, get_expiring, write_digest
+from ralph_assets.tests.utils import UserFactory
+from ralph_assets.tests.utils.assets import DCAssetFactory
+from ralph_assets.tests.utils.licences import LicenceFactory
+from ralph_assets.tests.utils.supports import DCSupportFactory
+
+
+class TestExpiryDigest(TestCase):
+    def setUp(self):
+        self.today = datetime.date(2014, 11, 1)
+        self.owner = UserFactory(username='owner')
+        self.expires = self.today + datetime.timedelta(days=10)
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def add_contracts(self, count):
+        for _ in xrange(count):
+            asset = DCAssetFactory(owner=self.owner)
+            support = DCSupportFactory(date_to=self.expires)
+            support.assets.add(asset)
+            licence = LicenceFactory(valid_thru=self.expires)
+            licence.assign(asset)
+            licence.assign(UserFactory())
+
+    def test_groups_by_owner(self):
+        self.add_contracts(1)
+        DCSupportFactory(date_to=self.expires)
+        DCSupportFactory(date_to=self.today + datetime.timedelta(days=40))
+        LicenceFactory(valid_thru=self.today - datetime.timedelta(days=1))
+        digest = get_expiring(30, self.today)
+        self.assertEqual(
+            sorted(row['type'] for row in digest[self.owner.username]),
+            ['licence', 'support'],
+        )
+        # contract without assets
+        self.assertEqual(
+            [row['type'] for row in digest[NO_OWNER]], ['support'],
+        )
+        # the licence assigned to a user
+        self.assertEqual(len(digest), 3)
+
+    def test_constant_number_of_queries(self):
+        self.add_contracts(1)
+        with self.assertNumQueries(5):
+            get_expiring(30, self.today)
+        self.add_contracts(5)
+        with self.assertNumQueries(5):
+            digest = get_expiring(30, self.today)
+        self.assertEqual(len(digest[self.owner.username]), 12)
+
+    def test_skips_soft_deleted(self):
+        self.add_contracts(1)
+        DCSupportFactory(date_to=self.expires, deleted=True)
+        asset = DCAssetFactory(owner=self.owner)
+        DCSupportFactory(date_to=self.expires).assets.add(asset)
+        LicenceFactory(valid_thru=self.expires).assign(asset)
+        asset.deleted = True
+        asset.save()
+        digest = get_expiring(30, self.today)
+        # the deleted support isn't listed, contracts of the deleted asset
+        # are listed without it
+        self.assertEqual(len(digest[self.owner.username]), 2)
+        self.assertEqual(
+            sorted(row['type'] for row in digest[NO_OWNER]),
+            ['licence', 'support'],
+        )
+
+    def test_write_digest(self):
+        self.add_contracts(2)
+        digest = get_expiring(30, self.today)
+        directory = write_digest(digest, self.directory, 'csv', self.today)
+        with open(os.path.join(
+            directory, '{}.csv'.format(self.owner.username),
+        )) as f:
+            rows = list(csv.DictReader(f))
+        self.assertEqual(len(rows), 4)
+        self.assertEqual(rows[0]['expires'], str(self.expires))
+        directory = write_digest(digest, self.directory, 'json', self.today)
+        with open(os.path.join(
+            directory, '{}.json'.format(self.owner.username),
+        )) as f:
+            self.assertEqual(len(json.load(f)), 4)
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import datetime
+
+from django.core.management import call_command
+from django.test import TestCase
+
+from ralph_assets.history.models import History, HistoryArchive
+from ralph_assets.tests.utils.assets import AssetFactory
+
+
+class TestHistoryArchive(TestCase):
+
+    def setUp(self):
+        self.asset = AssetFactory()
+        for sn in ('old-1', 'old-2'):
+            self.asset.sn = sn
+            self.asset.save()
+        now = datetime.datetime.now()
+        for days, history in enumerate(self.asset.get_history(), 100):
+            History.objects.filter(pk=history.pk).update(
+                date=now - datetime.timedelta(days=days),
+            )
+        self.asset.remarks = 'new'
+        self.asset.save()
+
+    def test_old_history_is_archived(self):
+        call_command('archive_history', months=2)
+        self.assertEqual(
+            [h.field_name for h in self.asset.get_history()], ['remarks'],
+        )
+        self.assertEqual(HistoryArchive.objects.count(), 1)
+
+    def test_archived_history_is_read_transparently(self):
+        expected = list(self.asset.get_history())
+        call_command('archive_history', months=2)
+        history = self.asset.get_history(archived=True)
+        self.assertEqual(history.count(), 3)
+        self.assertEqual(
+            [(h.field_name, h.new_value, h.date) for h in history],
+            [(h.field_name, h.new_value, h.date) for h in expected],
+        )
+        self.assertEqual(
+            [h.new_value for h in history[1:3]], ['old-2', 'old-1'],
+        )
+        self.assertEqual(history[0].new_value, 'new')
+        self.assertEqual(
+            [
+                h.new_value
+                for h in self.asset.get_history(
+                    field_name='sn', archived=True,
+                )
+            ],
+            ['old-2', 'old-1'],
+        )
+        self.assertFalse(History.objects.filter(field_name='sn').exists())
+
+    def test_latest_history_reads_archive_only_when_asked(self):
+        call_command('archive_history', months=2)
+        asset = type(self.asset).objects.get(pk=self.asset.pk)
+        with self.assertNumQueries(1):
+            latest = asset.get_latest_history(3)
+        self.assertEqual([h.new_value for h in latest], ['new'])
+        self.assertEqual(
+            [h.new_value for h in asset.get_latest_history(3, archived=True)],
+            ['new', 'old-2', 'old-1'],
+        )
+        with self.assertNumQueries(1):
+            History.objects.prefetch_latest([asset], 3)
+        self.assertEqual(len(asset.get_latest_history(3)), 1)
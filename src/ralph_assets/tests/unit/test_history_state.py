@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import datetime
+
+from django.test import TestCase
+
+from ralph_assets.history.state import (
+    get_current_states,
+    get_state_at,
+    get_states_at,
+    take_snapshots,
+)
+from ralph_assets.models_assets import Asset
+from ralph_assets.tests.utils.assets import AssetFactory, AssetModelFactory
+
+
+class TestHistoryState(TestCase):
+
+    def setUp(self):
+        self.date = datetime.datetime.now()
+        self.asset = Asset.objects.get(pk=AssetFactory(remarks='old').pk)
+        self.before = get_current_states([self.asset])[self.asset.pk]
+        self.asset.remarks = 'new'
+        self.asset.model = AssetModelFactory()
+        self.asset.save()
+        self.asset.get_history().update(
+            date=self.date + datetime.timedelta(hours=1),
+        )
+
+    def test_state_before_changes(self):
+        state = get_state_at(self.asset, self.date)
+        self.assertEqual(state, self.before)
+        self.assertEqual(state['remarks'], 'old')
+
+    def test_state_after_changes(self):
+        state = get_state_at(
+            self.asset, self.date + datetime.timedelta(hours=2),
+        )
+        self.assertEqual(state['remarks'], 'new')
+        self.assertEqual(state['model'], unicode(self.asset.model))
+
+    def test_state_from_snapshot(self):
+        take_snapshots(
+            [self.asset], self.date + datetime.timedelta(hours=2),
+        )
+        # not recorded in the history, so only the snapshot knows the state
+        # before it
+        Asset.objects.filter(pk=self.asset.pk).update(remarks='untracked')
+        later = self.date + datetime.timedelta(minutes=90)
+        self.assertEqual(get_state_at(self.asset, later)['remarks'], 'new')
+        self.assertEqual(get_state_at(self.asset, self.date), self.before)
+
+    def test_states_of_queryset(self):
+        other = AssetFactory(remarks='other')
+        states = get_states_at(
+            Asset.objects.filter(pk__in=[self.asset.pk, other.pk]),
+            self.date,
+        )
+        self.assertEqual(states[self.asset.pk], self.before)
+        self.assertEqual(states[other.pk]['remarks'], 'other')
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from django.contrib.contenttypes.models import ContentType
+from django.test import TestCase
+from mock import patch
+
+from ralph_assets.models import Asset, ChangeOperation, Licence, OutboxEntry
+from ralph_assets.tests.utils.assets import BOAssetFactory
+from ralph_assets.tests.utils.licences import LicenceFactory
+
+
+@patch('ralph_assets.models_outbox.OUTBOX_LAG', 0)
+class TestOutbox(TestCase):
+    def setUp(self):
+        self.asset = BOAssetFactory()
+        self.licence = LicenceFactory()
+        self.sequence = OutboxEntry.objects.order_by('-id')[0].sequence
+
+    def test_save_logs_change(self):
+        self.asset.remarks = 'changed'
+        self.asset.save()
+        entries = list(OutboxEntry.objects.since(self.sequence))
+        self.assertEqual(len(entries), 1)
+        change = entries[0].to_dict()
+        self.assertEqual(change['sequence'], entries[0].id)
+        self.assertEqual(change['model'], 'ralph_assets.asset')
+        self.assertEqual(change['object_id'], self.asset.id)
+        self.assertEqual(change['operation'], 'updated')
+        self.assertEqual(change['data']['remarks'], 'changed')
+
+    def test_create_and_delete_are_logged(self):
+        self.assertTrue(OutboxEntry.objects.filter(
+            content_type=ContentType.objects.get_for_model(Licence),
+            object_id=self.licence.id,
+            operation=ChangeOperation.created,
+        ).exists())
+        licence_id = self.licence.id
+        self.licence.delete()
+        entry = OutboxEntry.objects.since(self.sequence)[0]
+        self.assertEqual(entry.object_id, licence_id)
+        self.assertEqual(entry.operation, ChangeOperation.deleted)
+
+    def test_since_reads_after_sequence(self):
+        self.asset.save()
+        self.licence.save()
+        entries = list(OutboxEntry.objects.since(self.sequence))
+        self.assertEqual(
+            [entry.content_type.model_class() for entry in entries],
+            [Asset, Licence],
+        )
+        self.assertEqual(
+            list(OutboxEntry.objects.since(self.sequence, limit=1)),
+            entries[:1],
+        )
+        self.assertFalse(OutboxEntry.objects.since(entries[-1].sequence))
+
+    def test_assignments_log_licence_changes(self):
+        self.licence.assign(self.asset)
+        entries = list(OutboxEntry.objects.since(self.sequence))
+        self.assertEqual(entries[-1].object_id, self.licence.id)
+        self.assertEqual(
+            entries[-1].to_dict()['data']['used_quantity'], 1,
+        )
+        self.licence.detach_many([self.asset])
+        entry = list(OutboxEntry.objects.since(entries[-1].sequence))[-1]
+        self.assertEqual(entry.to_dict()['data']['used_quantity'], 0)
+
+    def test_recent_changes_wait_for_lag(self):
+        self.asset.save()
+        self.assertFalse(OutboxEntry.objects.since(self.sequence, lag=60))
+        self.assertTrue(OutboxEntry.objects.since(self.sequence, lag=0))
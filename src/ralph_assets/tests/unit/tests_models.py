@@ -6,16 +6,37 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import datetime
+import json
 from unittest import skip
 
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management import call_command
+from django.db import transaction
 from django.test import TestCase
+from mock import patch
 
 from ralph.business.models import Venture
 from ralph.discovery.models_device import Device, DeviceType
 
 from ralph_assets.api_pricing import get_assets, get_asset_parts
-from ralph_assets.models_assets import AssetStatus, PartInfo, Rack
-from ralph_assets.licences.models import LicenceAsset, Licence, WrongModelError
+from ralph_assets.history.models import History
+from ralph_assets.history.utils import (
+    context,
+    deferred_history,
+    history_scope,
+)
+from ralph_assets.models_assets import Asset, AssetStatus, PartInfo, Rack
+from ralph_assets.licences.models import (
+    LicenceAsset,
+    LicenceUser,
+    Licence,
+    NotEnoughLicencesError,
+    WrongModelError,
+    get_subtree_usages,
+    get_summary,
+)
+from ralph_assets.tests.utils import UserFactory
 from ralph_assets.tests.utils.assets import (
     AssetSubCategoryFactory,
     AssetModelFactory,
@@ -106,6 +127,37 @@ class TestModelAsset(TestCase):
         self.assertEqual(self.asset2.venture, None)
         self.assertEqual(asset_without_device.venture, None)
 
+    def test_linked_device_is_memoized(self):
+        asset = Asset.objects.select_related('device_info').get(
+            pk=self.asset.pk,
+        )
+        with self.assertNumQueries(1):
+            self.assertEqual(asset.linked_device, self.dev1)
+            self.assertEqual(asset.linked_device, self.dev1)
+        asset.device_info.ralph_device_id = 667
+        with self.assertNumQueries(1):
+            self.assertEqual(asset.linked_device.id, 667)
+
+    def test_prefetch_linked_devices(self):
+        venture = Venture.objects.create(name='v1')
+        self.dev1.venture = venture
+        self.dev1.save()
+        dev2 = Device.objects.get(pk=667)
+        asset_without_device = AssetFactory(device_info=None)
+        assets = list(Asset.objects.select_related('device_info').filter(
+            pk__in=[self.asset.pk, self.asset2.pk, asset_without_device.pk],
+        ).order_by('pk'))
+        with self.assertNumQueries(1):
+            Asset.prefetch_linked_devices(assets)
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                [asset.linked_device for asset in assets],
+                [self.dev1, dev2, None],
+            )
+            self.assertEqual(
+                [asset.venture for asset in assets], [venture, None, None],
+            )
+
     def test_in_use_status(self):
         self.assertEqual(AssetStatus.used.desc, 'in use')
 
@@ -202,6 +254,219 @@ class TestModelLicences(TestCase):
         with self.assertRaises(Exception):
             self.licence.assign(obj=asset2, quantity=1)
 
+    def test_used_quantity_is_stored(self):
+        """Usage of assets and users is stored on the licence."""
+        asset = AssetFactory()
+        user = UserFactory()
+        self.licence.assign(obj=asset, quantity=3)
+        self.licence.assign(obj=user, quantity=2)
+        licence = Licence.objects.get(pk=self.licence.pk)
+        self.assertEqual(licence.used_quantity, 5)
+        self.assertEqual(licence.free, licence.number_bought - 5)
+        with self.assertNumQueries(0):
+            licence.used
+
+    def test_used_quantity_after_deletions(self):
+        """Deletions of querysets and cascades decrease usage."""
+        assets = [AssetFactory() for _ in xrange(3)]
+        for asset in assets:
+            self.licence.assign(obj=asset, quantity=2)
+        LicenceAsset.objects.filter(asset=assets[0]).delete()
+        assets[1].delete()
+        licence = Licence.objects.get(pk=self.licence.pk)
+        self.assertEqual(licence.used_quantity, 2)
+
+    def test_save_keeps_used_quantity(self):
+        """Saving a licence loaded before an assignment doesn't overwrite
+        its usage."""
+        licence = Licence.objects.get(pk=self.licence.pk)
+        self.licence.assign(obj=AssetFactory(), quantity=4)
+        licence.remarks = 'changed'
+        licence.save()
+        self.assertEqual(
+            Licence.objects.get(pk=self.licence.pk).used_quantity, 4,
+        )
+
+    def test_stale_assignment_updates_used_quantity(self):
+        """Quantities are diffed against the stored assignment, not the
+        loaded one."""
+        asset = AssetFactory()
+        self.licence.assign(obj=asset, quantity=2)
+        stale = LicenceAsset.objects.get(licence=self.licence, asset=asset)
+        self.licence.assign(obj=asset, quantity=5)
+        stale.quantity = 3
+        stale.save()
+        self.assertEqual(
+            Licence.objects.get(pk=self.licence.pk).used_quantity, 3,
+        )
+        self.licence.assign(obj=asset, quantity=4)
+        stale.delete()
+        self.assertEqual(
+            Licence.objects.get(pk=self.licence.pk).used_quantity, 0,
+        )
+
+    def test_unchanged_assignment_isnt_locked(self):
+        """Saving an assignment reads the stored one only when its quantity
+        or licence changed."""
+        self.licence.assign(obj=AssetFactory(), quantity=2)
+        assignment = LicenceAsset.objects.get(licence=self.licence)
+        with self.assertNumQueries(2):
+            # the row is checked and updated by Django
+            assignment.save()
+        assignment.quantity = 3
+        with self.assertNumQueries(5):
+            # stored row, Django's check, update, counter, outbox
+            assignment.save()
+        self.assertEqual(
+            Licence.objects.get(pk=self.licence.pk).used_quantity, 3,
+        )
+
+    def test_moved_assignment_updates_both_licences(self):
+        other = LicenceFactory(number_bought=10)
+        self.licence.assign(obj=AssetFactory(), quantity=2)
+        assignment = LicenceAsset.objects.get(licence=self.licence)
+        assignment.licence = other
+        assignment.save()
+        self.assertEqual(
+            Licence.objects.get(pk=self.licence.pk).used_quantity, 0,
+        )
+        self.assertEqual(Licence.objects.get(pk=other.pk).used_quantity, 2)
+
+    def test_save_with_pk_of_existing_licence(self):
+        """An unsaved instance with the pk of a stored licence updates it
+        without overwriting its usage."""
+        self.licence.assign(obj=AssetFactory(), quantity=4)
+        licence = Licence.objects.get(pk=self.licence.pk)
+        licence._state.adding = True
+        licence.remarks = 'changed'
+        licence.used_quantity = 0
+        licence.save()
+        licence = Licence.objects.get(pk=self.licence.pk)
+        self.assertEqual(licence.remarks, 'changed')
+        self.assertEqual(licence.used_quantity, 4)
+
+    def test_repair_used_quantity(self):
+        self.licence.assign(obj=AssetFactory(), quantity=4)
+        Licence.objects.filter(pk=self.licence.pk).update(used_quantity=1)
+        call_command('repair_licence_usage')
+        self.assertEqual(
+            Licence.objects.get(pk=self.licence.pk).used_quantity, 4,
+        )
+
+    def test_assign_many(self):
+        """Assignments are diffed against existing ones and written in bulk,
+        with history of changed ones."""
+        self.licence.number_bought = 100
+        self.licence.save()
+        assets = [AssetFactory() for _ in xrange(3)]
+        self.licence.assign(assets[0], quantity=2)
+        self.licence.assign(assets[1], quantity=5)
+        History.objects.all().delete()
+        self.licence.assign_many({assets[0]: 2, assets[1]: 1, assets[2]: 4})
+        self.assertEqual(
+            dict(LicenceAsset.objects.values_list('asset', 'quantity')),
+            {assets[0].id: 2, assets[1].id: 1, assets[2].id: 4},
+        )
+        self.assertEqual(
+            Licence.objects.get(pk=self.licence.pk).used_quantity, 7,
+        )
+        self.assertEqual(self.licence.used_quantity, 7)
+        self.assertEqual(
+            sorted(History.objects.values_list(
+                'object_id', 'old_value', 'new_value',
+            )),
+            sorted([
+                (assets[1].id, '5', '1'), (assets[2].id, '-', '4'),
+            ]),
+        )
+
+    def test_assign_many_queries_dont_grow(self):
+        self.licence.number_bought = 100
+        self.licence.save()
+        users = [UserFactory() for _ in xrange(20)]
+        ContentType.objects.get_for_model(users[0])
+        with self.assertNumQueries(6):
+            # existing assignments, capacity, insert, counter, outbox,
+            # history
+            self.licence.assign_many(dict.fromkeys(users, 2))
+        self.assertEqual(LicenceUser.objects.count(), 20)
+
+    def test_assign_many_checks_capacity(self):
+        self.licence.number_bought = 5
+        self.licence.save()
+        assets = [AssetFactory() for _ in xrange(3)]
+        with self.assertRaises(NotEnoughLicencesError):
+            self.licence.assign_many(dict.fromkeys(assets, 2))
+        self.assertEqual(LicenceAsset.objects.count(), 0)
+        self.licence.assign_many(
+            dict.fromkeys(assets, 2), check_capacity=False,
+        )
+        self.assertEqual(self.licence.free, -1)
+
+    def test_detach_many(self):
+        assets = [AssetFactory() for _ in xrange(3)]
+        for asset in assets:
+            self.licence.assign(asset, quantity=3)
+        self.licence.detach_many(assets[:2] + [AssetFactory()])
+        self.assertEqual(
+            list(LicenceAsset.objects.values_list('asset', flat=True)),
+            [assets[2].id],
+        )
+        self.assertEqual(
+            Licence.objects.get(pk=self.licence.pk).used_quantity, 3,
+        )
+        self.assertEqual(self.licence.used_quantity, 3)
+
+    @patch('ralph_assets.licences.models.cache', LocMemCache('subtree', {}))
+    def test_subtree_usage(self):
+        """Usage of a licence with its descendants is summed in one query
+        and cached until assignments change."""
+        child = LicenceFactory(parent=self.licence, number_bought=10)
+        grandchild = LicenceFactory(parent=child, number_bought=5)
+        other = LicenceFactory(parent=self.licence, number_bought=1)
+        child.assign(AssetFactory(), quantity=3)
+        grandchild.assign(UserFactory(), quantity=2)
+        licence, child = Licence.objects.filter(
+            pk__in=[self.licence.pk, child.pk],
+        ).order_by('lft')
+        bought = licence.number_bought + 16
+        with self.assertNumQueries(1):
+            usages = get_subtree_usages([licence, child])
+        self.assertEqual(usages, {
+            licence.pk: {'bought': bought, 'used': 5, 'free': bought - 5},
+            child.pk: {'bought': 15, 'used': 5, 'free': 10},
+        })
+        self.assertEqual(licence.subtree_usage, usages[licence.pk])
+        with self.assertNumQueries(0):
+            licence.subtree_usage
+            other.subtree_usage
+        other.assign(AssetFactory(), quantity=1)
+        self.assertEqual(licence.subtree_usage['used'], 6)
+
+    @patch('ralph_assets.licences.models.cache', LocMemCache('summary', {}))
+    def test_summary(self):
+        """Summary is computed by one query, without multiplying quantities
+        by joined rows, and cached until assignments change."""
+        licence = LicenceFactory()
+        for _ in xrange(2):
+            self.licence.assign(AssetFactory(), quantity=3)
+            self.licence.assign(UserFactory(), quantity=2)
+        licences = Licence.objects.filter(
+            pk__in=[self.licence.pk, licence.pk],
+        )
+        expected = {
+            'total': self.licence.number_bought + licence.number_bought,
+            'used_by_assets': 6,
+            'used_by_users': 4,
+        }
+        with self.assertNumQueries(1):
+            self.assertEqual(get_summary(licences), expected)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_summary(licences), expected)
+        licence.assign(AssetFactory(), quantity=1)
+        expected['used_by_assets'] = 7
+        self.assertEqual(get_summary(licences), expected)
+
 
 class TestApiAssets(TestCase):
     def setUp(self):
@@ -286,6 +551,195 @@ class TestModelHistory(TestCase):
             licence.assign(asset, i + 1)
             self.assertEqual(i + 3, history.count())
 
+    def test_nested_saves_diff_against_own_snapshot(self):
+        outer = AssetFactory()
+        inner = AssetFactory()
+        context.start(Asset, outer)
+        inner.remarks = 'inner remarks'
+        inner.save()
+        outer.remarks = 'outer remarks'
+        Asset.objects.filter(pk=outer.pk).update(remarks=outer.remarks)
+        context.end(outer)
+        self.assertEqual(
+            [h.new_value for h in outer.get_history(field_name='remarks')],
+            ['outer remarks'],
+        )
+        self.assertEqual(
+            [h.new_value for h in inner.get_history(field_name='remarks')],
+            ['inner remarks'],
+        )
+        self.assertEqual(context.frames, [])
+
+    def test_frames_of_failed_saves_are_dropped(self):
+        asset = AssetFactory()
+        failed = AssetFactory()
+        context.start(Asset, asset)
+        context.start(Asset, failed)
+        asset.remarks = 'new remarks'
+        Asset.objects.filter(pk=asset.pk).update(remarks=asset.remarks)
+        context.end(asset)
+        self.assertEqual(context.frames, [])
+        self.assertEqual(asset.get_history(field_name='remarks').count(), 1)
+        self.assertEqual(failed.get_history().count(), 0)
+
+        context.start(Asset, failed)
+        context.reset()
+        self.assertEqual(context.frames, [])
+
+    def test_save_diffs_against_loaded_state(self):
+        asset = Asset.objects.get(pk=AssetFactory().pk)
+        old_sn = asset.sn
+        old_model = unicode(asset.model)
+        # changed behind the loaded object's back - not a change made by it
+        Asset.objects.filter(pk=asset.pk).update(remarks='changed in db')
+        asset.sn = 'new-sn'
+        asset.model = AssetModelFactory()
+        asset.save()
+        history = dict(
+            (h.field_name, (h.old_value, h.new_value))
+            for h in asset.get_history()
+        )
+        self.assertEqual(
+            history,
+            {
+                'sn': (old_sn, 'new-sn'),
+                'model': (old_model, unicode(asset.model)),
+            },
+        )
+        asset.sn = 'newer-sn'
+        asset.model = AssetModelFactory()
+        # labels are taken from the loaded and the cached model, nothing is
+        # selected - the only query inserts the history
+        with self.assertNumQueries(1):
+            context.start(Asset, asset)
+            context.end(asset)
+        self.assertEqual(
+            asset.get_history(field_name='sn')[0].old_value, 'new-sn',
+        )
+
+    def test_deferred_history_is_written_at_the_end(self):
+        assets = [AssetFactory(), AssetFactory()]
+        with deferred_history():
+            for asset in assets:
+                asset.remarks = 'deferred'
+                asset.save()
+            with deferred_history():
+                assets[0].sn = 'nested'
+                assets[0].save()
+            for asset in assets:
+                self.assertEqual(asset.get_history().count(), 0)
+        self.assertEqual(assets[0].get_history().count(), 2)
+        self.assertEqual(assets[1].get_history().count(), 1)
+        self.assertEqual(context.pending, None)
+
+    def test_deferred_history_is_dropped_on_error(self):
+        asset = AssetFactory()
+        with self.assertRaises(ValueError):
+            with deferred_history():
+                asset.remarks = 'dropped'
+                asset.save()
+                raise ValueError()
+        with deferred_history():
+            asset.sn = 'kept'
+            asset.save()
+            try:
+                with deferred_history():
+                    asset.remarks = 'dropped too'
+                    asset.save()
+                    raise ValueError()
+            except ValueError:
+                pass
+        self.assertEqual(
+            [h.field_name for h in asset.get_history()], ['sn'],
+        )
+
+    @patch('ralph_assets.history.utils.HISTORY_QUEUE', 'history')
+    def test_deferred_history_is_written_in_the_transaction(self):
+        asset = AssetFactory()
+        with transaction.commit_on_success(), deferred_history():
+            asset.remarks = 'in transaction'
+            asset.save()
+        # joined the caller's transaction - written in place, not handed to
+        # the queue
+        self.assertEqual(asset.get_history().count(), 1)
+
+    @patch('ralph_assets.history.utils.HISTORY_QUEUE', 'history')
+    @patch('ralph_assets.history.utils.enqueue_history')
+    def test_deferred_history_is_queued_after_commit(self, enqueue):
+        asset = AssetFactory()
+        with patch('django.db.transaction.is_managed', return_value=False):
+            with deferred_history():
+                asset.remarks = 'queued'
+                asset.save()
+                self.assertFalse(enqueue.called)
+            with self.assertRaises(ValueError):
+                with deferred_history():
+                    asset.remarks = 'rolled back'
+                    asset.save()
+                    raise ValueError()
+        self.assertEqual(asset.get_history().count(), 0)
+        self.assertEqual(enqueue.call_count, 1)
+        entries = enqueue.call_args[0][0]
+        self.assertEqual(
+            [entry.new_value for entry in entries], ['queued'],
+        )
+
+    def test_m2m_history_uses_last_known_set(self):
+        support = DCSupportFactory()
+        first, second = AssetFactory(), AssetFactory()
+        with deferred_history():
+            support.assets.add(first)
+            # history of the first change isn't written yet, the previous
+            # set comes from the cache
+            support.assets.add(second)
+        self.assertEqual(
+            sorted(
+                (
+                    sorted(json.loads(h.old_value)),
+                    sorted(json.loads(h.new_value)),
+                )
+                for h in support.get_history(field_name='assets')
+            ),
+            [([], [first.pk]), ([first.pk], [first.pk, second.pk])],
+        )
+
+    def test_m2m_state_is_dropped_with_deferred_history(self):
+        support = DCSupportFactory()
+        asset = AssetFactory()
+        with self.assertRaises(ValueError):
+            with deferred_history():
+                support.assets.add(asset)
+                raise ValueError()
+        self.assertEqual(context.m2m_states, {})
+
+    def test_history_scope_resets_context(self):
+        support = DCSupportFactory()
+        with history_scope():
+            with history_scope():
+                support.assets.add(AssetFactory())
+            self.assertTrue(context.m2m_states)
+        self.assertEqual(context.m2m_states, {})
+        self.assertEqual(context.labels, {})
+        self.assertEqual(context.scopes, 0)
+
+    def test_prefetch_latest_history(self):
+        user = UserFactory()
+        assets = [AssetFactory(), AssetFactory(), AssetFactory()]
+        for asset in assets:
+            for remarks in ('first', 'second', 'third'):
+                asset.remarks = remarks
+                asset.save(user=user)
+        with self.assertNumQueries(1):
+            History.objects.prefetch_latest(assets, limit=2)
+        with self.assertNumQueries(0):
+            for asset in assets:
+                history = asset.get_latest_history(2)
+                self.assertEqual(
+                    [(h.new_value, h.user) for h in history],
+                    [('third', user), ('second', user)],
+                )
+                self.assertEqual(len(asset.get_latest_history(1)), 1)
+
 
 class TestModelRack(TestCase):
     def test_free_u(self):
@@ -5,11 +5,14 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import time
 from functools import partial
 
 from factory import Sequence, SubFactory
 from factory.django import DjangoModelFactory, FileField
 
+from django.core.signals import request_started
+from django.db import connection, reset_queries
 from django.test.client import Client
 
 from ralph.ui.tests.global_utils import UserFactory
@@ -26,6 +29,25 @@ class AttachmentFactory(DjangoModelFactory):
     uploaded_by = SubFactory(UserFactory)
 
 
+class QueryCounter(object):
+    """Count queries and measure wall time of the block, including requests
+    made by the test client (which would reset the list of queries)."""
+
+    def __enter__(self):
+        self.use_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        request_started.disconnect(reset_queries)
+        self.start = len(connection.queries)
+        self.started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.time = time.time() - self.started
+        self.count = len(connection.queries) - self.start
+        request_started.connect(reset_queries)
+        connection.use_debug_cursor = self.use_debug_cursor
+
+
 class AdminFactory(UserFactory):
     is_staff = True
     is_superuser = True
@@ -15,6 +15,7 @@ from ralph_assets.api import (
     AssetModelResource,
     AssetOwnerResource,
     AssetsResource,
+    ChangesResource,
     LicenceResource,
     LicenceTypeResource,
     ServiceResource,
@@ -59,6 +60,7 @@ for r in (
     AssetModelResource,
     AssetOwnerResource,
     AssetsResource,
+    ChangesResource,
     LicenceResource,
     LicenceTypeResource,
     ServiceResource,
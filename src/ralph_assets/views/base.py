@@ -26,6 +26,7 @@ from ralph.ui.views.common import MenuMixin
 from ralph.account.models import Perm, ralph_permission
 from ralph_assets import forms as assets_forms
 from ralph_assets.app import Assets as app
+from ralph_assets.history.utils import deferred_history
 from ralph_assets.models_assets import AssetType
 from ralph_assets.models import Asset
 from ralph_assets.forms import OfficeForm
@@ -196,6 +197,10 @@ class BulkEditBase(BobBulkEditBase):
         else:
             return self.form_bulk
 
+    @deferred_history()
+    def save_formset(self, instances, formset):
+        return super(BulkEditBase, self).save_formset(instances, formset)
+
     def get_query_from_request(self, *args, **kwargs):
         if self.request.GET.get('from_query'):
             query = super(
@@ -302,14 +307,20 @@ class ContentTypeMixin(object):
         self.content_type = ContentType.objects.get(pk=self.content_type_id)
         self.model = self.content_type.model_class()
         self.object_id = kwargs[self.object_id_kwarg_name]
+        self._content_object = None
         return super(ContentTypeMixin, self).dispatch(request, *args, **kwargs)
 
+    def get_content_object(self):
+        if self._content_object is None:
+            self._content_object = self.model.objects.get(pk=self.object_id)
+        return self._content_object
+
     def get_context_data(self, **kwargs):
         context = super(ContentTypeMixin, self).get_context_data(**kwargs)
         context.update({
             'content_type': self.content_type,
             'content_type_id': self.content_type_id,
             'object_id': self.object_id,
-            'content_object': self.model.objects.get(pk=self.object_id),
+            'content_object': self.get_content_object(),
         })
         return context
@@ -5,29 +5,35 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import copy
+import itertools
 import logging
+from collections import defaultdict
 
 from django.conf import settings
 from django.core.files.storage import FileSystemStorage
 from django.contrib.auth.models import User
 from django.contrib.formtools.wizard.views import SessionWizardView
 from django.core.exceptions import ObjectDoesNotExist, MultipleObjectsReturned
-from django.db import transaction
-from django.db.models.fields import (
-    BooleanField,
-    CharField,
-    DateField,
-    DecimalField,
-    TextField,
-)
+from django.db import DatabaseError, transaction
+from django.db.models.fields import FieldDoesNotExist
 from django.db.models.fields.related import RelatedField, ManyToManyField
 from django.shortcuts import render
 from django.template.defaultfilters import slugify
-from django.utils.dateparse import parse_date, parse_datetime
 from lck.django.common.models import Named
 from ralph.account.models import Region
 from ralph.discovery.models_device import DeviceEnvironment, ServiceCatalog
 
+from ralph_assets.data_import_utils import (
+    AssetModelResolver,
+    BULK_UPDATE_EXCLUDED_FIELDS,
+    ImportValidator,
+    bulk_update,
+    chunked,
+    convert_rows,
+    convert_value,
+    get_field_spec,
+)
 from ralph_assets.forms_import import (
     ColumnChoiceField,
     get_model_by_name,
@@ -37,17 +43,24 @@ from ralph_assets.models_assets import (
     MODE2ASSET_TYPE,
     ASSET_TYPE2MODE,
     CreatableFromString,
+    _replace_empty_with_none,
     Sluggy,
     AssetType,
 )
+from ralph_assets.history.models import History
+from ralph_assets.history.utils import (
+    context as history_context,
+    deferred_history,
+    get_diff_data,
+)
+from ralph_assets.models_outbox import ChangeOperation, OutboxEntry
+from ralph_assets.models_signals import OUTBOX_MODELS
 from ralph_assets.models_util import add_problem, ProblemSeverity
 from ralph_assets.views.asset import AssetsBase
 from ralph_assets.models import (
     Asset,
     AssetCategory,
     AssetCategoryType,
-    AssetManufacturer,
-    AssetModel,
 )
 
 
@@ -88,6 +101,21 @@ class XlsUploadView(SessionWizardView, AssetsBase):
     def get_form(self, step=None, data=None, files=None):
         if step is None:
             step = self.steps.current
+        if step == 'confirm':
+            # needed by the validation of the file
+            names_per_sheet, _, _ =\
+                self.get_cleaned_data_for_step('upload')['file']
+            mappings = {}
+            all_names = set(sum((
+                [slugify(n) for n in name_list]
+                for name_list in names_per_sheet.values()
+            ), []))
+            for k, v in self.get_cleaned_data_for_step(
+                'column_choice'
+            ).items():
+                if k in all_names and v != '':
+                    mappings[k.lower()] = v
+            self.storage.data['mappings'] = mappings
         form = super(XlsUploadView, self).get_form(step, data, files)
         if step == 'column_choice':
             names_per_sheet, update_per_sheet, add_per_sheet =\
@@ -109,22 +137,32 @@ class XlsUploadView(SessionWizardView, AssetsBase):
                     )
                     if options:
                         form.fields[slugify(name)].initial = options[0][0]
-        elif step == 'confirm':
-            names_per_sheet, _, _ =\
-                self.get_cleaned_data_for_step('upload')['file']
-            mappings = {}
-            all_names = set(sum((
-                [slugify(n) for n in name_list]
-                for name_list in names_per_sheet.values()
-            ), []))
-            for k, v in self.get_cleaned_data_for_step(
-                'column_choice'
-            ).items():
-                if k in all_names and v != '':
-                    mappings[k.lower()] = v
-            self.storage.data['mappings'] = mappings
         return form
 
+    def get_form_kwargs(self, step):
+        if step == 'confirm':
+            return {'validation_errors': self.get_validation_errors()}
+        return super(XlsUploadView, self).get_form_kwargs(step)
+
+    def get_validation_errors(self):
+        """Return problems of the uploaded file found by
+        :class:`ImportValidator`, computed once per request (before anything
+        is written)."""
+        if not hasattr(self, '_validation_errors'):
+            _, update_per_sheet, add_per_sheet =\
+                self.get_cleaned_data_for_step('upload')['file']
+            validator = ImportValidator(
+                get_model_by_name(
+                    self.get_cleaned_data_for_step('upload')['model']
+                ),
+                self.storage.data['mappings'],
+                MODE2ASSET_CATEGORY_TYPE.get(self.mode),
+            )
+            self._validation_errors = validator.validate(
+                update_per_sheet, add_per_sheet,
+            )
+        return self._validation_errors
+
     def get_context_data(self, form, **kwargs):
         data = super(XlsUploadView, self).get_context_data(form, **kwargs)
         if self.steps.current == 'confirm':
@@ -161,40 +199,35 @@ class XlsUploadView(SessionWizardView, AssetsBase):
             data['all_column_names'] = all_column_names
             data['update_table'] = update_table
             data['add_table'] = add_table
+            data['validation_errors'] = self.get_validation_errors()
         data['section'] = None
         return data
 
-    def _get_field_value(self, field_name, value):
-        """Transform a pure string into the value to be put into the field."""
+    def _get_field(self, field_name):
         if '.' in field_name:
             Model = self.AmdModel
             _, field_name = field_name.split('.', 1)
         else:
             Model = self.Model
-        field = Model._meta.get_field_by_name(field_name)[0]
+        return Model._meta.get_field_by_name(field_name)[0]
+
+    def _get_field_spec(self, field_name):
+        specs = self._field_specs
+        if field_name not in specs:
+            specs[field_name] = get_field_spec(self._get_field(field_name))
+        return specs[field_name]
+
+    def _get_field_value(self, field_name, value, converted=False):
+        """Transform a pure string into the value to be put into the field.
+
+        When *converted* is set, *value* has been already passed through
+        ``convert_value`` and only related objects are resolved.
+        """
+        field = self._get_field(field_name)
+        if not converted:
+            value = convert_value(self._get_field_spec(field_name), value)
         if not value:
-            if isinstance(field, ManyToManyField):
-                return []
-            elif (
-                isinstance(field, (TextField, CharField)) and
-                field_name not in ('imei', 'sn', 'barcode')
-            ):
-                return ''
-            else:
-                return
-        if isinstance(field, BooleanField):
-            value = False if value.lower() in ["0", "false"] else True
-        if isinstance(field, DecimalField):
-            if value.count(',') == 1 and '.' not in value:
-                value = value.replace(',', '.')
-        if isinstance(field, DateField):
-            value = parse_datetime(value) or parse_date(value) or None
-        if field.choices:
-            value_lower = value.lower().strip()
-            for k, v in field.choices:
-                if value_lower == v.lower().strip():
-                    value = k
-                    break
+            return value
 
         if (
             isinstance(value, basestring) and
@@ -251,7 +284,7 @@ class XlsUploadView(SessionWizardView, AssetsBase):
             value = [value]
         return value
 
-    @transaction.commit_on_success
+    @deferred_history()
     def done(self, form_list):
         mappings = self.storage.data['mappings']
         names_per_sheet, update_per_sheet, add_per_sheet =\
@@ -261,54 +294,98 @@ class XlsUploadView(SessionWizardView, AssetsBase):
         model = self.get_cleaned_data_for_step('upload')['model']
         self.Model = get_model_by_name(model)
 
+        resolve_models = (
+            model == 'ralph_assets.asset' and
+            'model.category' in mappings.values()
+        )
+
         def get_or_create_asset_model(asset_data, asset=None):
-            if model == 'ralph_assets.asset':
-                category_key = [
-                    k for k, v in mappings.iteritems() if v == 'model.category'
-                ]
-                if category_key:
-                    category_name = [
-                        v for k, v in asset_data.iteritems()
-                        if slugify(k) == category_key[0]
-                    ][0]
-                    try:
-                        asset_data = self.get_or_create_model(asset_data)
-                    except AssetCategory.DoesNotExist:
-                        msg = "Category '{0}' does not exists".format(
-                            category_name
-                        )
-                        errors[asset or tuple(asset_data.values())] = msg
-                        return asset_data, False
+            if resolve_models:
+                category_name = asset_data.get(
+                    self.get_column_mapping(asset_data).get('model.category')
+                )
+                try:
+                    asset_data = self.get_or_create_model(asset_data)
+                except AssetCategory.DoesNotExist:
+                    msg = "Category '{0}' does not exists".format(
+                        category_name
+                    )
+                    errors[asset or tuple(asset_data.values())] = msg
+                    return asset_data, False
             return asset_data, True
 
         if model == 'ralph_assets.asset':
             amd_field, amd_model = get_amendment_model(self.mode)
             self.AmdModel = get_model_by_name(amd_model)
+            self._column_mappings = {}
+            self.model_resolver = AssetModelResolver(
+                MODE2ASSET_TYPE[self.mode],
+                MODE2ASSET_CATEGORY_TYPE.get(self.mode),
+            )
+            if resolve_models:
+                self.preload_asset_models(
+                    [
+                        asset_data
+                        for sheet_data in update_per_sheet.values()
+                        for asset_data in sheet_data.values()
+                    ] + [
+                        asset_data
+                        for sheet_data in add_per_sheet.values()
+                        for asset_data in sheet_data
+                    ]
+                )
         else:
             amd_field = amd_model = self.AmdModel = None
+        self._field_specs = {}
+        conversion_errors = self.convert_sheets(
+            mappings, update_per_sheet, add_per_sheet,
+        )
 
         for sheet_name, sheet_data in update_per_sheet.items():
+            originals = {}
+            for chunk in chunked(sheet_data.keys()):
+                originals.update(self.Model.objects.in_bulk(chunk))
+            updated = []
             for asset_id, asset_data in sheet_data.items():
-                try:
-                    asset = self.Model.objects.get(pk=asset_id)
-                except ObjectDoesNotExist:
+                asset = originals.get(asset_id)
+                if asset is None:
                     failed_assets.append(asset_id)
                     continue
+                if id(asset_data) in conversion_errors:
+                    errors[asset_id] = conversion_errors[id(asset_data)]
+                    continue
                 asset_data, success = get_or_create_asset_model(
                     asset_data, asset
                 )
                 if not success:
                     continue
                 try:
+                    field_names = set(
+                        mappings[key.lower()] for key in asset_data
+                    )
+                    bulk = self.can_bulk_update(field_names)
+                    if bulk:
+                        original, asset = asset, copy.copy(asset)
                     for key, value in asset_data.items():
                         key = key.lower()
-                        new_value = self._get_field_value(mappings[key], value)
+                        new_value = self._get_field_value(
+                            mappings[key], value, converted=True,
+                        )
                         setattr(asset, mappings[key], new_value)
-                    asset.save()
+                    if bulk:
+                        updated.append((original, asset, field_names))
+                    else:
+                        asset.save()
                 except Exception as exc:
                     errors[asset_id] = repr(exc)
+            self.save_updated(updated, errors)
         for sheet_name, sheet_data in add_per_sheet.items():
             for asset_data in sheet_data:
+                if id(asset_data) in conversion_errors:
+                    errors[tuple(asset_data.values())] = conversion_errors[
+                        id(asset_data)
+                    ]
+                    continue
                 asset_data, success = get_or_create_asset_model(asset_data)
                 if not success:
                     continue
@@ -322,7 +399,9 @@ class XlsUploadView(SessionWizardView, AssetsBase):
                     if field_name is None:
                         continue
                     try:
-                        value = self._get_field_value(field_name, value)
+                        value = self._get_field_value(
+                            field_name, value, converted=True,
+                        )
                     except RequiredFieldError as exc:
                         errors[tuple(asset_data.values())] = repr(exc.message)
                         break
@@ -389,45 +468,167 @@ class XlsUploadView(SessionWizardView, AssetsBase):
             ctx_data
         )
 
+    def convert_sheets(self, mappings, update_per_sheet, add_per_sheet):
+        """Convert cell values of all rows in place, before anything is
+        written to the database.
+
+        Return errors of rows which couldn't be converted, keyed by ``id`` of
+        the row dict.
+        """
+        rows = [
+            asset_data
+            for sheet_data in update_per_sheet.values()
+            for asset_data in sheet_data.values()
+        ] + [
+            asset_data
+            for sheet_data in add_per_sheet.values()
+            for asset_data in sheet_data
+        ]
+        specs = {}
+        for key in set(itertools.chain.from_iterable(rows)):
+            field_name = mappings.get(slugify(key)) or mappings.get(
+                key.lower()
+            )
+            if not field_name or field_name.startswith('model.'):
+                continue
+            try:
+                specs[key] = self._get_field_spec(field_name)
+            except (AttributeError, FieldDoesNotExist):
+                continue
+        conversion_errors = {}
+        for asset_data, (converted, error) in zip(
+            rows, convert_rows(specs, rows),
+        ):
+            if error:
+                conversion_errors[id(asset_data)] = '{}: {}'.format(*error)
+            else:
+                asset_data.update(converted)
+        return conversion_errors
+
+    def can_bulk_update(self, field_names):
+        """Check if changes of *field_names* can be written without calling
+        ``save`` on each object."""
+        local_fields = set(field.name for field in self.Model._meta.fields)
+        return (
+            field_names <= local_fields and
+            not field_names & BULK_UPDATE_EXCLUDED_FIELDS
+        )
+
+    def save_updated(self, updated, errors):
+        """Write changes of objects from the update sheet in chunked bulk
+        updates and log their history in one batch.
+
+        *updated* is a list of ``(original, changed copy, field names)``.
+        History is computed against the originals loaded before, so objects
+        aren't selected again.
+        """
+        local_fields = set(field.name for field in self.Model._meta.fields)
+        values = {}
+        if 'modified_by' in local_fields:
+            values['modified_by'] = self.request.user.get_profile()
+        empty_as_none = getattr(self.Model, 'empty_as_none_fields', ())
+        by_fields = defaultdict(list)
+        for original, asset, field_names in updated:
+            # normalized as save would do
+            _replace_empty_with_none(asset, empty_as_none)
+            changed = []
+            for name in sorted(field_names):
+                attname = self.Model._meta.get_field(name).attname
+                if getattr(original, attname) != getattr(asset, attname):
+                    changed.append(name)
+            changed = tuple(changed)
+            if changed:
+                by_fields[changed].append((original, asset))
+        logged = history_context.registry.get(self.Model)
+        history = []
+        for field_names, rows in by_fields.iteritems():
+            sid = transaction.savepoint()
+            try:
+                bulk_update(
+                    self.Model, [asset for _, asset in rows], field_names,
+                    values,
+                )
+            except DatabaseError:
+                transaction.savepoint_rollback(sid)
+                for _, asset in rows:
+                    try:
+                        asset.save()
+                    except Exception as exc:
+                        errors[asset.pk] = repr(exc)
+                continue
+            transaction.savepoint_commit(sid)
+            if logged:
+                for original, asset in rows:
+                    past, current = history_context.get_fields_snapshot(
+                        [original, asset],
+                    )
+                    history.extend(History.objects.build_changes(
+                        asset,
+                        getattr(asset, 'saving_user', None),
+                        get_diff_data(
+                            original, asset, past['fields'],
+                            current['fields'],
+                        ),
+                    ))
+            # set after history, so they aren't logged as changes
+            for _, asset in rows:
+                for name, value in values.iteritems():
+                    setattr(asset, name, value)
+            if self.Model in OUTBOX_MODELS:
+                # bulk updates don't send signals
+                OutboxEntry.objects.log(
+                    [asset for _, asset in rows], ChangeOperation.updated,
+                )
+        history_context.write(history)
+
+    def get_column_mapping(self, data):
+        """Return mapping of a field name to the key of the column in *data*.
+
+        Rows of one sheet share column names, so the mapping is computed once
+        per set of columns.
+        """
+        keys = frozenset(data)
+        cache = self._column_mappings
+        if keys not in cache:
+            slugified_names = {
+                slugify(k): k for k in keys
+            }
+            cache[keys] = {
+                v: slugified_names[k]
+                for k, v in self.storage.data['mappings'].iteritems()
+                if k in slugified_names
+            }
+        return cache[keys]
+
+    def preload_asset_models(self, rows):
+        """Resolve all distinct models used in *rows* with a few queries."""
+        combinations = set()
+        for data in rows:
+            mapping = self.get_column_mapping(data)
+            combinations.add((
+                data.get(mapping.get('model')),
+                data.get(mapping.get('model.category')) or None,
+                data.get(mapping.get('model.manufacturer')) or None,
+            ))
+        self.model_resolver.preload(combinations)
+
     def get_or_create_model(self, data):
         """Update/add AssetModel and clear asset_data from its fields.
 
         Raise AssetCategory.DoesNotExist if category name is provided but not
         exists.
         """
-        slugified_names = {
-            slugify(k): k for k in data
-        }
-        mapping = {
-            v: slugified_names[k]
-            for k, v in self.storage.data['mappings'].iteritems()
-        }
+        mapping = self.get_column_mapping(data)
         get_name = mapping.get
 
-        model = data.get(mapping.get('model'), None)
-        category = data.pop(mapping.get('model.category'), None)
-        manufacturer = data.pop(mapping.get('model.manufacturer'), None)
+        model = data.get(get_name('model'), None)
+        category = data.pop(get_name('model.category'), None)
+        manufacturer = data.pop(get_name('model.manufacturer'), None)
 
         if not model:
             return data
 
-        kwargs = {'name': model, 'type': MODE2ASSET_TYPE[self.mode]}
-
-        if category:
-            category = AssetCategory.objects.get(
-                name=category,
-                type=MODE2ASSET_CATEGORY_TYPE[self.mode],
-            )
-        else:
-            category = None
-        kwargs['category'] = category
-        if manufacturer:
-            manufacturer = AssetManufacturer.objects.get_or_create(
-                name=manufacturer,
-            )[0]
-        else:
-            manufacturer = None
-        kwargs['manufacturer'] = manufacturer
-
-        data[get_name('model')] = AssetModel.objects.get_or_create(**kwargs)[0]
+        data[get_name('model')] = self.model_resolver.get(
+            model, category or None, manufacturer or None,
+        )
         return data
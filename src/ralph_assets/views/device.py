@@ -166,6 +166,27 @@ class EditDevice(HardwareModeMixin, SubmoduleModeMixin, AssetsBase):
         })
         return context
 
+    def _update_licences(self, licence_ids):
+        """Change assignments of the asset to licences with *licence_ids*,
+        keeping quantities of licences assigned before, and log the changed
+        sets of licences and their assets, as clearing them did."""
+        selected = set(int(licence_id) for licence_id in licence_ids)
+        assigned = set(self.asset.licences.values_list('pk', flat=True))
+        if selected == assigned:
+            return
+        for licence in Licence.objects.filter(pk__in=assigned - selected):
+            licence.detach_many([self.asset], user=self.request.user)
+        for licence in Licence.objects.filter(pk__in=selected - assigned):
+            licence.assign(self.asset)
+        asset = self.asset
+        asset.save_history_from_snapshot(asset.get_snapshot(
+            asset, None, 'licences', current=sorted(selected),
+        ))
+        for licence in Licence.objects.filter(pk__in=selected ^ assigned):
+            asset.save_history_from_snapshot(
+                asset.get_snapshot(licence, licence.assets, 'assets'),
+            )
+
     def _update_additional_info(self, modifier):
         if self.asset.type in AssetType.DC.choices:
             self.asset = _update_device_info(
@@ -274,11 +295,9 @@ class EditDevice(HardwareModeMixin, SubmoduleModeMixin, AssetsBase):
                 self.asset.save(
                     user=self.request.user, force_unlink=force_unlink,
                 )
-                self.asset.licences.clear()
-                for licence in self.asset_form.cleaned_data.get(
-                    'licences', []
-                ):
-                    Licence.objects.get(pk=licence).assign(self.asset)
+                self._update_licences(
+                    self.asset_form.cleaned_data.get('licences', []),
+                )
                 self.asset.supports.clear()
                 for support in self.asset_form.cleaned_data.get(
                     'supports', []
@@ -19,7 +19,7 @@ from ralph_assets.forms_support import (
     SupportSearchForm,
 )
 from ralph_assets.models_assets import Asset
-from ralph_assets.models_support import Support
+from ralph_assets.models_support import ASSETS_COUNT_SQL, Support
 from ralph_assets.views.base import AssetsBase
 from ralph_assets.licences.views import CheckBoxColumn
 from ralph_assets.views.search import GenericSearch
@@ -146,6 +146,12 @@ class SupportList(GenericSearch):
             field='price',
             sort_expression='price',
         ),
+        DataTableColumn(
+            _('Assets'),
+            bob_tag=True,
+            field='assets_count',
+            sort_expression='assets_count',
+        ),
         DataTableColumn(
             _('Created'),
             bob_tag=True,
@@ -154,12 +160,9 @@ class SupportList(GenericSearch):
         ),
     ]
 
-    def get_context_data(self, *args, **kwargs):
-        data = super(SupportList, self).get_context_data(
-            *args, **kwargs
-        )
-        data['supports'] = Support.objects.all()
-        return data
+    def handle_search_data(self, request):
+        query_set = super(SupportList, self).handle_search_data(request)
+        return query_set.extra(select={'assets_count': ASSETS_COUNT_SQL})
 
 
 class EditSupportView(SupportView):